@@ -0,0 +1,216 @@
+"""
+Модуль контрольных точек состояния касс (desk_checkpoints)
+
+Контрольная точка - состояние кассы на момент as_of: балансы, книга открытых лотов
+и накопленная прибыль по валютам. Точки создаются периодически фоновой задачей.
+Состояние на произвольную дату собирается от ближайшей точки не позже этой даты:
+проигрываются только транзакции после неё, а не вся история кассы.
+"""
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+import zlib
+import bson
+from .db import db
+from .constants import CHECKPOINT_INTERVAL_SECONDS, CHECKPOINT_MAX_PER_DESK
+from .fifo_engine import LotBook
+from .history_manager import history_manager
+from .replay import replay_manager
+
+ZLIB_LEVEL = 6
+
+
+class CheckpointManager:
+    """Менеджер контрольных точек состояния касс"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Поиск ближайшей точки кассы по времени"""
+        db.desk_checkpoints.create_index([("cash_desk_id", 1), ("as_of", -1)])
+        db.desk_checkpoints.create_index([("tenant_id", 1), ("as_of", -1)])
+
+    @staticmethod
+    def _encode_lots(lots: list) -> bson.Binary:
+        return bson.Binary(zlib.compress(bson.encode({"lots": lots}), ZLIB_LEVEL))
+
+    @staticmethod
+    def _decode_lots(data: bytes) -> list:
+        return bson.decode(zlib.decompress(data))["lots"]
+
+    @staticmethod
+    def _read_state(cash_desk_id: str, session=None) -> Dict[str, Any]:
+        """
+        Балансы, открытые лоты, прибыль и момент последней транзакции кассы.
+        Читаются одной транзакцией MongoDB - из одного снимка данных, который
+        записи обменов (транзакция, лоты и балансы одной транзакцией) меняют целиком
+        """
+        desk_filter = {"cash_desk_id": cash_desk_id}
+        balances = {row["asset"]: row["balance"] for row in db.cash.find(desk_filter, session=session)}
+        lots = list(db.fiat_lots.find({**desk_filter, "remaining": {"$gt": 0}}, session=session))
+        last_tx = db.transactions.find_one(
+            desk_filter, {"created_at": 1}, sort=[("created_at", -1), ("_id", -1)], session=session
+        )
+        # desk_stats обновляются после фиксации записи и могут отставать от снимка - прибыль
+        # считаем по тем же транзакциям, что отражены в балансах и лотах
+        profit, tx_count = {}, 0
+        pipeline = [
+            {"$match": desk_filter},
+            {"$group": {"_id": "$profit_currency", "profit": {"$sum": "$realized_profit"}, "count": {"$sum": 1}}}
+        ]
+        for row in db.transactions.aggregate(pipeline, session=session):
+            tx_count += row["count"]
+            if row["_id"] and row["profit"]:
+                profit[row["_id"]] = row["profit"]
+        return {
+            "as_of": last_tx["created_at"] if last_tx else datetime.utcnow(),
+            "balances": balances,
+            "lots": lots,
+            "profit": profit,
+            "tx_count": tx_count
+        }
+
+    @staticmethod
+    def create_checkpoint(cash_desk_id: str, tenant_id: str) -> Dict[str, Any]:
+        """
+        Фиксирует текущее состояние кассы. as_of - момент последней транзакции,
+        отражённой в прочитанном состоянии: транзакции позже него в точку не вошли
+
+        Returns:
+            Метаданные созданной точки (без книги лотов)
+        """
+        state = {}
+
+        def read(session):
+            state.update(CheckpointManager._read_state(cash_desk_id, session))
+
+        history_manager.run_in_transaction(read)
+        as_of, balances, lots = state["as_of"], state["balances"], state["lots"]
+
+        checkpoint = {
+            "tenant_id": tenant_id,
+            "cash_desk_id": cash_desk_id,
+            "as_of": as_of,
+            "balances": balances,
+            "profit": state["profit"],
+            "tx_count": state["tx_count"],
+            "lot_count": len(lots),
+            "lots": CheckpointManager._encode_lots(lots),
+            "created_at": datetime.utcnow()
+        }
+        result = db.desk_checkpoints.insert_one(checkpoint)
+        CheckpointManager._cleanup(cash_desk_id)
+
+        print(f"📍 Checkpoint saved for desk {cash_desk_id}: {len(lots)} open lots")
+        return {
+            "_id": str(result.inserted_id),
+            "cash_desk_id": cash_desk_id,
+            "as_of": as_of,
+            "balances": balances,
+            "profit": checkpoint["profit"],
+            "tx_count": checkpoint["tx_count"],
+            "lot_count": checkpoint["lot_count"]
+        }
+
+    @staticmethod
+    def _cleanup(cash_desk_id: str) -> int:
+        """Оставляет только последние CHECKPOINT_MAX_PER_DESK точек кассы"""
+        old_ids = [
+            checkpoint["_id"]
+            for checkpoint in db.desk_checkpoints.find({"cash_desk_id": cash_desk_id}, {"_id": 1})
+            .sort("as_of", -1)
+            .skip(CHECKPOINT_MAX_PER_DESK)
+        ]
+        if not old_ids:
+            return 0
+        return db.desk_checkpoints.delete_many({"_id": {"$in": old_ids}}).deleted_count
+
+    @staticmethod
+    def run_due() -> int:
+        """
+        Фоновая задача: создаёт точки для касс, у которых последняя точка старше интервала
+        и после неё были операции
+
+        Returns:
+            Количество созданных точек
+        """
+        threshold = datetime.utcnow() - timedelta(seconds=CHECKPOINT_INTERVAL_SECONDS)
+        created = 0
+        for desk in db.cash_desks.find({"is_active": True}, {"_id": 1, "tenant_id": 1}):
+            cash_desk_id = desk["_id"]
+            try:
+                last = db.desk_checkpoints.find_one(
+                    {"cash_desk_id": cash_desk_id}, {"as_of": 1}, sort=[("as_of", -1)]
+                )
+                if last and last["as_of"] > threshold:
+                    continue
+                stats = db.desk_stats.find_one({"_id": cash_desk_id}, {"last_op_at": 1}) or {}
+                last_op_at = stats.get("last_op_at")
+                if last and (last_op_at is None or last_op_at <= last["as_of"]):
+                    # С последней точки ничего не изменилось
+                    continue
+                CheckpointManager.create_checkpoint(cash_desk_id, desk["tenant_id"])
+                created += 1
+            except Exception as e:
+                print(f"❌ Failed to create checkpoint for desk {cash_desk_id}: {e}")
+        return created
+
+    @staticmethod
+    def get_state_at(cash_desk_id: str, at: datetime) -> Dict[str, Any]:
+        """
+        Состояние кассы на момент at: ближайшая точка не позже at
+        плюс проигрывание транзакций между ней и at
+
+        Returns:
+            {as_of, checkpoint_at, replayed_transactions, balances, profit, lots}
+        """
+        checkpoint = db.desk_checkpoints.find_one(
+            {"cash_desk_id": cash_desk_id, "as_of": {"$lte": at}},
+            sort=[("as_of", -1)]
+        )
+        if checkpoint:
+            book = LotBook(CheckpointManager._decode_lots(checkpoint["lots"]))
+            replayed = replay_manager.regenerate(
+                cash_desk_id,
+                book=book,
+                balances=checkpoint.get("balances"),
+                profit=checkpoint.get("profit"),
+                since=checkpoint["as_of"],
+                until=at
+            )
+        else:
+            # Точек раньше at нет - проигрываем историю кассы с начала
+            replayed = replay_manager.regenerate(cash_desk_id, until=at)
+
+        lots = []
+        for lot in replayed["book"].open_lots():
+            lots.append({**lot, "_id": str(lot["_id"])})
+
+        return {
+            "as_of": at,
+            "checkpoint_at": checkpoint["as_of"] if checkpoint else None,
+            "replayed_transactions": replayed["count"],
+            "balances": replayed["balances"],
+            "profit": replayed["profit"],
+            "lots": lots
+        }
+
+    @staticmethod
+    def invalidate(tenant_id: str, cash_desk_id: Optional[str] = None, since: Optional[datetime] = None) -> int:
+        """
+        Удаляет точки, которые больше не отражают историю кассы
+        (после отмены, повтора или пересборки изменений, сделанных до них)
+        """
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        if since:
+            filter_criteria["as_of"] = {"$gte": since}
+        return db.desk_checkpoints.delete_many(filter_criteria).deleted_count
+
+    @staticmethod
+    def clear(tenant_id: str, cash_desk_id: Optional[str] = None) -> int:
+        """Удаляет точки tenant'а (или одной кассы)"""
+        return CheckpointManager.invalidate(tenant_id, cash_desk_id)
+
+
+# Глобальный экземпляр
+checkpoint_manager = CheckpointManager()
@@ -28,4 +28,33 @@ GOOGLE_SHEETS_CREDENTIALS_PATH = os.getenv(
     "GOOGLE_SHEETS_CREDENTIALS_PATH", 
     "credentials/google-sheets-key.json"
 )
-GOOGLE_SHEETS_SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
\ No newline at end of file
+GOOGLE_SHEETS_SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
+# Сжатие журналов снимков истории: "zlib" или "none"
+SNAPSHOT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zlib").lower()
+
+# Хранение снимков по времени: TTL в днях (0 - только лимит по количеству)
+SNAPSHOT_TTL_DAYS = int(os.getenv("SNAPSHOT_TTL_DAYS", "0"))
+
+# Период фоновой очистки снимков, секунды
+SNAPSHOT_PRUNE_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_PRUNE_INTERVAL_SECONDS", "3600"))
+
+# Период создания контрольных точек состояния касс, секунды (0 - отключено)
+CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("CHECKPOINT_INTERVAL_SECONDS", "86400"))
+
+# Сколько контрольных точек хранить на кассу
+CHECKPOINT_MAX_PER_DESK = int(os.getenv("CHECKPOINT_MAX_PER_DESK", "366"))
+
+# Размер LRU-кэша результатов предпросмотра обмена (0 - кэш отключён)
+PREVIEW_CACHE_SIZE = int(os.getenv("PREVIEW_CACHE_SIZE", "512"))
+
+# Сколько книг лотов касс держать в памяти процесса (0 - кэш отключён)
+LOT_BOOK_CACHE_DESKS = int(os.getenv("LOT_BOOK_CACHE_DESKS", "64"))
+
+# Запись денежных полей в Decimal128 (false - писать double, как до миграции)
+MONEY_DECIMAL128 = os.getenv("MONEY_DECIMAL128", "true").lower() == "true"
+
+# Матчи PnL: один документ на закрывающую транзакцию (pnl_match_buckets) вместо документа на кусок
+PNL_MATCH_BUCKETS = os.getenv("PNL_MATCH_BUCKETS", "true").lower() == "true"
+
+# Сколько часов хранится ответ по ключу Idempotency-Key
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
@@ -0,0 +1,189 @@
+"""
+Модуль дневных агрегатов (daily_rollups)
+
+Один документ на (tenant, касса, день, валюта): объёмы прихода/расхода, комиссии,
+реализованный PnL в фиате и USDT, количество транзакций.
+Обновляется инкрементально каждой записью и может быть пересобран пакетной задачей.
+"""
+from datetime import datetime, date, time
+from typing import Optional, Dict, Any
+from pymongo import UpdateOne, InsertOne
+from .db import db
+from .utils.transaction_utils import transaction_cash_flows
+
+ROLLUP_FIELDS = ["volume_in", "volume_out", "fee_total", "pnl_fiat", "pnl_usdt", "tx_count"]
+
+
+class RollupManager:
+    """Менеджер дневных агрегатов по валютам"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Уникальный ключ агрегата и индекс для выборки по периоду"""
+        db.daily_rollups.create_index(
+            [("tenant_id", 1), ("cash_desk_id", 1), ("day", 1), ("currency", 1)],
+            unique=True
+        )
+        db.daily_rollups.create_index([("tenant_id", 1), ("day", 1)])
+
+    @staticmethod
+    def day_start(value) -> datetime:
+        """Начало дня (UTC) для даты или времени транзакции"""
+        if isinstance(value, datetime):
+            return datetime.combine(value.date(), time.min)
+        if isinstance(value, date):
+            return datetime.combine(value, time.min)
+        return datetime.combine(datetime.utcnow().date(), time.min)
+
+    @staticmethod
+    def _contributions(tx: dict) -> Dict[str, Dict[str, float]]:
+        """Вклад транзакции в агрегаты по валютам: {валюта: {поле: значение}}"""
+        result = {}
+
+        def add(currency, field, value):
+            if not currency or not value:
+                return
+            result.setdefault(currency, {})
+            result[currency][field] = result[currency].get(field, 0) + value
+
+        for asset, delta in transaction_cash_flows(tx):
+            if delta > 0:
+                add(asset, "volume_in", delta)
+            else:
+                add(asset, "volume_out", -delta)
+
+        # Комиссия номинирована в to_asset (фиат для crypto_to_fiat, крипта для fiat_to_crypto)
+        if tx.get("type") in ("fiat_to_crypto", "crypto_to_fiat"):
+            add(tx.get("to_asset"), "fee_total", abs(tx.get("fee_amount") or 0))
+
+        profit_currency = tx.get("profit_currency")
+        add(profit_currency, "pnl_fiat", tx.get("realized_profit") or 0)
+        add(profit_currency, "pnl_usdt", tx.get("realized_profit_usdt") or 0)
+
+        for asset in {tx.get("from_asset"), tx.get("to_asset")}:
+            if asset:
+                result.setdefault(asset, {})["tx_count"] = 1
+
+        return result
+
+    @staticmethod
+    def _apply(tx: dict, sign: int):
+        cash_desk_id = tx.get("cash_desk_id")
+        tenant_id = tx.get("tenant_id")
+        if not cash_desk_id or not tenant_id:
+            return
+
+        day = RollupManager.day_start(tx.get("created_at"))
+        operations = []
+        for currency, fields in RollupManager._contributions(tx).items():
+            operations.append(UpdateOne(
+                {"tenant_id": tenant_id, "cash_desk_id": cash_desk_id, "day": day, "currency": currency},
+                {
+                    "$inc": {field: sign * value for field, value in fields.items()},
+                    "$set": {"updated_at": datetime.utcnow()}
+                },
+                upsert=True
+            ))
+
+        if operations:
+            try:
+                db.daily_rollups.bulk_write(operations, ordered=False)
+            except Exception as e:
+                print(f"❌ Failed to update daily rollups for desk {cash_desk_id}: {e}")
+
+    @staticmethod
+    def record_transaction(tx: dict):
+        """Учитывает транзакцию в агрегатах её дня"""
+        RollupManager._apply(tx, 1)
+
+    @staticmethod
+    def remove_transaction(tx: dict):
+        """Вычитает удалённую транзакцию из агрегатов её дня"""
+        RollupManager._apply(tx, -1)
+
+    @staticmethod
+    def backfill(tenant_id: str, cash_desk_id: str = None) -> int:
+        """
+        Пересобирает агрегаты по сырым транзакциям (пакетная задача)
+
+        Returns:
+            Количество записанных документов агрегатов
+        """
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+
+        projection = {
+            "_id": 0, "tenant_id": 1, "cash_desk_id": 1, "type": 1, "from_asset": 1, "to_asset": 1,
+            "amount_from": 1, "amount_to_final": 1, "fee_amount": 1, "profit_currency": 1,
+            "realized_profit": 1, "realized_profit_usdt": 1, "created_at": 1
+        }
+
+        rollups = {}
+        for tx in db.transactions.find(filter_criteria, projection).batch_size(1000):
+            if not tx.get("cash_desk_id"):
+                continue
+            day = RollupManager.day_start(tx.get("created_at"))
+            for currency, fields in RollupManager._contributions(tx).items():
+                key = (tx["cash_desk_id"], day, currency)
+                doc = rollups.setdefault(key, {field: 0 for field in ROLLUP_FIELDS})
+                for field, value in fields.items():
+                    doc[field] += value
+
+        db.daily_rollups.delete_many(filter_criteria)
+
+        now = datetime.utcnow()
+        operations = [
+            InsertOne({
+                "tenant_id": tenant_id,
+                "cash_desk_id": desk_id,
+                "day": day,
+                "currency": currency,
+                **fields,
+                "updated_at": now
+            })
+            for (desk_id, day, currency), fields in rollups.items()
+        ]
+        if operations:
+            db.daily_rollups.bulk_write(operations, ordered=False)
+
+        desk_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+        print(f"🔧 Daily rollups backfilled for tenant {tenant_id}{desk_desc}: {len(operations)} documents")
+        return len(operations)
+
+    @staticmethod
+    def get_range(tenant_id: str, date_from: date, date_to: date, cash_desk_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Суммирует агрегаты за период [date_from, date_to] включительно
+
+        Returns:
+            Словарь {валюта: {volume_in, volume_out, fee_total, pnl_fiat, pnl_usdt, tx_count}}
+        """
+        match_filter = {
+            "tenant_id": tenant_id,
+            "day": {"$gte": RollupManager.day_start(date_from), "$lte": RollupManager.day_start(date_to)}
+        }
+        if cash_desk_id:
+            match_filter["cash_desk_id"] = cash_desk_id
+
+        pipeline = [
+            {"$match": match_filter},
+            {"$group": {"_id": "$currency", **{field: {"$sum": f"${field}"} for field in ROLLUP_FIELDS}}}
+        ]
+
+        return {
+            item.pop("_id"): item
+            for item in db.daily_rollups.aggregate(pipeline)
+        }
+
+    @staticmethod
+    def clear(tenant_id: str, cash_desk_id: str = None) -> int:
+        """Удаляет агрегаты tenant'а (или одной кассы)"""
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        return db.daily_rollups.delete_many(filter_criteria).deleted_count
+
+
+# Глобальный экземпляр
+rollup_manager = RollupManager()
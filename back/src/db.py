@@ -1,6 +1,7 @@
 from pymongo import MongoClient
 import os
 from dotenv import load_dotenv
+from .utils.money import MONEY_CODEC_OPTIONS
 
 load_dotenv()
 
@@ -17,4 +18,5 @@ try:
 except Exception as e:
     print(f"MongoDB connection failed: {e}")
 
-db = client["exchange_dashboard"]
+# Денежные поля в Decimal128 читаются как float (см. utils/money.py)
+db = client.get_database("exchange_dashboard", codec_options=MONEY_CODEC_OPTIONS)
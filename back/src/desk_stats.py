@@ -0,0 +1,191 @@
+"""
+Модуль материализованных счётчиков кассы (desk_stats)
+
+Один документ на кассу: реализованная прибыль по валютам, количество операций,
+время последней операции и объёмы прихода/расхода по активам.
+Документ обновляется атомарно каждой записью и может быть пересобран из транзакций.
+"""
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+from .db import db
+from .utils.transaction_utils import transaction_cash_flows
+
+
+class DeskStatsManager:
+    """Менеджер счётчиков кассы, заменяющий $group по всем транзакциям"""
+
+    @staticmethod
+    def _build_inc(tx: dict, sign: int) -> Dict[str, Any]:
+        """Собирает $inc для учёта (sign=1) или отката (sign=-1) транзакции"""
+        inc = {"tx_count": sign}
+
+        profit_currency = tx.get("profit_currency")
+        realized_profit = tx.get("realized_profit") or 0
+        if profit_currency and realized_profit:
+            inc[f"profit.{profit_currency}"] = sign * realized_profit
+
+        for asset, delta in transaction_cash_flows(tx):
+            if not asset or not delta:
+                continue
+            if delta > 0:
+                key = f"volume_in.{asset}"
+            else:
+                key = f"volume_out.{asset}"
+            inc[key] = inc.get(key, 0) + sign * abs(delta)
+
+        return inc
+
+    @staticmethod
+    def apply_changes(removed: List[dict], added: List[dict]):
+        """
+        Вычитает удалённые (или прежние) версии транзакций и учитывает новые - одним $inc на кассу.
+
+        Счётчики меняются только у существующего документа кассы: документ, созданный
+        приращением с нуля, потерял бы всю историю кассы до него. Если документа ещё нет
+        (касса с историей до появления desk_stats), он пересобирается по транзакциям -
+        изменения уже записаны, поэтому пересборка их учитывает
+        """
+        changes: Dict[str, Dict[str, Any]] = {}
+        for txs, sign in ((removed, -1), (added, 1)):
+            for tx in txs:
+                cash_desk_id = tx.get("cash_desk_id")
+                if not cash_desk_id:
+                    continue
+                change = changes.setdefault(cash_desk_id, {"inc": {}, "last_op_at": None, "tenant_id": tx.get("tenant_id")})
+                for key, value in DeskStatsManager._build_inc(tx, sign).items():
+                    change["inc"][key] = change["inc"].get(key, 0) + value
+                if sign > 0:
+                    created_at = tx.get("created_at") or datetime.utcnow()
+                    if change["last_op_at"] is None or created_at > change["last_op_at"]:
+                        change["last_op_at"] = created_at
+
+        for cash_desk_id, change in changes.items():
+            try:
+                update = {"$inc": change["inc"], "$set": {"updated_at": datetime.utcnow()}}
+                if change["last_op_at"] is not None:
+                    update["$max"] = {"last_op_at": change["last_op_at"]}
+                result = db.desk_stats.update_one({"_id": cash_desk_id}, update)
+                if result.matched_count == 0:
+                    DeskStatsManager.rebuild(cash_desk_id, change["tenant_id"])
+            except Exception as e:
+                print(f"❌ Failed to update desk stats for {cash_desk_id}: {e}")
+
+    @staticmethod
+    def record_transaction(tx: dict):
+        """Учитывает новую транзакцию (обмен, депозит или вывод) в счётчиках кассы"""
+        DeskStatsManager.apply_changes([], [tx])
+
+    @staticmethod
+    def remove_transaction(tx: dict):
+        """Вычитает удалённую транзакцию из счётчиков кассы"""
+        DeskStatsManager.apply_changes([tx], [])
+
+    @staticmethod
+    def backfill() -> int:
+        """
+        Пересобирает счётчики касс, у которых документа desk_stats ещё нет
+        (задача запуска: касса с историей не должна начинать счёт с нуля)
+
+        Returns:
+            Количество пересобранных касс
+        """
+        built = {doc["_id"] for doc in db.desk_stats.find({}, {"_id": 1})}
+        rebuilt = 0
+        for desk in db.cash_desks.find({}, {"_id": 1, "tenant_id": 1}):
+            if desk["_id"] not in built:
+                DeskStatsManager.rebuild(desk["_id"], desk.get("tenant_id"))
+                rebuilt += 1
+        return rebuilt
+
+    @staticmethod
+    def rebuild(cash_desk_id: str, tenant_id: str = None) -> Dict[str, Any]:
+        """
+        Пересобирает документ кассы по её транзакциям (ремонтная задача)
+
+        Returns:
+            Пересобранный документ desk_stats
+        """
+        stats = {
+            "_id": cash_desk_id,
+            "tenant_id": tenant_id,
+            "profit": {},
+            "tx_count": 0,
+            "last_op_at": None,
+            "volume_in": {},
+            "volume_out": {},
+        }
+
+        projection = {
+            "_id": 0, "tenant_id": 1, "type": 1, "from_asset": 1, "to_asset": 1,
+            "amount_from": 1, "amount_to_final": 1, "profit_currency": 1,
+            "realized_profit": 1, "created_at": 1
+        }
+        for tx in db.transactions.find({"cash_desk_id": cash_desk_id}, projection):
+            if not stats["tenant_id"]:
+                stats["tenant_id"] = tx.get("tenant_id")
+            for key, value in DeskStatsManager._build_inc(tx, 1).items():
+                if "." in key:
+                    group, field = key.split(".", 1)
+                    stats[group][field] = stats[group].get(field, 0) + value
+                else:
+                    stats[key] += value
+            created_at = tx.get("created_at")
+            if isinstance(created_at, datetime) and (stats["last_op_at"] is None or created_at > stats["last_op_at"]):
+                stats["last_op_at"] = created_at
+
+        stats["updated_at"] = datetime.utcnow()
+        db.desk_stats.replace_one({"_id": cash_desk_id}, stats, upsert=True)
+        print(f"🔧 Desk stats rebuilt for desk {cash_desk_id}: {stats['tx_count']} transactions")
+        return stats
+
+    @staticmethod
+    def rebuild_tenant(tenant_id: str) -> int:
+        """Пересобирает счётчики всех касс tenant'а. Возвращает количество касс"""
+        desk_ids = [d["_id"] for d in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1})]
+        for cash_desk_id in desk_ids:
+            DeskStatsManager.rebuild(cash_desk_id, tenant_id)
+        return len(desk_ids)
+
+    @staticmethod
+    def get_stats(cash_desk_id: str, tenant_id: str = None) -> Dict[str, Any]:
+        """Получает документ кассы; если его ещё нет (старые данные) - собирает его"""
+        stats = db.desk_stats.find_one({"_id": cash_desk_id})
+        if not stats:
+            stats = DeskStatsManager.rebuild(cash_desk_id, tenant_id)
+        return stats
+
+    @staticmethod
+    def get_profits(cash_desk_id: Optional[str] = None, tenant_id: Optional[str] = None) -> Dict[str, float]:
+        """
+        Реализованная прибыль по валютам для кассы или агрегированно по всем кассам tenant'а
+
+        Returns:
+            Словарь {валюта: прибыль}
+        """
+        if cash_desk_id:
+            return dict(DeskStatsManager.get_stats(cash_desk_id, tenant_id).get("profit", {}))
+
+        if not tenant_id:
+            raise ValueError("tenant_id or cash_desk_id is required")
+
+        desk_ids = [d["_id"] for d in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1})]
+        found = {s["_id"]: s for s in db.desk_stats.find({"_id": {"$in": desk_ids}}, {"profit": 1})}
+
+        profits = {}
+        for cash_desk_id in desk_ids:
+            stats = found.get(cash_desk_id) or DeskStatsManager.rebuild(cash_desk_id, tenant_id)
+            for currency, value in stats.get("profit", {}).items():
+                profits[currency] = profits.get(currency, 0) + value
+        return profits
+
+    @staticmethod
+    def clear(tenant_id: str, cash_desk_id: str = None) -> int:
+        """Удаляет счётчики tenant'а (или одной кассы)"""
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["_id"] = cash_desk_id
+        return db.desk_stats.delete_many(filter_criteria).deleted_count
+
+
+# Глобальный экземпляр
+desk_stats_manager = DeskStatsManager()
@@ -0,0 +1,137 @@
+"""
+Модуль версий состояния касс (desk_versions)
+
+Один документ на кассу со счётчиком version. Счётчик увеличивается каждой записью,
+меняющей балансы или фиатные лоты кассы. Кэши, построенные по состоянию кассы
+(например, результаты предпросмотра), хранят версию, по которой они построены,
+и считаются устаревшими, как только версия кассы изменилась.
+
+Запись обмена увеличивает версию в своей транзакции MongoDB при условии, что версия
+не изменилась с момента чтения балансов и лотов (advance) - иначе запись отменяется целиком.
+"""
+from datetime import datetime
+from typing import Optional
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from .db import db
+
+
+class DeskVersionConflict(Exception):
+    """Касса изменилась между чтением её состояния и записью"""
+
+
+class DeskVersionManager:
+    """Менеджер счётчиков версий касс"""
+
+    @staticmethod
+    def get(cash_desk_id: str) -> int:
+        """Текущая версия кассы (0, если касса ещё не менялась)"""
+        doc = db.desk_versions.find_one({"_id": cash_desk_id}, {"version": 1})
+        return doc["version"] if doc else 0
+
+    @staticmethod
+    def bump(cash_desk_id: str, tenant_id: Optional[str] = None) -> Optional[int]:
+        """
+        Увеличивает версию кассы после изменения её балансов или лотов
+
+        Returns:
+            Новая версия или None, если обновить счётчик не удалось
+        """
+        if not cash_desk_id:
+            return None
+        try:
+            update = {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+            if tenant_id:
+                update["$set"]["tenant_id"] = tenant_id
+            doc = db.desk_versions.find_one_and_update(
+                {"_id": cash_desk_id},
+                update,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return doc["version"]
+        except Exception as e:
+            print(f"❌ Failed to bump version of desk {cash_desk_id}: {e}")
+            return None
+
+    @staticmethod
+    def advance(cash_desk_id: str, expected: Optional[int] = None, tenant_id: Optional[str] = None, session=None) -> int:
+        """
+        Увеличивает версию кассы внутри транзакции записи. Ошибки не подавляются -
+        они отменяют транзакцию вместе с остальными изменениями
+
+        Args:
+            expected: Версия, по которой посчитана запись (None - без проверки)
+
+        Returns:
+            Новая версия
+
+        Raises:
+            DeskVersionConflict: Версия кассы уже не равна expected
+        """
+        filter_criteria = {"_id": cash_desk_id}
+        if expected is not None:
+            filter_criteria["version"] = expected
+        update = {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+        if tenant_id:
+            update["$set"]["tenant_id"] = tenant_id
+        try:
+            # Документа версии может ещё не быть только у кассы с версией 0
+            doc = db.desk_versions.find_one_and_update(
+                filter_criteria,
+                update,
+                upsert=expected in (None, 0),
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+        except DuplicateKeyError:
+            doc = None
+        if not doc:
+            raise DeskVersionConflict(f"Cash desk {cash_desk_id} was changed concurrently")
+        return doc["version"]
+
+    @staticmethod
+    def advance_tenant(tenant_id: str, session=None) -> int:
+        """
+        Увеличивает версии всех касс tenant'а внутри транзакции записи (без проверки версии)
+
+        Returns:
+            Количество касс, версии которых изменены
+        """
+        desk_ids = {desk["_id"] for desk in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1}, session=session)}
+        desk_ids |= {doc["_id"] for doc in db.desk_versions.find({"tenant_id": tenant_id}, {"_id": 1}, session=session)}
+        for cash_desk_id in desk_ids:
+            DeskVersionManager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+        return len(desk_ids)
+
+    @staticmethod
+    def bump_tenant(tenant_id: str) -> int:
+        """
+        Увеличивает версии всех касс tenant'а (после сброса данных tenant'а)
+
+        Returns:
+            Количество касс, версии которых изменены
+        """
+        desk_ids = {desk["_id"] for desk in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1})}
+        desk_ids |= {doc["_id"] for doc in db.desk_versions.find({"tenant_id": tenant_id}, {"_id": 1})}
+        for cash_desk_id in desk_ids:
+            DeskVersionManager.bump(cash_desk_id, tenant_id)
+        return len(desk_ids)
+
+
+    @staticmethod
+    def clear(tenant_id: str) -> int:
+        """
+        Удаляет счётчики версий касс tenant'а (при удалении tenant'а).
+        Документы, созданные без tenant_id, находятся по кассам tenant'а
+
+        Returns:
+            Количество удалённых счётчиков
+        """
+        desk_ids = [desk["_id"] for desk in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1})]
+        result = db.desk_versions.delete_many({"$or": [{"tenant_id": tenant_id}, {"_id": {"$in": desk_ids}}]})
+        return result.deleted_count
+
+
+# Глобальный экземпляр
+desk_version_manager = DeskVersionManager()
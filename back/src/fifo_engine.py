@@ -0,0 +1,425 @@
+"""
+FIFO-движок фиатных лотов
+
+Расчёт обмена поверх книги открытых лотов в памяти (LotBook): списание лотов,
+новые лоты, матчи PnL, реализованная прибыль и движения кассы.
+Движок не пишет в базу - результат сохраняет вызывающий код
+(create_transaction или пересборка кассы в replay).
+"""
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from .db import db
+from .constants import FIAT_ASSETS
+from .utils.money import (
+    to_units, from_units, div_round, quantize_work,
+    AMOUNT_SCALE, RATE_SCALE, WORK_SCALE, AMOUNT_TO_WORK
+)
+
+EXCHANGE_TYPES = ["fiat_to_crypto", "crypto_to_fiat", "fiat_to_fiat"]
+
+
+# Точность сравнения сумм: одна единица 1e-7
+EPS_UNITS = 1
+
+
+def _lot_order(lot: dict):
+    """Порядок FIFO: время создания, при равенстве - _id"""
+    return (lot["created_at"], str(lot["_id"]))
+
+
+class LotBook:
+    """
+    Открытые лоты кассы в памяти: очередь FIFO на каждую пару (валюта, источник).
+    Лоты списываются только с головы очереди, поэтому исчерпанные лоты
+    пропускаются сдвигом указателя, без поиска по всей книге
+    """
+
+    def __init__(self, lots: Optional[List[dict]] = None):
+        self._queues: Dict[tuple, List[dict]] = {}
+        self._heads: Dict[tuple, int] = {}
+        for lot in sorted(lots or [], key=_lot_order):
+            self.add(lot)
+
+    def add(self, lot: dict):
+        """Добавляет лот в очередь его валюты и источника"""
+        key = (lot["currency"], (lot.get("meta") or {}).get("source"))
+        queue = self._queues.setdefault(key, [])
+        self._heads.setdefault(key, 0)
+        queue.append(lot)
+        if len(queue) > 1 and _lot_order(queue[-2]) > _lot_order(lot):
+            # Лот старше уже поставленных - пересортировываем необработанную часть очереди
+            head = self._heads[key]
+            queue[head:] = sorted(queue[head:], key=_lot_order)
+
+    def _head(self, key: tuple) -> Optional[dict]:
+        queue = self._queues[key]
+        head = self._heads[key]
+        while head < len(queue) and queue[head]["remaining"] <= 0:
+            head += 1
+        self._heads[key] = head
+        return queue[head] if head < len(queue) else None
+
+    def next_open(self, currency: str, source: Optional[str] = None) -> Optional[dict]:
+        """Самый старый открытый лот валюты (опционально - только указанного источника)"""
+        best = None
+        for key in self._queues:
+            if key[0] != currency or (source is not None and key[1] != source):
+                continue
+            lot = self._head(key)
+            if lot and (best is None or _lot_order(lot) < _lot_order(best)):
+                best = lot
+        return best
+
+    def open_lots(self, currency: Optional[str] = None) -> List[dict]:
+        """Открытые лоты книги (опционально одной валюты) в порядке FIFO"""
+        lots = [
+            lot
+            for key, queue in self._queues.items()
+            if currency is None or key[0] == currency
+            for lot in queue[self._heads[key]:]
+            if lot["remaining"] > 0
+        ]
+        return sorted(lots, key=_lot_order)
+
+    def compact(self):
+        """Отбрасывает исчерпанные лоты из голов очередей (для книг, живущих между запросами)"""
+        for key, queue in self._queues.items():
+            self._head(key)
+            head = self._heads[key]
+            if head:
+                del queue[:head]
+                self._heads[key] = 0
+
+
+class FifoEngine:
+    """Расчёт обменов по FIFO без обращения к базе"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Открытые лоты кассы по валюте в порядке FIFO; лоты и матчи по транзакции"""
+        db.fiat_lots.create_index([("cash_desk_id", 1), ("currency", 1), ("created_at", 1), ("_id", 1)])
+        db.fiat_lots.create_index([("tx_id", 1)])
+        db.pnl_matches.create_index([("close_tx_id", 1)])
+
+    @staticmethod
+    def lot_demand(tx: dict) -> Optional[tuple]:
+        """
+        Сколько фиата обмен спишет с лотов
+
+        Returns:
+            (валюта, количество) или None, если обмен лоты не списывает
+        """
+        if tx["type"] == "crypto_to_fiat" and tx["from_asset"] == "USDT" and tx["to_asset"] in FIAT_ASSETS:
+            return tx["to_asset"], tx["amount_to_final"]
+        if tx["type"] == "fiat_to_fiat" and tx["from_asset"] in FIAT_ASSETS:
+            return tx["from_asset"], tx["amount_from"]
+        return None
+
+    @staticmethod
+    def load_covering(cash_desk_id: str, needs: Dict[str, float]) -> LotBook:
+        """
+        Загружает только лоты, которые могут понадобиться для списания needs[валюта].
+
+        Накопленный остаток считается на стороне MongoDB ($setWindowFields) отдельно
+        для каждой пары (валюта, источник) в порядке FIFO; лот попадает в выборку,
+        пока сумма остатков лотов перед ним меньше потребности. Списание по любому
+        этапу FIFO берёт префикс очереди источника не больше потребности, поэтому
+        выборки хватает, а её размер зависит от суммы обмена, а не от размера склада
+        """
+        needs = {currency: float(need) for currency, need in needs.items() if currency and need and need > 0}
+        if not needs:
+            return LotBook()
+
+        cutoff = {
+            "$or": [
+                {"$and": [
+                    {"$eq": ["$currency", currency]},
+                    {"$lt": [{"$subtract": ["$_cumulative", "$remaining"]}, need]}
+                ]}
+                for currency, need in needs.items()
+            ]
+        }
+        pipeline = [
+            {"$match": {
+                "cash_desk_id": cash_desk_id,
+                "currency": {"$in": list(needs)},
+                "remaining": {"$gt": 0}
+            }},
+            {"$setWindowFields": {
+                "partitionBy": {"currency": "$currency", "source": "$meta.source"},
+                "sortBy": {"created_at": 1, "_id": 1},
+                "output": {
+                    "_cumulative": {"$sum": "$remaining", "window": {"documents": ["unbounded", "current"]}}
+                }
+            }},
+            {"$match": {"$expr": cutoff}},
+            {"$unset": "_cumulative"}
+        ]
+        try:
+            return LotBook(list(db.fiat_lots.aggregate(pipeline)))
+        except OperationFailure as e:
+            # $setWindowFields появился в MongoDB 5.0 - на старых серверах грузим все открытые лоты
+            print(f"⚠️ Cumulative lot query failed, loading full lot book: {e}")
+            return FifoEngine.load_book(cash_desk_id, list(needs))
+
+    @staticmethod
+    def load_book(cash_desk_id: str, currencies: Optional[List[str]] = None) -> LotBook:
+        """Загружает открытые лоты кассы одним запросом: по нужным валютам или все (currencies=None)"""
+        filter_criteria = {"cash_desk_id": cash_desk_id, "remaining": {"$gt": 0}}
+        if currencies is not None:
+            if not currencies:
+                return LotBook()
+            filter_criteria["currency"] = {"$in": list(currencies)}
+        return LotBook(list(db.fiat_lots.find(filter_criteria)))
+
+    @staticmethod
+    def _consume(book: LotBook, lot: dict, lot_rem: int, take: int, result: Dict[str, Any]) -> int:
+        """Списывает take (единицы суммы) из лота книги и фиксирует исходную версию лота"""
+        new_rem = lot_rem - take
+        result["consumed"].append({"lot": dict(lot), "take": from_units(take), "remaining": from_units(new_rem)})
+        lot["remaining"] = from_units(new_rem)
+        return new_rem
+
+    @staticmethod
+    def apply(tx: dict, book: LotBook, now: datetime, new_id: Callable = ObjectId) -> Dict[str, Any]:
+        """
+        Применяет обмен к книге лотов: списывает лоты, добавляет новые и считает прибыль.
+        Расчёт ведётся в масштабированных целых (utils.money), в float переводится только результат
+
+        Args:
+            tx: Данные обмена (type, from_asset, to_asset, amount_from, amount_to_final, fee_percent,
+                tenant_id, cash_desk_id; для fiat_to_fiat - заданная себестоимость, если есть).
+                _id транзакции, выделенный до записи, проставляется в tx_id лотов и close_tx_id матчей
+            book: Книга открытых лотов кассы (изменяется на месте)
+            now: Время создания новых лотов и матчей
+            new_id: Генератор _id для новых документов
+
+        Returns:
+            {consumed, new_lots, matches, cash_deltas, realized_profit, realized_profit_usdt,
+             profit_currency, cost_usdt_of_fiat_in, rate_usdt_of_fiat_in}
+        """
+        tx_type = tx["type"]
+        from_asset = tx["from_asset"]
+        to_asset = tx["to_asset"]
+        tenant_id = tx.get("tenant_id")
+        cash_desk_id = tx.get("cash_desk_id")
+        tx_id = str(tx["_id"]) if tx.get("_id") else None
+
+        result = {
+            "consumed": [],
+            "new_lots": [],
+            "matches": [],
+            "cash_deltas": [],
+            "realized_profit": 0.0,
+            "realized_profit_usdt": 0.0,
+            "profit_currency": None,
+            "cost_usdt_of_fiat_in": tx.get("cost_usdt_of_fiat_in"),
+            "rate_usdt_of_fiat_in": tx.get("rate_usdt_of_fiat_in")
+        }
+
+        if tx_type == "crypto_to_fiat":
+            result["profit_currency"] = to_asset  # клиент получает фиат → прибыль в нём
+        elif tx_type == "fiat_to_crypto":
+            result["profit_currency"] = from_asset  # клиент платит фиат → прибыль в нём
+        elif tx_type == "fiat_to_fiat":
+            result["profit_currency"] = "USDT"  # PnL от fiat_to_fiat считается в USDT
+
+        def new_lot(currency: str, remaining: int, rate: float, meta: dict) -> dict:
+            lot = {
+                "_id": new_id(),
+                "tenant_id": tenant_id,
+                "cash_desk_id": cash_desk_id,
+                "currency": currency,
+                "remaining": from_units(remaining),
+                "rate": rate,
+                "tx_id": tx_id,
+                "created_at": now,
+                "meta": meta
+            }
+            book.add(lot)
+            result["new_lots"].append(lot)
+            return lot
+
+        def add_match(fields: dict):
+            match = {
+                "_id": new_id(),
+                "tenant_id": tenant_id,
+                "cash_desk_id": cash_desk_id,
+                "close_tx_id": tx_id,
+                **fields,
+                "created_at": now
+            }
+            result["matches"].append(match)
+
+        if tx_type == "fiat_to_crypto":
+            # Клиент отдаёт фиат, получает крипту
+            result["cash_deltas"] = [(to_asset, -tx["amount_to_final"]), (from_asset, tx["amount_from"])]
+
+            # Лот фиата (этот кэш позже "сгорит" при покупках USDT за этот же фиат)
+            fiat_in_fact = to_units(tx["amount_from"])       # фактический приток фиата в кассу
+            usdt_out_fact = to_units(tx["amount_to_final"])  # фактическая выдача USDT клиенту
+            if usdt_out_fact != 0:
+                # Эффективный курс покупки = полученный фиат / выданный USDT
+                new_lot(from_asset, fiat_in_fact, fiat_in_fact / usdt_out_fact, {
+                    "source": "fiat_to_crypto",
+                    "fee_percent": float(tx.get("fee_percent") or 0.0)
+                })
+
+        elif tx_type == "fiat_to_fiat" and from_asset in FIAT_ASSETS:
+            # FIFO расчет себестоимости to_asset в USDT.
+            # PnL не рассчитывается - он появится при продаже to_asset через crypto_to_fiat
+            need = to_units(tx["amount_from"])           # сколько фиата отдали
+            to_fiat_in = to_units(tx["amount_to_final"])  # сколько фиата получили
+            cost_usdt_work = 0                            # себестоимость в рабочих единицах
+
+            while need > EPS_UNITS:
+                lot = book.next_open(from_asset)
+                if not lot:
+                    print(f"WARNING: No {from_asset} lots available for FIFO calculation in fiat_to_fiat")
+                    break
+
+                lot_rem = to_units(lot["remaining"])
+                lot_rate = to_units(lot["rate"], RATE_SCALE)  # курс FIAT/USDT при исходной покупке
+                take = lot_rem if lot_rem <= need else need
+                # USDT-эквивалент этого куска: take / lot_rate
+                cost_usdt_work += div_round(take * RATE_SCALE * AMOUNT_TO_WORK, lot_rate)
+                FifoEngine._consume(book, lot, lot_rem, take, result)
+                need -= take
+
+            if cost_usdt_work > EPS_UNITS * AMOUNT_TO_WORK:
+                result["cost_usdt_of_fiat_in"] = quantize_work(cost_usdt_work, 4)
+                # Курс себестоимости = полученный фиат / себестоимость в USDT
+                result["rate_usdt_of_fiat_in"] = from_units(
+                    div_round(to_fiat_in * AMOUNT_TO_WORK * 10 ** 4, cost_usdt_work), 10 ** 4
+                )
+
+            result["cash_deltas"] = [(from_asset, -tx["amount_from"]), (to_asset, tx["amount_to_final"])]
+
+        elif tx_type == "crypto_to_fiat":
+            # Касса обновляется и без FIFO (например, для не-USDT пар)
+            result["cash_deltas"] = [(to_asset, -tx["amount_to_final"]), (from_asset, tx["amount_from"])]
+
+            if from_asset == "USDT" and to_asset in FIAT_ASSETS:
+                # Двухэтапная логика FIFO по фиатным лотам
+                fiat_out_fact = to_units(tx["amount_to_final"])  # сколько фиата реально отдали клиенту
+                usdt_in_fact = to_units(tx["amount_from"])       # сколько USDT получили от клиента
+                if usdt_in_fact == 0:
+                    raise ZeroDivisionError("amount_from (USDT) is zero")
+
+                # Эффективный курс = фактически выданный фиат / полученный USDT (точная дробь)
+                sell_rate_eff = fiat_out_fact / usdt_in_fact
+
+                def matched_usdt(take: int) -> float:
+                    # take / sell_rate_eff
+                    return (take * usdt_in_fact) / (fiat_out_fact * AMOUNT_SCALE)
+
+                pnl_fiat_work = 0
+                pnl_usdt_work = 0
+                need = fiat_out_fact
+
+                # ЭТАП 1: живые лоты (fiat_to_crypto), прибыль считается в фиате
+                while need > EPS_UNITS:
+                    lot = book.next_open(to_asset, "fiat_to_crypto")
+                    if not lot:
+                        break
+
+                    lot_rem = to_units(lot["remaining"])
+                    lot_rate = to_units(lot["rate"], RATE_SCALE)
+                    take = lot_rem if lot_rem <= need else need
+
+                    # (lot_rate - sell_rate) · take / sell_rate, затем / sell_rate для USDT
+                    spread = take * (lot_rate * usdt_in_fact - fiat_out_fact * RATE_SCALE)
+                    pnl_piece_fiat = div_round(spread * AMOUNT_TO_WORK, RATE_SCALE * fiat_out_fact)
+                    pnl_piece_usdt = div_round(spread * usdt_in_fact * AMOUNT_TO_WORK, RATE_SCALE * fiat_out_fact * fiat_out_fact)
+                    pnl_fiat_work += pnl_piece_fiat
+                    pnl_usdt_work += pnl_piece_usdt
+
+                    FifoEngine._consume(book, lot, lot_rem, take, result)
+                    add_match({
+                        "currency": to_asset,
+                        "open_lot_id": str(lot["_id"]),
+                        "stage": 1,  # этап 1 - живые лоты
+                        "fiat_used": from_units(take),
+                        "matched_usdt": matched_usdt(take),
+                        "lot_rate": float(lot["rate"]),
+                        "sell_rate_eff": sell_rate_eff,
+                        "pnl_fiat": from_units(pnl_piece_fiat, WORK_SCALE),
+                        "pnl_usdt": from_units(pnl_piece_usdt, WORK_SCALE)
+                    })
+                    need -= take
+
+                # ЭТАП 2: лоты fiat_to_fiat (обменные пункты), прибыль считается в USDT
+                while need > EPS_UNITS:
+                    lot = book.next_open(to_asset, "fiat_to_fiat")
+                    if not lot:
+                        break
+
+                    lot_rem = to_units(lot["remaining"])
+                    if lot_rem <= 0:
+                        # Остаток меньше точности суммы - лот просто закрывается
+                        FifoEngine._consume(book, lot, lot_rem, lot_rem, result)
+                        continue
+                    # Себестоимость из метаданных относится к ОСТАТКУ лота
+                    cost_usdt_total_lot = to_units(lot["meta"].get("cost_usdt_of_fiat_in", 0))
+
+                    take = lot_rem if lot_rem <= need else need
+                    # matched_usdt - себестоимость доли остатка (take / lot_rem)
+                    pnl_piece_usdt = (
+                        div_round(take * usdt_in_fact * AMOUNT_TO_WORK, fiat_out_fact)
+                        - div_round(cost_usdt_total_lot * take * AMOUNT_TO_WORK, lot_rem)
+                    )
+                    pnl_piece_fiat = div_round(pnl_piece_usdt * fiat_out_fact, usdt_in_fact)
+                    pnl_usdt_work += pnl_piece_usdt
+                    pnl_fiat_work += pnl_piece_fiat
+
+                    FifoEngine._consume(book, lot, lot_rem, take, result)
+                    add_match({
+                        "currency": to_asset,
+                        "open_lot_id": str(lot["_id"]),
+                        "stage": 2,  # этап 2 - обменные пункты
+                        "fiat_used": from_units(take),
+                        "matched_usdt": matched_usdt(take),
+                        # take / себестоимость доли = lot_rem / себестоимость остатка
+                        "lot_rate": lot_rem / cost_usdt_total_lot if cost_usdt_total_lot > 0 and take > 0 else 0,
+                        "sell_rate_eff": sell_rate_eff,
+                        "pnl_fiat": from_units(pnl_piece_fiat, WORK_SCALE),
+                        "pnl_usdt": from_units(pnl_piece_usdt, WORK_SCALE),
+                        "cost_usdt_of_fiat_in": from_units(cost_usdt_total_lot)
+                    })
+                    need -= take
+
+                # ЭТАП 3: остаток покрывается из депозитов (без PnL)
+                if need > EPS_UNITS:
+                    add_match({
+                        "currency": to_asset,
+                        "open_lot_id": "deposit",
+                        "stage": 3,  # этап 3 - депозиты
+                        "fiat_used": from_units(need),
+                        "matched_usdt": matched_usdt(need),
+                        "lot_rate": sell_rate_eff,  # себестоимость равна курсу продажи
+                        "sell_rate_eff": sell_rate_eff,
+                        "pnl_fiat": 0.0,
+                        "pnl_usdt": 0.0
+                    })
+
+                result["realized_profit"] = quantize_work(pnl_fiat_work, 2)
+                result["realized_profit_usdt"] = quantize_work(pnl_usdt_work, 4)
+
+        # Для fiat_to_fiat: лот to_asset с себестоимостью в USDT - его спишет crypto_to_fiat
+        cost_usdt = result["cost_usdt_of_fiat_in"]
+        if tx_type == "fiat_to_fiat" and cost_usdt and cost_usdt > 0:
+            fiat_in_fact_to = to_units(tx["amount_to_final"])
+            rate_usdt = result["rate_usdt_of_fiat_in"]
+            new_lot(to_asset, fiat_in_fact_to, fiat_in_fact_to / to_units(cost_usdt), {
+                "source": "fiat_to_fiat",
+                "cost_usdt_of_fiat_in": float(cost_usdt),
+                "rate_usdt_of_fiat_in": float(rate_usdt) if rate_usdt is not None else None
+            })
+
+        return result
+
+
+# Глобальный экземпляр
+fifo_engine = FifoEngine()
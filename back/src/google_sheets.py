@@ -12,6 +12,7 @@ from .constants import (
     GOOGLE_SHEETS_CREDENTIALS_PATH
 )
 from .db import db
+from .desk_stats import desk_stats_manager
 
 class GoogleSheetsManager:
     """Менеджер для работы с Google Sheets с поддержкой множественных таблиц"""
@@ -202,6 +203,15 @@ class GoogleSheetsManager:
         (ПЕРЕРАБОТАНО)
         Добавляет транзакцию в лист, специфичный для кассы (f"Транзакции_{cash_desk_name}").
         """
+        self.add_transactions([transaction_data], tenant_id=tenant_id, cash_desk_id=cash_desk_id)
+
+    def add_transactions(self, transactions: List[dict], tenant_id: str = None, cash_desk_id: str = None):
+        """
+        Добавляет пачку транзакций в лист кассы одним запросом и один раз
+        обновляет балансы, прибыль и сводный отчёт
+        """
+        if not transactions:
+            return
         if not tenant_id or not self.is_enabled_for_tenant(tenant_id):
             return
         
@@ -231,10 +241,10 @@ class GoogleSheetsManager:
             # 1. Находим или создаем лист ТРАНЗАКЦИЙ
             tx_sheet_name = f"Транзакции_{cash_desk_name}"
             worksheet = self._get_or_create_cash_desk_sheet(spreadsheet, tx_sheet_name, "transactions")
-            # 2. Добавляем транзакцию
-            row_data = self._format_transaction_row_simple(transaction_data)
-            worksheet.append_row(row_data, value_input_option='RAW')
-            print(f"✅ Transaction added to Google Sheet '{tx_sheet_name}'")
+            # 2. Добавляем транзакции
+            rows = [self._format_transaction_row_simple(transaction_data) for transaction_data in transactions]
+            worksheet.append_rows(rows, value_input_option='RAW')
+            print(f"✅ {len(rows)} transaction(s) added to Google Sheet '{tx_sheet_name}'")
 
             # 3. Обновляем состояние кассы (балансы и прибыль)
             # Получаем актуальные балансы и прибыли из базы
@@ -246,12 +256,7 @@ class GoogleSheetsManager:
                     cash_desk_name = cash_desk["name"]
                     cash_items = list(db.cash.find({"cash_desk_id": cash_desk_id}))
                     cash_status = {item["asset"]: item["balance"] for item in cash_items}
-                    pipeline = [
-                        {"$match": {"cash_desk_id": cash_desk_id, "profit_currency": {"$ne": None}}},
-                        {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-                    ]
-                    profit_results = list(db.transactions.aggregate(pipeline))
-                    realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+                    realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
                     # Обновляем балансы
                     for currency, balance in cash_status.items():
                         self.update_balance_for_desk(cash_desk_name, currency, balance, tenant_id)
@@ -508,12 +513,7 @@ class GoogleSheetsManager:
             cash_items = list(db.cash.find({"cash_desk_id": cash_desk_id}))
             cash_status = {item["asset"]: item["balance"] for item in cash_items}
             # Прибыль
-            pipeline = [
-                {"$match": {"cash_desk_id": cash_desk_id, "profit_currency": {"$ne": None}}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results}
+            realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
             # Транзакции
             transactions = list(db.transactions.find({"cash_desk_id": cash_desk_id}))
             # Создать/очистить листы и записать данные
@@ -566,14 +566,8 @@ class GoogleSheetsManager:
                 transactions = list(db.transactions.find({"cash_desk_id": cash_desk_id_str}))
                 cash_items = list(db.cash.find({"cash_desk_id": cash_desk_id_str}))
                 
-                pipeline = [
-                    {"$match": {"cash_desk_id": cash_desk_id_str, "profit_currency": {"$ne": None}}},
-                    {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-                ]
-                profit_results = list(db.transactions.aggregate(pipeline))
-                
                 cash_status = {item["asset"]: item["balance"] for item in cash_items}
-                realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+                realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id_str, tenant_id=tenant_id)
 
                 # 4. Обновляем лист ТРАНЗАКЦИЙ (полная перезапись)
                 tx_sheet_name = f"Транзакции_{cash_desk_name}"
@@ -793,14 +787,8 @@ class GoogleSheetsManager:
             transactions = list(db.transactions.find({"cash_desk_id": cash_desk_id}))
             cash_items = list(db.cash.find({"cash_desk_id": cash_desk_id}))
             
-            pipeline = [
-                {"$match": {"cash_desk_id": cash_desk_id, "profit_currency": {"$ne": None}}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            
             cash_status = {item["asset"]: item["balance"] for item in cash_items}
-            realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results}
+            realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
 
             # 3. Открываем таблицу
             spreadsheet = self.client.open_by_key(settings["spreadsheet_id"])
@@ -2,8 +2,48 @@
 Модуль для управления историей изменений через снимки состояния
 """
 from datetime import datetime
-from typing import Optional, Dict, Any
-from .db import db
+from typing import Optional, Dict, Any, List
+import zlib
+import bson
+from bson import ObjectId
+from pymongo import ReplaceOne, DeleteOne
+from pymongo.errors import OperationFailure
+from .db import db, client
+from .constants import SNAPSHOT_COMPRESSION, SNAPSHOT_TTL_DAYS
+from .lot_archive import lot_archive_manager
+from .desk_stats import desk_stats_manager
+from .daily_rollups import rollup_manager
+from .desk_versions import desk_version_manager
+from .money_storage import money_storage
+
+JOURNAL_COLLECTIONS = ["transactions", "cash", "fiat_lots", "pnl_matches", "pnl_match_buckets"]
+
+BSON_DOCUMENT_LIMIT = 16 * 1024 * 1024  # Лимит размера документа MongoDB
+INLINE_PAYLOAD_LIMIT = 1024 * 1024      # Больше - журнал уходит в history_snapshot_chunks
+CHUNK_SIZE = 255 * 1024                 # Размер одного чанка (как в GridFS)
+SNAPSHOT_ALERT_BYTES = BSON_DOCUMENT_LIMIT // 2  # Предупреждение о крупном снимке
+DESK_ALERT_BYTES = 64 * 1024 * 1024     # Предупреждение о суммарном объёме снимков кассы
+ZLIB_LEVEL = 6
+ILLEGAL_OPERATION_CODE = 20  # Транзакции недоступны (standalone-сервер)
+REDO_SEGMENT = -1            # Номер части с образом состояния для повтора
+
+# Поля снимка без журнала - для списков и проверок без передачи тела снимка
+SNAPSHOT_METADATA_FIELDS = {
+    "_id": 1,
+    "timestamp": 1,
+    "operation_type": 1,
+    "description": 1,
+    "tenant_id": 1,
+    "cash_desk_id": 1,
+    "format": 1,
+    "compression": 1,
+    "payload_storage": 1,
+    "payload_size": 1,
+    "stored_size": 1,
+    "chunk_count": 1,
+    "undone": 1,
+    "undone_at": 1
+}
 
 
 class HistoryManager:
@@ -12,15 +52,179 @@ class HistoryManager:
     MAX_SNAPSHOTS = 50  # Максимальное количество хранимых снимков
     
     @staticmethod
-    def save_snapshot(operation_type: str, description: str = "", tenant_id: str = None, cash_desk_id: str = None) -> str:
+    def ensure_indexes():
+        """Индексы снимков и чанков их журналов, TTL-индексы при заданном SNAPSHOT_TTL_DAYS"""
+        db.history_snapshots.create_index([("tenant_id", 1), ("cash_desk_id", 1), ("timestamp", -1)])
+        db.history_snapshot_chunks.create_index(
+            [("snapshot_id", 1), ("segment", 1), ("n", 1)],
+            unique=True
+        )
+        db.history_snapshot_chunks.create_index([("tenant_id", 1), ("cash_desk_id", 1)])
+        
+        if SNAPSHOT_TTL_DAYS > 0:
+            ttl_seconds = SNAPSHOT_TTL_DAYS * 24 * 3600
+            HistoryManager._ensure_ttl_index("history_snapshots", "timestamp", ttl_seconds)
+            HistoryManager._ensure_ttl_index("history_snapshot_chunks", "created_at", ttl_seconds)
+    
+    @staticmethod
+    def _ensure_ttl_index(collection: str, field: str, ttl_seconds: int):
+        """Создаёт TTL-индекс или обновляет срок у существующего"""
+        try:
+            db[collection].create_index([(field, 1)], expireAfterSeconds=ttl_seconds)
+        except OperationFailure:
+            db.command("collMod", collection, index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl_seconds})
+    
+    @staticmethod
+    def _encode_payload(payload: dict, compression: Optional[str]) -> bytes:
+        """BSON журнала, при включённом сжатии - zlib поверх BSON"""
+        data = bson.encode(payload)
+        if compression == "zlib":
+            data = zlib.compress(data, ZLIB_LEVEL)
+        return data
+    
+    @staticmethod
+    def _decode_payload(data: bytes, compression: Optional[str]) -> dict:
+        if compression == "zlib":
+            data = zlib.decompress(data)
+        return bson.decode(data)
+    
+    @staticmethod
+    def _write_segment(snapshot: dict, data: bytes, segment: int, kind: str = "journal", session=None) -> int:
+        """
+        Записывает часть журнала снимка (закодированную) в history_snapshot_chunks
+        
+        Args:
+            kind: "journal" - журнал операции, "redo" - образ состояния для повтора
+        
+        Returns:
+            Количество записанных чанков
+        """
+        created_at = datetime.utcnow()
+        chunks = (
+            {
+                "snapshot_id": snapshot["_id"],
+                "tenant_id": snapshot["tenant_id"],
+                "cash_desk_id": snapshot.get("cash_desk_id"),
+                "kind": kind,
+                "segment": segment,
+                "n": n,
+                "created_at": created_at,
+                "data": bson.Binary(data[offset:offset + CHUNK_SIZE])
+            }
+            for n, offset in enumerate(range(0, len(data), CHUNK_SIZE))
+        )
+        count = 0
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= 16:
+                db.history_snapshot_chunks.insert_many(batch, session=session)
+                count += len(batch)
+                batch = []
+        if batch:
+            db.history_snapshot_chunks.insert_many(batch, session=session)
+            count += len(batch)
+        return count
+    
+    @staticmethod
+    def _read_segments(snapshot: dict, kind: str = "journal") -> List[dict]:
+        """Читает части журнала (или образа для повтора) из чанков - потоково, по порядку записи"""
+        compression = snapshot.get("compression")
+        segments = []
+        current, buffer = None, bytearray()
+        # Чанки без kind записаны до появления redo и относятся к журналу
+        kind_filter = {"kind": "redo"} if kind == "redo" else {"kind": {"$ne": "redo"}}
+        cursor = db.history_snapshot_chunks.find(
+            {"snapshot_id": snapshot["_id"], **kind_filter},
+            {"segment": 1, "data": 1}
+        ).sort([("segment", 1), ("n", 1)])
+        for chunk in cursor:
+            if current is not None and chunk["segment"] != current:
+                segments.append(HistoryManager._decode_payload(bytes(buffer), compression))
+                buffer = bytearray()
+            current = chunk["segment"]
+            buffer.extend(chunk["data"])
+        if current is not None:
+            segments.append(HistoryManager._decode_payload(bytes(buffer), compression))
+        return segments
+    
+    @staticmethod
+    def _load_payload(snapshot: dict) -> dict:
+        """
+        Собирает журнал снимка в порядке записи: несжатая встроенная часть,
+        сжатые встроенные части, затем части из чанков. Распаковка - только здесь, при восстановлении
+        """
+        payload = {
+            "before": {k: list(v) for k, v in (snapshot.get("before") or {}).items()},
+            "inserted": {k: list(v) for k, v in (snapshot.get("inserted") or {}).items()}
+        }
+        segments = [
+            HistoryManager._decode_payload(bytes(blob), snapshot.get("compression"))
+            for blob in snapshot.get("payload_segments") or []
+        ]
+        if snapshot.get("payload_storage") == "chunks":
+            segments.extend(HistoryManager._read_segments(snapshot))
+        for segment in segments:
+            for key in ("before", "inserted"):
+                for collection, items in (segment.get(key) or {}).items():
+                    payload[key].setdefault(collection, []).extend(items)
+        return payload
+    
+    @staticmethod
+    def _delete_chunks(snapshot_ids: list, kind: Optional[str] = None, session=None):
+        if snapshot_ids:
+            filter_criteria = {"snapshot_id": {"$in": snapshot_ids}}
+            if kind:
+                filter_criteria["kind"] = kind
+            db.history_snapshot_chunks.delete_many(filter_criteria, session=session)
+    
+    @staticmethod
+    def _check_limits(tenant_id: str, cash_desk_id: Optional[str], payload_size: int):
+        """Предупреждает, если снимок или суммарный объём снимков кассы близки к лимитам"""
+        cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+        if payload_size >= SNAPSHOT_ALERT_BYTES:
+            print(f"⚠️ Snapshot payload of {payload_size} bytes for tenant {tenant_id}{cash_desc} "
+                  f"is close to the {BSON_DOCUMENT_LIMIT} bytes document limit")
+        
+        metrics = HistoryManager.get_snapshot_metrics(tenant_id, cash_desk_id)
+        if metrics["total_stored_size"] >= DESK_ALERT_BYTES:
+            print(f"⚠️ Snapshots for tenant {tenant_id}{cash_desc} take {metrics['total_stored_size']} bytes "
+                  f"({metrics['snapshots_count']} snapshots, {metrics['chunked_count']} chunked)")
+    
+    @staticmethod
+    def cash_images(tenant_id: str, cash_desk_id: Optional[str], assets: List[str], session=None) -> list:
+        """Текущие строки кассы по активам - before-image для снимка"""
+        cash_filter = {"tenant_id": tenant_id, "asset": {"$in": sorted(set(assets))}}
+        if cash_desk_id:
+            cash_filter["cash_desk_id"] = cash_desk_id
+        return list(db.cash.find(cash_filter, session=session))
+    
+    @staticmethod
+    def save_snapshot(
+        operation_type: str,
+        description: str = "",
+        tenant_id: str = None,
+        cash_desk_id: str = None,
+        cash_assets: Optional[List[str]] = None,
+        before: Optional[Dict[str, list]] = None
+    ) -> str:
         """
-        Сохраняет снимок текущего состояния перед операцией (для конкретного tenant и кассы)
+        Сохраняет снимок перед операцией (для конкретного tenant и кассы)
+        
+        Снимок - журнал before-image: хранит только документы, которые операция затронет.
+        Строки кассы по cash_assets снимаются сразу (если их версии не переданы в before),
+        остальные изменения (списанные лоты, вставленные документы) дописываются через
+        record_changes по ходу операции.
         
         Args:
             operation_type: Тип операции (create_transaction, delete_transaction, deposit, withdrawal, etc.)
             description: Описание операции для удобства
             tenant_id: ID tenant'а для изоляции снимков
             cash_desk_id: ID кассы для изоляции по кассе
+            cash_assets: Активы кассы, балансы которых изменит операция
+            before: Исходные версии документов, известные до операции {коллекция: [документы]}.
+                Операция, уже записанная в транзакции MongoDB, передаёт строки кассы,
+                прочитанные в этой транзакции (cash_images)
             
         Returns:
             ID созданного снимка
@@ -29,13 +233,23 @@ class HistoryManager:
             if not tenant_id:
                 raise ValueError("tenant_id is required for snapshot creation")
             
-            # Собираем текущее состояние всех критичных коллекций (для конкретного tenant и кассы)
-            tenant_filter = {"tenant_id": tenant_id}
-            cash_desk_filter = {"tenant_id": tenant_id}
-            
-            # Если указан cash_desk_id, фильтруем по нему
-            if cash_desk_id:
-                cash_desk_filter["cash_desk_id"] = cash_desk_id
+            assets = sorted({asset for asset in (cash_assets or []) if asset})
+            before_images = {collection: list(docs) for collection, docs in (before or {}).items() if docs}
+            if assets and "cash" not in (before or {}):
+                before_images["cash"] = HistoryManager.cash_images(tenant_id, cash_desk_id, assets)
+            
+            payload = {"before": before_images, "inserted": {}}
+            compression = SNAPSHOT_COMPRESSION if SNAPSHOT_COMPRESSION == "zlib" else None
+            payload_size = len(bson.encode(payload))
+            data = HistoryManager._encode_payload(payload, compression)
+            
+            # Крупный журнал пишем чанками, чтобы не упереться в лимит документа
+            if len(data) > INLINE_PAYLOAD_LIMIT:
+                storage = "chunks"
+            elif compression:
+                storage = "compressed"
+            else:
+                storage = "inline"
             
             snapshot = {
                 "timestamp": datetime.utcnow(),
@@ -43,23 +257,33 @@ class HistoryManager:
                 "description": description,
                 "tenant_id": tenant_id,  # Привязываем снимок к tenant
                 "cash_desk_id": cash_desk_id,  # Привязываем снимок к кассе
-                
-                # Сохраняем транзакции только для указанной кассы (или всех касс tenant'а если cash_desk_id не указан)
-                "transactions": list(db.transactions.find(cash_desk_filter)),
-                
-                # Сохраняем состояние кассы только для указанной кассы
-                "cash": list(db.cash.find(cash_desk_filter)),
-                
-                # Сохраняем фиатные лоты (для FIFO) только для указанной кассы
-                "fiat_lots": list(db.fiat_lots.find(cash_desk_filter)),
-                
-                # Сохраняем PnL матчинги только для указанной кассы
-                "pnl_matches": list(db.pnl_matches.find(cash_desk_filter))
+                "format": "delta",
+                "cash_assets": assets,
+                "compression": compression,
+                "before": before_images if storage == "inline" else {},
+                "inserted": {},
+                "payload_segments": [bson.Binary(data)] if storage == "compressed" else [],
+                "payload_storage": storage,
+                "payload_size": payload_size,
+                "stored_size": len(data),
+                "chunk_count": 0,
+                "segments": 0
             }
             
             # Вставляем снимок
             result = db.history_snapshots.insert_one(snapshot)
             
+            # Новая операция обнуляет стек повтора кассы
+            HistoryManager._drop_redo_stack(tenant_id, cash_desk_id)
+            
+            if storage == "chunks":
+                chunk_count = HistoryManager._write_segment(snapshot, data, 0)
+                db.history_snapshots.update_one(
+                    {"_id": result.inserted_id},
+                    {"$set": {"chunk_count": chunk_count, "segments": 1}}
+                )
+                HistoryManager._check_limits(tenant_id, cash_desk_id, payload_size)
+            
             # Ограничиваем количество снимков для конкретного tenant и кассы
             HistoryManager._cleanup_old_snapshots(tenant_id, cash_desk_id)
             
@@ -72,42 +296,146 @@ class HistoryManager:
             return None
     
     @staticmethod
-    def _cleanup_old_snapshots(tenant_id: str, cash_desk_id: str = None):
-        """Удаляет старые снимки для конкретного tenant и кассы, оставляя только последние MAX_SNAPSHOTS"""
+    def record_changes(snapshot_id: Optional[str], before: Optional[Dict[str, list]] = None, inserted: Optional[Dict[str, list]] = None):
+        """
+        Дописывает в журнал снимка изменения, сделанные операцией
+        
+        Args:
+            snapshot_id: ID снимка из save_snapshot
+            before: Исходные версии изменённых документов {коллекция: [документы]}
+            inserted: ID вставленных операцией документов {коллекция: [_id]}
+        """
+        if not snapshot_id:
+            return
+        payload = {
+            "before": {collection: list(docs) for collection, docs in (before or {}).items() if docs},
+            "inserted": {collection: list(ids) for collection, ids in (inserted or {}).items() if ids}
+        }
+        if not payload["before"] and not payload["inserted"]:
+            return
+        try:
+            snapshot = db.history_snapshots.find_one(
+                {"_id": ObjectId(snapshot_id)},
+                {
+                    "tenant_id": 1, "cash_desk_id": 1, "payload_storage": 1, "compression": 1,
+                    "payload_size": 1, "stored_size": 1, "segments": 1
+                }
+            )
+            if not snapshot:
+                return
+            size = len(bson.encode(payload))
+            data = HistoryManager._encode_payload(payload, snapshot.get("compression"))
+            stored_size = snapshot.get("stored_size", snapshot.get("payload_size")) or 0
+            storage = snapshot.get("payload_storage", "inline")
+            inc = {"payload_size": size, "stored_size": len(data)}
+            
+            if storage != "chunks" and stored_size + len(data) <= INLINE_PAYLOAD_LIMIT:
+                if storage == "compressed":
+                    push = {"payload_segments": bson.Binary(data)}
+                else:
+                    push = {}
+                    for key in ("before", "inserted"):
+                        for collection, items in payload[key].items():
+                            push[f"{key}.{collection}"] = {"$each": items}
+                db.history_snapshots.update_one({"_id": snapshot["_id"]}, {"$push": push, "$inc": inc})
+                return
+            
+            # Журнал перерос встроенный лимит - дописываем новую часть чанками
+            segment = snapshot.get("segments") or 0
+            inc["chunk_count"] = HistoryManager._write_segment(snapshot, data, segment)
+            inc["segments"] = 1
+            db.history_snapshots.update_one(
+                {"_id": snapshot["_id"]},
+                {"$set": {"payload_storage": "chunks"}, "$inc": inc}
+            )
+            HistoryManager._check_limits(
+                snapshot["tenant_id"], snapshot.get("cash_desk_id"),
+                (snapshot.get("payload_size") or 0) + size
+            )
+        except Exception as e:
+            print(f"❌ Failed to record snapshot changes: {e}")
+    
+    @staticmethod
+    def _drop_redo_stack(tenant_id: str, cash_desk_id: str = None):
+        """Удаляет отменённые операции, которые больше нельзя повторить"""
+        filter_criteria = {"tenant_id": tenant_id, "cash_desk_id": cash_desk_id, "undone": True}
+        ids = [snapshot["_id"] for snapshot in db.history_snapshots.find(filter_criteria, {"_id": 1})]
+        if ids:
+            db.history_snapshots.delete_many({"_id": {"$in": ids}})
+            HistoryManager._delete_chunks(ids)
+    
+    @staticmethod
+    def _cleanup_old_snapshots(tenant_id: str, cash_desk_id: str = None) -> int:
+        """
+        Удаляет старые снимки для конкретного tenant и кассы, оставляя только последние MAX_SNAPSHOTS.
+        Читает только _id лишних снимков и удаляет их одним delete_many - тела снимков не передаются
+        """
         try:
-            # Считаем количество снимков для конкретного tenant и кассы
             filter_criteria = {"tenant_id": tenant_id}
             if cash_desk_id:
                 filter_criteria["cash_desk_id"] = cash_desk_id
             
-            count = db.history_snapshots.count_documents(filter_criteria)
+            # Всё, что старше MAX_SNAPSHOTS последних снимков
+            old_ids = [
+                snapshot["_id"]
+                for snapshot in db.history_snapshots.find(filter_criteria, {"_id": 1})
+                .sort("timestamp", -1)
+                .skip(HistoryManager.MAX_SNAPSHOTS)
+            ]
+            if not old_ids:
+                return 0
             
-            if count > HistoryManager.MAX_SNAPSHOTS:
-                # Получаем снимки отсортированные по времени (старые первыми)
-                old_snapshots = list(
-                    db.history_snapshots.find(filter_criteria)
-                    .sort("timestamp", 1)
-                    .limit(count - HistoryManager.MAX_SNAPSHOTS)
-                )
-                
-                # Удаляем старые снимки
-                for snapshot in old_snapshots:
-                    db.history_snapshots.delete_one({"_id": snapshot["_id"]})
-                
-                cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
-                print(f"🧹 Cleaned up {len(old_snapshots)} old snapshots for tenant {tenant_id}{cash_desc}")
+            result = db.history_snapshots.delete_many({"_id": {"$in": old_ids}})
+            HistoryManager._delete_chunks(old_ids)
+            
+            cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+            print(f"🧹 Cleaned up {result.deleted_count} old snapshots for tenant {tenant_id}{cash_desc}")
+            return result.deleted_count
                 
         except Exception as e:
             print(f"❌ Failed to cleanup snapshots: {e}")
+            return 0
+    
+    @staticmethod
+    def prune_all() -> int:
+        """
+        Фоновая очистка: применяет лимит MAX_SNAPSHOTS ко всем кассам
+        и удаляет чанки, чьи снимки уже удалены (в том числе по TTL)
+        
+        Returns:
+            Количество удалённых снимков
+        """
+        pipeline = [
+            {"$group": {
+                "_id": {"tenant_id": "$tenant_id", "cash_desk_id": "$cash_desk_id"},
+                "count": {"$sum": 1}
+            }},
+            {"$match": {"count": {"$gt": HistoryManager.MAX_SNAPSHOTS}}}
+        ]
+        deleted = 0
+        for group in db.history_snapshots.aggregate(pipeline):
+            key = group["_id"]
+            if key.get("tenant_id"):
+                deleted += HistoryManager._cleanup_old_snapshots(key["tenant_id"], key.get("cash_desk_id"))
+        
+        chunk_owner_ids = db.history_snapshot_chunks.distinct("snapshot_id")
+        if chunk_owner_ids:
+            alive = {
+                snapshot["_id"]
+                for snapshot in db.history_snapshots.find({"_id": {"$in": chunk_owner_ids}}, {"_id": 1})
+            }
+            HistoryManager._delete_chunks([sid for sid in chunk_owner_ids if sid not in alive])
+        return deleted
     
     @staticmethod
-    def get_last_snapshot(tenant_id: str = None, cash_desk_id: str = None) -> Optional[Dict[str, Any]]:
+    def get_last_snapshot(tenant_id: str = None, cash_desk_id: str = None, metadata_only: bool = False) -> Optional[Dict[str, Any]]:
         """
         Получает последний сохраненный снимок для конкретного tenant и кассы
         
         Args:
             tenant_id: ID tenant'а
             cash_desk_id: ID кассы (опционально)
+            metadata_only: Не читать журнал снимка (только метаданные)
             
         Returns:
             Снимок состояния или None если снимков нет
@@ -116,12 +444,14 @@ class HistoryManager:
             if not tenant_id:
                 raise ValueError("tenant_id is required")
             
-            filter_criteria = {"tenant_id": tenant_id}
+            # Отменённые операции лежат в стеке повтора и в отмену не попадают
+            filter_criteria = {"tenant_id": tenant_id, "undone": {"$ne": True}}
             if cash_desk_id:
                 filter_criteria["cash_desk_id"] = cash_desk_id
                 
             snapshot = db.history_snapshots.find_one(
                 filter_criteria,
+                SNAPSHOT_METADATA_FIELDS if metadata_only else None,
                 sort=[("timestamp", -1)]  # Сортировка по убыванию времени
             )
             return snapshot
@@ -149,7 +479,6 @@ class HistoryManager:
             
             # Получаем снимок для конкретного tenant и кассы
             if snapshot_id:
-                from bson import ObjectId
                 filter_criteria = {
                     "_id": ObjectId(snapshot_id), 
                     "tenant_id": tenant_id  # Проверяем принадлежность к tenant
@@ -168,57 +497,11 @@ class HistoryManager:
             cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
             print(f"🔄 Restoring snapshot from {snapshot['timestamp']} for tenant {tenant_id}{cash_desc}: {snapshot['operation_type']}")
             
-            # Фильтр для удаления и восстановления данных
-            restore_filter = {"tenant_id": tenant_id}
-            if cash_desk_id:
-                restore_filter["cash_desk_id"] = cash_desk_id
-            
-            # Восстанавливаем транзакции
-            db.transactions.delete_many(restore_filter)
-            if snapshot.get("transactions"):
-                transactions = snapshot["transactions"]
-                for tx in transactions:
-                    tx["tenant_id"] = tenant_id
-                    if cash_desk_id:
-                        tx["cash_desk_id"] = cash_desk_id
-                if transactions:
-                    db.transactions.insert_many(transactions)
-            
-            # Восстанавливаем кассу
-            db.cash.delete_many(restore_filter)
-            if snapshot.get("cash"):
-                cash_items = snapshot["cash"]
-                for item in cash_items:
-                    item["tenant_id"] = tenant_id
-                    if cash_desk_id:
-                        item["cash_desk_id"] = cash_desk_id
-                if cash_items:
-                    db.cash.insert_many(cash_items)
-            
-            # Восстанавливаем фиатные лоты
-            db.fiat_lots.delete_many(restore_filter)
-            if snapshot.get("fiat_lots"):
-                lots = snapshot["fiat_lots"]
-                for lot in lots:
-                    lot["tenant_id"] = tenant_id
-                    if cash_desk_id:
-                        lot["cash_desk_id"] = cash_desk_id
-                if lots:
-                    db.fiat_lots.insert_many(lots)
-            
-            # Восстанавливаем PnL матчи
-            db.pnl_matches.delete_many(restore_filter)
-            if snapshot.get("pnl_matches"):
-                matches = snapshot["pnl_matches"]
-                for match in matches:
-                    match["tenant_id"] = tenant_id
-                    if cash_desk_id:
-                        match["cash_desk_id"] = cash_desk_id
-                if matches:
-                    db.pnl_matches.insert_many(matches)
-            
-            # Удаляем восстановленный снимок (он уже не нужен)
-            db.history_snapshots.delete_one({"_id": snapshot["_id"]})
+            # Журнальный снимок остаётся в стеке повтора, полный снимок старого формата удаляется
+            if snapshot.get("format") == "delta":
+                HistoryManager._undo_delta(snapshot)
+            else:
+                HistoryManager._restore_full(snapshot, tenant_id, cash_desk_id)
             
             print(f"✅ Snapshot restored successfully for tenant {tenant_id}{cash_desc}")
             return True
@@ -229,6 +512,289 @@ class HistoryManager:
             traceback.print_exc()
             return False
     
+    @staticmethod
+    def _first_images(docs: list) -> list:
+        """Оставляет по одной (самой ранней) версии каждого документа"""
+        images = {}
+        for doc in docs:
+            images.setdefault(doc["_id"], doc)
+        return list(images.values())
+    
+    @staticmethod
+    def run_in_transaction(callback):
+        """
+        Выполняет callback(session) в транзакции MongoDB. При TransientTransactionError драйвер
+        повторяет callback целиком, при UnknownTransactionCommitResult - фиксацию (до 120 секунд),
+        поэтому callback должен быть повторяемым. Если сервер не поддерживает транзакции
+        (standalone), выполняет без сессии
+        """
+        try:
+            with client.start_session() as session:
+                session.with_transaction(callback)
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION_CODE:
+                raise
+            print(f"⚠️ Transactions are not supported, writing without transaction: {e}")
+            callback(None)
+    
+    @staticmethod
+    def diff_operations(current_docs: list, target_docs: list, delete_missing: bool = True, collection: str = None) -> list:
+        """
+        Операции bulk_write, приводящие текущие документы к целевым:
+        upsert изменённых и отсутствующих, удаление лишних. Совпадающие документы не трогаются.
+        С указанной коллекцией денежные поля записываются в Decimal128
+        """
+        current = {doc["_id"]: doc for doc in current_docs}
+        operations = [
+            ReplaceOne({"_id": doc["_id"]}, money_storage.encode(collection, doc) if collection else doc, upsert=True)
+            for doc in target_docs
+            if current.get(doc["_id"]) != doc
+        ]
+        if delete_missing:
+            target_ids = {doc["_id"] for doc in target_docs}
+            operations.extend(DeleteOne({"_id": _id}) for _id in current if _id not in target_ids)
+        return operations
+    
+    @staticmethod
+    def _advance_versions(tenant_id: str, cash_desk_id: Optional[str], session=None):
+        """
+        Увеличивает версию кассы (или всех касс tenant'а) в транзакции отмены/повтора:
+        обмен, посчитанный по прежнему состоянию кассы, после этого не пройдёт advance
+        """
+        if cash_desk_id:
+            desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+        else:
+            desk_version_manager.advance_tenant(tenant_id, session=session)
+    
+    @staticmethod
+    def _restore_full(snapshot: dict, tenant_id: str, cash_desk_id: str = None):
+        """
+        Восстанавливает полный снимок старого формата: сравнивает текущие данные кассы со снимком
+        и применяет только изменения - одним bulk_write на коллекцию в одной транзакции
+        """
+        # Фильтр для выборки текущих данных
+        restore_filter = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            restore_filter["cash_desk_id"] = cash_desk_id
+        
+        targets = {}
+        for collection in JOURNAL_COLLECTIONS:
+            docs = snapshot.get(collection) or []
+            for doc in docs:
+                doc["tenant_id"] = tenant_id
+                if cash_desk_id:
+                    doc["cash_desk_id"] = cash_desk_id
+            targets[collection] = docs
+        
+        def apply(session):
+            for collection in JOURNAL_COLLECTIONS:
+                current_docs = list(db[collection].find(restore_filter, session=session))
+                operations = HistoryManager.diff_operations(current_docs, targets[collection], collection=collection)
+                if operations:
+                    db[collection].bulk_write(operations, ordered=False, session=session)
+            
+            # Лоты могли быть заархивированы после снимка - убираем их архивные копии
+            lot_archive_manager.discard([lot["_id"] for lot in targets["fiat_lots"]], session=session)
+            
+            # Удаляем восстановленный снимок (он уже не нужен)
+            db.history_snapshots.delete_one({"_id": snapshot["_id"]}, session=session)
+            HistoryManager._advance_versions(tenant_id, cash_desk_id, session)
+        
+        HistoryManager.run_in_transaction(apply)
+    
+    @staticmethod
+    def _journal_scope(payload: dict) -> Dict[str, list]:
+        """ID документов, затронутых операцией, по коллекциям (касса адресуется активами)"""
+        scope = {}
+        for collection in JOURNAL_COLLECTIONS:
+            if collection == "cash":
+                continue
+            ids = list(payload["inserted"].get(collection, []))
+            ids += [doc["_id"] for doc in payload["before"].get(collection, [])]
+            if ids:
+                scope[collection] = list(dict.fromkeys(ids))
+        return scope
+    
+    @staticmethod
+    def _cash_filter(snapshot: dict) -> Optional[dict]:
+        assets = snapshot.get("cash_assets") or []
+        if not assets:
+            return None
+        cash_filter = {"tenant_id": snapshot["tenant_id"], "asset": {"$in": assets}}
+        if snapshot.get("cash_desk_id"):
+            cash_filter["cash_desk_id"] = snapshot["cash_desk_id"]
+        return cash_filter
+    
+    @staticmethod
+    def _current_images(snapshot: dict, scope: Dict[str, list], session=None) -> Dict[str, list]:
+        """Текущие версии документов операции (исчерпанные лоты ищутся и в архиве)"""
+        images = {}
+        for collection, ids in scope.items():
+            docs = list(db[collection].find({"_id": {"$in": ids}}, session=session))
+            if collection == "fiat_lots":
+                found = {lot["_id"] for lot in docs}
+                archived_ids = [_id for _id in ids if _id not in found]
+                if archived_ids:
+                    for lot in db.fiat_lots_archive.find({"_id": {"$in": archived_ids}}, session=session):
+                        lot.pop("archived_at", None)
+                        docs.append(lot)
+            images[collection] = docs
+        cash_filter = HistoryManager._cash_filter(snapshot)
+        if cash_filter:
+            images["cash"] = list(db.cash.find(cash_filter, session=session))
+        return images
+    
+    @staticmethod
+    def _apply_images(snapshot: dict, scope: Dict[str, list], targets: Dict[str, list], session=None) -> list:
+        """
+        Приводит документы операции к целевым версиям (только отличающиеся, bulk_write на коллекцию)
+        
+        Returns:
+            Версии затронутых транзакций до применения - для вычитания из счётчиков
+        """
+        touched_txs = []
+        for collection in JOURNAL_COLLECTIONS:
+            if collection == "cash":
+                cash_filter = HistoryManager._cash_filter(snapshot)
+                if not cash_filter:
+                    continue
+                current_docs = list(db.cash.find(cash_filter, session=session))
+            else:
+                ids = scope.get(collection)
+                if not ids:
+                    continue
+                current_docs = list(db[collection].find({"_id": {"$in": ids}}, session=session))
+            if collection == "transactions":
+                touched_txs = current_docs
+            operations = HistoryManager.diff_operations(current_docs, targets.get(collection, []), collection=collection)
+            if operations:
+                db[collection].bulk_write(operations, ordered=False, session=session)
+        
+        # Лоты могли быть заархивированы после операции - убираем их архивные копии
+        lot_archive_manager.discard(scope.get("fiat_lots", []), session=session)
+        return touched_txs
+    
+    @staticmethod
+    def _apply_counters(touched_txs: list, target_txs: list):
+        """Корректирует счётчики desk_stats и дневные агрегаты после смены версий транзакций"""
+        desk_stats_manager.apply_changes(touched_txs, target_txs)
+        for tx in touched_txs:
+            rollup_manager.remove_transaction(tx)
+        for tx in target_txs:
+            rollup_manager.record_transaction(tx)
+    
+    @staticmethod
+    def _undo_delta(snapshot: dict):
+        """
+        Отменяет операцию по журналу: возвращает before-image затронутых документов,
+        удаляет вставленные и сохраняет текущие версии (after-image) для повтора.
+        Всё - в одной транзакции; стоимость пропорциональна числу документов операции
+        """
+        payload = HistoryManager._load_payload(snapshot)
+        before = {
+            collection: HistoryManager._first_images(docs)
+            for collection, docs in payload["before"].items()
+        }
+        scope = HistoryManager._journal_scope(payload)
+        state = {}
+        
+        def apply(session):
+            after = HistoryManager._current_images(snapshot, scope, session)
+            data = HistoryManager._encode_payload({"after": after}, snapshot.get("compression"))
+            update = {"undone": True, "undone_at": datetime.utcnow()}
+            HistoryManager._delete_chunks([snapshot["_id"]], kind="redo", session=session)
+            if len(data) <= INLINE_PAYLOAD_LIMIT:
+                update["redo_payload"] = bson.Binary(data)
+            else:
+                update["redo_payload"] = None
+                HistoryManager._write_segment(snapshot, data, REDO_SEGMENT, kind="redo", session=session)
+            
+            state["touched"] = HistoryManager._apply_images(snapshot, scope, before, session)
+            db.history_snapshots.update_one({"_id": snapshot["_id"]}, {"$set": update}, session=session)
+            HistoryManager._advance_versions(snapshot["tenant_id"], snapshot.get("cash_desk_id"), session)
+        
+        HistoryManager.run_in_transaction(apply)
+        HistoryManager._apply_counters(state["touched"], before.get("transactions", []))
+    
+    @staticmethod
+    def get_next_redo(tenant_id: str, cash_desk_id: str = None) -> Optional[Dict[str, Any]]:
+        """Метаданные операции, которая будет повторена следующей (последняя отменённая)"""
+        filter_criteria = {"tenant_id": tenant_id, "undone": True}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        # Отменённые операции новее всех действующих; первой повторяется самая ранняя из них
+        return db.history_snapshots.find_one(
+            filter_criteria,
+            SNAPSHOT_METADATA_FIELDS,
+            sort=[("timestamp", 1)]
+        )
+    
+    @staticmethod
+    def redo_snapshot(snapshot_id: Optional[str] = None, tenant_id: str = None, cash_desk_id: str = None) -> bool:
+        """
+        Повторяет отменённую операцию: возвращает сохранённые при отмене after-image документов
+        
+        Args:
+            snapshot_id: ID отменённого снимка. Если None, берётся следующий в стеке повтора
+            tenant_id: ID tenant'а
+            cash_desk_id: ID кассы
+            
+        Returns:
+            True если повтор прошёл успешно, False иначе
+        """
+        try:
+            if not tenant_id:
+                raise ValueError("tenant_id is required for redo")
+            
+            if not snapshot_id:
+                next_redo = HistoryManager.get_next_redo(tenant_id, cash_desk_id)
+                if not next_redo:
+                    return False
+                snapshot_id = next_redo["_id"]
+            snapshot = db.history_snapshots.find_one(
+                {"_id": ObjectId(snapshot_id), "tenant_id": tenant_id, "undone": True}
+            )
+            if not snapshot:
+                return False
+            
+            payload = HistoryManager._load_payload(snapshot)
+            scope = HistoryManager._journal_scope(payload)
+            if snapshot.get("redo_payload") is not None:
+                redo = HistoryManager._decode_payload(bytes(snapshot["redo_payload"]), snapshot.get("compression"))
+            else:
+                segments = HistoryManager._read_segments(snapshot, kind="redo")
+                redo = segments[0] if segments else {"after": {}}
+            after = redo.get("after") or {}
+            state = {}
+            
+            def apply(session):
+                state["touched"] = HistoryManager._apply_images(snapshot, scope, after, session)
+                db.history_snapshots.update_one(
+                    {"_id": snapshot["_id"]},
+                    {"$set": {"undone": False}, "$unset": {"undone_at": "", "redo_payload": ""}},
+                    session=session
+                )
+                HistoryManager._delete_chunks([snapshot["_id"]], kind="redo", session=session)
+                HistoryManager._advance_versions(snapshot["tenant_id"], snapshot.get("cash_desk_id"), session)
+            
+            HistoryManager.run_in_transaction(apply)
+            HistoryManager._apply_counters(state["touched"], after.get("transactions", []))
+            
+            # Исчерпанные лоты снова уходят в архив
+            lot_archive_manager.archive_lots([
+                lot["_id"] for lot in after.get("fiat_lots", []) if (lot.get("remaining") or 0) <= 0
+            ])
+            
+            cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+            print(f"✅ Operation redone for tenant {tenant_id}{cash_desc}: {snapshot['operation_type']}")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Failed to redo operation: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    
     @staticmethod
     def get_history(limit: int = 10, tenant_id: str = None, cash_desk_id: str = None) -> list:
         """
@@ -251,17 +817,7 @@ class HistoryManager:
                 filter_criteria["cash_desk_id"] = cash_desk_id
                 
             snapshots = list(
-                db.history_snapshots.find(
-                    filter_criteria,
-                    {
-                        "_id": 1,
-                        "timestamp": 1,
-                        "operation_type": 1,
-                        "description": 1,
-                        "tenant_id": 1,
-                        "cash_desk_id": 1
-                    }
-                )
+                db.history_snapshots.find(filter_criteria, SNAPSHOT_METADATA_FIELDS)
                 .sort("timestamp", -1)
                 .limit(limit)
             )
@@ -276,6 +832,44 @@ class HistoryManager:
             print(f"❌ Failed to get history: {e}")
             return []
     
+    @staticmethod
+    def get_snapshot_metrics(tenant_id: str, cash_desk_id: str = None) -> Dict[str, Any]:
+        """
+        Метрики объёма снимков tenant'а (или кассы)
+        
+        Returns:
+            {snapshots_count, chunked_count, compressed_count, total_payload_size,
+             total_stored_size, max_payload_size, total_chunks}
+        """
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        pipeline = [
+            {"$match": filter_criteria},
+            {"$group": {
+                "_id": None,
+                "snapshots_count": {"$sum": 1},
+                "chunked_count": {"$sum": {"$cond": [{"$eq": ["$payload_storage", "chunks"]}, 1, 0]}},
+                "total_payload_size": {"$sum": {"$ifNull": ["$payload_size", 0]}},
+                "total_stored_size": {"$sum": {"$ifNull": ["$stored_size", {"$ifNull": ["$payload_size", 0]}]}},
+                "compressed_count": {"$sum": {"$cond": [{"$ifNull": ["$compression", False]}, 1, 0]}},
+                "max_payload_size": {"$max": {"$ifNull": ["$payload_size", 0]}},
+                "total_chunks": {"$sum": {"$ifNull": ["$chunk_count", 0]}}
+            }}
+        ]
+        row = next(db.history_snapshots.aggregate(pipeline), None) or {}
+        return {
+            "snapshots_count": row.get("snapshots_count", 0),
+            "chunked_count": row.get("chunked_count", 0),
+            "total_payload_size": row.get("total_payload_size", 0),
+            "total_stored_size": row.get("total_stored_size", 0),
+            "compressed_count": row.get("compressed_count", 0),
+            "max_payload_size": row.get("max_payload_size", 0),
+            "total_chunks": row.get("total_chunks", 0),
+            "inline_limit": INLINE_PAYLOAD_LIMIT,
+            "document_limit": BSON_DOCUMENT_LIMIT
+        }
+    
     @staticmethod
     def clear_history(tenant_id: str = None, cash_desk_id: str = None):
         """Очищает историю снимков (для reset-all-data)
@@ -292,12 +886,14 @@ class HistoryManager:
                 
                 # Очищаем историю для конкретного tenant'а (и кассы если указана)
                 result = db.history_snapshots.delete_many(filter_criteria)
+                db.history_snapshot_chunks.delete_many(filter_criteria)
                 
                 cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
                 print(f"🧹 Cleared {result.deleted_count} history snapshots for tenant {tenant_id}{cash_desc}")
             else:
                 # Очищаем всю историю (для полного сброса системы)
                 result = db.history_snapshots.delete_many({})
+                db.history_snapshot_chunks.delete_many({})
                 print(f"🧹 Cleared {result.deleted_count} history snapshots (all)")
             
             return result.deleted_count
@@ -0,0 +1,147 @@
+"""
+Модуль ключей идемпотентности (idempotency_keys)
+
+Клиент передаёт заголовок Idempotency-Key с POST /transactions, /cash/deposit и
+/cash/withdrawal. Первый запрос с ключом захватывает его (status = "pending"),
+выполняет операцию и сохраняет её ответ (status = "done"). Повтор с тем же ключом
+получает сохранённый ответ - без FIFO, снимков, Google Sheets и Telegram.
+Ключ с другим телом запроса отклоняется, ключ операции, которая ещё выполняется, -
+тоже (409). Если операция завершилась ошибкой, ключ освобождается для повтора.
+Записи удаляются TTL-индексом через IDEMPOTENCY_TTL_HOURS.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Callable
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from .db import db
+from .constants import IDEMPOTENCY_TTL_HOURS
+
+MAX_KEY_LENGTH = 255
+# Захват ключа старше этого считается брошенным (процесс упал посреди операции)
+PENDING_TIMEOUT_SECONDS = 300
+
+
+class IdempotencyManager:
+    """Менеджер ключей идемпотентности операций записи"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Уникальный ключ в пределах tenant'а и TTL-индекс по времени создания"""
+        db.idempotency_keys.create_index([("tenant_id", 1), ("key", 1)], unique=True)
+        ttl_seconds = IDEMPOTENCY_TTL_HOURS * 3600
+        try:
+            db.idempotency_keys.create_index([("created_at", 1)], expireAfterSeconds=ttl_seconds)
+        except OperationFailure:
+            db.command("collMod", "idempotency_keys", index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": ttl_seconds})
+
+    @staticmethod
+    def fingerprint(operation: str, request: Dict[str, Any]) -> str:
+        """Хэш операции и переданных клиентом полей запроса"""
+        data = json.dumps({"operation": operation, "request": jsonable_encoder(request)}, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def begin(tenant_id: str, key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Захватывает ключ для выполнения операции
+
+        Returns:
+            Сохранённый ответ, если операция с этим ключом уже выполнена, иначе None (ключ захвачен)
+
+        Raises:
+            HTTPException: 422 - ключ использован с другим запросом, 409 - операция ещё выполняется
+        """
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key is limited to {MAX_KEY_LENGTH} characters")
+        now = datetime.utcnow()
+        try:
+            db.idempotency_keys.insert_one({
+                "tenant_id": tenant_id,
+                "key": key,
+                "request_hash": request_hash,
+                "status": "pending",
+                "created_at": now
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+
+        record = db.idempotency_keys.find_one({"tenant_id": tenant_id, "key": key})
+        if not record:
+            # Запись только что истекла или освобождена - захватываем заново
+            return IdempotencyManager.begin(tenant_id, key, request_hash)
+        if record["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if record["status"] == "done":
+            return record["response"]
+
+        # Брошенный захват перехватывается условно - его мог перехватить и параллельный повтор
+        if record["created_at"] < now - timedelta(seconds=PENDING_TIMEOUT_SECONDS):
+            result = db.idempotency_keys.update_one(
+                {"_id": record["_id"], "status": "pending", "created_at": record["created_at"]},
+                {"$set": {"created_at": now}}
+            )
+            if result.modified_count:
+                return None
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    @staticmethod
+    def complete(tenant_id: str, key: str, response: Dict[str, Any]):
+        """Сохраняет ответ выполненной операции"""
+        try:
+            db.idempotency_keys.update_one(
+                {"tenant_id": tenant_id, "key": key},
+                {"$set": {"status": "done", "response": jsonable_encoder(response), "completed_at": datetime.utcnow()}}
+            )
+        except Exception as e:
+            print(f"❌ Failed to store idempotent response for key {key}: {e}")
+
+    @staticmethod
+    def release(tenant_id: str, key: str):
+        """Освобождает ключ операции, завершившейся ошибкой, чтобы клиент мог повторить запрос"""
+        try:
+            db.idempotency_keys.delete_one({"tenant_id": tenant_id, "key": key, "status": "pending"})
+        except Exception as e:
+            print(f"❌ Failed to release idempotency key {key}: {e}")
+
+    @staticmethod
+    def clear(tenant_id: str) -> int:
+        """Удаляет ключи tenant'а (после сброса его данных сохранённые ответы недействительны)"""
+        return db.idempotency_keys.delete_many({"tenant_id": tenant_id}).deleted_count
+
+    @staticmethod
+    def run(
+        tenant_id: str,
+        key: Optional[str],
+        operation: str,
+        request: Dict[str, Any],
+        execute: Callable[[], Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """
+        Выполняет операцию один раз на ключ: без ключа - как обычно,
+        с уже использованным ключом - возвращает сохранённый ответ
+
+        Args:
+            operation: Имя операции (входит в хэш запроса)
+            request: Поля запроса, переданные клиентом
+            execute: Сама операция, возвращающая ответ API
+        """
+        if not key:
+            return execute()
+        cached = IdempotencyManager.begin(tenant_id, key, IdempotencyManager.fingerprint(operation, request))
+        if cached is not None:
+            return cached
+        try:
+            response = execute()
+        except BaseException:
+            IdempotencyManager.release(tenant_id, key)
+            raise
+        IdempotencyManager.complete(tenant_id, key, response)
+        return response
+
+
+# Глобальный экземпляр
+idempotency_manager = IdempotencyManager()
@@ -0,0 +1,100 @@
+"""
+Модуль архива исчерпанных фиатных лотов (fiat_lots_archive)
+
+Лоты с remaining = 0 переносятся из fiat_lots в архивную коллекцию пакетно,
+поэтому рабочая коллекция содержит только открытый инвентарь.
+Перенос идемпотентен: документ сначала upsert'ится в архив, затем удаляется из fiat_lots.
+"""
+from datetime import datetime
+from typing import Optional, List
+from pymongo import ReplaceOne
+from .db import db
+from .money_storage import money_storage
+
+
+class LotArchiveManager:
+    """Менеджер архива исчерпанных лотов"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Индексы для чтения архива по кассе и валюте"""
+        db.fiat_lots_archive.create_index([("cash_desk_id", 1), ("currency", 1), ("created_at", 1)])
+        db.fiat_lots_archive.create_index([("tenant_id", 1), ("currency", 1)])
+        db.fiat_lots_archive.create_index([("tx_id", 1)])
+
+    @staticmethod
+    def _move(filter_criteria: dict) -> int:
+        """Переносит исчерпанные лоты по фильтру в архив"""
+        filter_criteria = {**filter_criteria, "remaining": {"$lte": 0}}
+        lots = list(db.fiat_lots.find(filter_criteria))
+        if not lots:
+            return 0
+
+        now = datetime.utcnow()
+        operations = [
+            ReplaceOne({"_id": lot["_id"]}, money_storage.encode("fiat_lots_archive", {**lot, "archived_at": now}), upsert=True)
+            for lot in lots
+        ]
+        db.fiat_lots_archive.bulk_write(operations, ordered=False)
+
+        # Удаляем только то, что скопировали и что по-прежнему исчерпано
+        ids = [lot["_id"] for lot in lots]
+        result = db.fiat_lots.delete_many({"_id": {"$in": ids}, "remaining": {"$lte": 0}})
+        return result.deleted_count
+
+    @staticmethod
+    def archive_lots(lot_ids: List) -> int:
+        """
+        Архивирует указанные лоты, если они исчерпаны (вызывается после FIFO-списания)
+
+        Returns:
+            Количество перенесённых лотов
+        """
+        if not lot_ids:
+            return 0
+        try:
+            return LotArchiveManager._move({"_id": {"$in": list(lot_ids)}})
+        except Exception as e:
+            print(f"❌ Failed to archive fiat lots: {e}")
+            return 0
+
+    @staticmethod
+    def archive_exhausted(tenant_id: str, cash_desk_id: str = None) -> int:
+        """
+        Переносит в архив все исчерпанные лоты tenant'а (или одной кассы)
+
+        Returns:
+            Количество перенесённых лотов
+        """
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        moved = LotArchiveManager._move(filter_criteria)
+
+        desk_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+        print(f"📦 Archived {moved} exhausted fiat lots for tenant {tenant_id}{desk_desc}")
+        return moved
+
+    @staticmethod
+    def find(filter_criteria: dict) -> list:
+        """Архивные лоты по фильтру"""
+        return list(db.fiat_lots_archive.find(filter_criteria).sort("created_at", 1))
+
+    @staticmethod
+    def discard(lot_ids: List, session=None) -> int:
+        """Удаляет архивные копии лотов, вернувшихся в fiat_lots (например, после отката)"""
+        if not lot_ids:
+            return 0
+        return db.fiat_lots_archive.delete_many({"_id": {"$in": list(lot_ids)}}, session=session).deleted_count
+
+    @staticmethod
+    def clear(tenant_id: str, cash_desk_id: Optional[str] = None) -> int:
+        """Удаляет архив tenant'а (или одной кассы)"""
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        return db.fiat_lots_archive.delete_many(filter_criteria).deleted_count
+
+
+# Глобальный экземпляр
+lot_archive_manager = LotArchiveManager()
@@ -0,0 +1,98 @@
+"""
+Модуль кэша книг лотов касс в памяти процесса
+
+Книга открытых лотов кассы (LotBook) загружается из fiat_lots лениво, при первом
+обращении, и хранится вместе с версией кассы (desk_versions), по которой она построена.
+Запись обмена берёт книгу из кэша (checkout), списывает лоты в памяти и после записи
+в базу возвращает её (commit) с новой версией - только если версия выросла ровно на
+единицу, то есть между чтением и записью касса не менялась никем другим.
+Если кассу изменил другой процесс или другой запрос, версии не совпадут и книга
+будет загружена заново. В обычном случае одного пишущего процесса выбор лотов
+не обращается к базе.
+"""
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+from .constants import LOT_BOOK_CACHE_DESKS
+from .desk_versions import desk_version_manager
+from .fifo_engine import fifo_engine, LotBook
+
+
+class LotBookCache:
+    """Кэш книг лотов по кассам с проверкой версии кассы"""
+
+    def __init__(self, max_desks: int):
+        self.max_desks = max_desks
+        self._books: "OrderedDict[str, Tuple[int, LotBook]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def checkout(self, cash_desk_id: str, needs: Optional[Dict[str, float]] = None) -> Tuple[LotBook, int]:
+        """
+        Забирает книгу кассы для изменения. Пока книга на руках, в кэше её нет,
+        поэтому параллельный запрос загрузит свою копию из базы
+
+        Args:
+            needs: Потребность по валютам - при отключённом кэше грузятся только покрывающие её лоты
+                (None - все открытые лоты кассы)
+
+        Returns:
+            (книга, версия кассы, по которой она актуальна)
+        """
+        # Версия читается до загрузки: запись, прошедшая во время загрузки, сменит версию
+        version = desk_version_manager.get(cash_desk_id)
+        if self.max_desks <= 0:
+            if needs is None:
+                return fifo_engine.load_book(cash_desk_id), version
+            return fifo_engine.load_covering(cash_desk_id, needs), version
+        with self._lock:
+            entry = self._books.pop(cash_desk_id, None)
+        if entry and entry[0] == version:
+            self.hits += 1
+            return entry[1], version
+        self.misses += 1
+        return fifo_engine.load_book(cash_desk_id), version
+
+    def checkin(self, cash_desk_id: str, book: LotBook, version: int):
+        """Возвращает в кэш книгу, актуальную для версии version"""
+        if self.max_desks <= 0:
+            return
+        book.compact()
+        with self._lock:
+            self._books[cash_desk_id] = (version, book)
+            self._books.move_to_end(cash_desk_id)
+            while len(self._books) > self.max_desks:
+                self._books.popitem(last=False)
+
+    def commit(self, cash_desk_id: str, book: LotBook, version: int, new_version: Optional[int]):
+        """
+        Возвращает книгу после собственной записи в базу
+
+        Args:
+            version: Версия, полученная при checkout
+            new_version: Версия после записи (результат desk_version_manager.advance)
+        """
+        if new_version is None or new_version != version + 1:
+            # Версию не удалось обновить или между чтением и записью кассу изменил кто-то ещё
+            return
+        self.checkin(cash_desk_id, book, new_version)
+
+    def open_lots(self, cash_desk_id: str, currency: str, need: Optional[float] = None) -> List[dict]:
+        """Копии открытых лотов валюты в порядке FIFO - для предпросмотра, который книгу не меняет"""
+        book, version = self.checkout(cash_desk_id, {currency: need} if need else None)
+        lots = [{**lot, "meta": dict(lot.get("meta") or {})} for lot in book.open_lots(currency)]
+        self.checkin(cash_desk_id, book, version)
+        return lots
+
+    def discard(self, cash_desk_id: str):
+        with self._lock:
+            self._books.pop(cash_desk_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"desks": len(self._books), "max_desks": self.max_desks, "hits": self.hits, "misses": self.misses}
+
+
+# Глобальный экземпляр
+lot_book_cache = LotBookCache(LOT_BOOK_CACHE_DESKS)
@@ -0,0 +1,217 @@
+"""
+Модуль агрегатов открытых фиатных лотов (lot_stats)
+
+Один документ на (касса, валюта, источник лота): суммарный остаток, Σ(rate·remaining)
+и количество открытых лотов. Обновляется в путях создания и списания лотов в той же
+транзакции MongoDB, что и сами лоты, одним $inc на агрегат, поэтому агрегаты не расходятся
+с fiat_lots, а сводки по лотам читаются без обхода лотов. Приращения применяются только
+к уже собранным агрегатам кассы: касса без них пересобирается по своим лотам.
+"""
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+from pymongo import UpdateOne
+from .db import db
+from .constants import FIAT_ASSETS
+
+LOT_SOURCES = ["fiat_to_crypto", "fiat_to_fiat"]
+EPS = 0.0000001
+
+
+class LotStatsManager:
+    """Менеджер агрегатов открытых лотов"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Уникальный ключ агрегата"""
+        db.lot_stats.create_index(
+            [("cash_desk_id", 1), ("currency", 1), ("source", 1)],
+            unique=True
+        )
+        db.lot_stats.create_index([("tenant_id", 1), ("currency", 1)])
+
+    @staticmethod
+    def _key(cash_desk_id: str, currency: str, source: str) -> dict:
+        return {"cash_desk_id": cash_desk_id, "currency": currency, "source": source}
+
+    @staticmethod
+    def apply_lot_changes(
+        cash_desk_id: str,
+        tenant_id: Optional[str],
+        created: List[dict],
+        consumed: List[dict],
+        session=None
+    ):
+        """
+        Учитывает новые и списанные FIFO-движком лоты обмена. Вызывается внутри транзакции
+        записи, после записи лотов: ошибка не подавляется и отменяет запись целиком
+
+        Args:
+            created: Новые лоты
+            consumed: Списания движка {lot (документ до списания), take, remaining}
+        """
+        deltas: Dict[tuple, Dict[str, float]] = {}
+
+        def add(lot: dict, amount: float, count: int):
+            key = (lot["currency"], (lot.get("meta") or {}).get("source"))
+            inc = deltas.setdefault(key, {"total_remaining": 0.0, "rate_value": 0.0, "open_count": 0})
+            inc["total_remaining"] += amount
+            inc["rate_value"] += lot["rate"] * amount
+            inc["open_count"] += count
+
+        for lot in created:
+            if (lot.get("remaining") or 0) > 0:
+                add(lot, lot["remaining"], 1)
+        for item in consumed:
+            lot = item["lot"]
+            if item["remaining"] <= 0:
+                # Лот закрыт: списываем его остаток целиком
+                add(lot, -lot["remaining"], -1)
+            else:
+                add(lot, -item["take"], 0)
+        if not deltas:
+            return
+
+        # Приращения к несобранным агрегатам потеряли бы уже открытые лоты кассы
+        if not db.lot_stats.find_one({"cash_desk_id": cash_desk_id}, {"_id": 1}, session=session):
+            LotStatsManager.rebuild(cash_desk_id, tenant_id, session=session)
+            return
+        now = datetime.utcnow()
+        for (currency, source), inc in deltas.items():
+            result = db.lot_stats.update_one(
+                LotStatsManager._key(cash_desk_id, currency, source),
+                {"$inc": inc, "$set": {"updated_at": now}},
+                session=session
+            )
+            if result.matched_count == 0:
+                # Агрегата этой пары нет (например, новая валюта) - пересобираем кассу целиком
+                LotStatsManager.rebuild(cash_desk_id, tenant_id, session=session)
+                return
+
+    @staticmethod
+    def rebuild(cash_desk_id: str, tenant_id: str = None, session=None) -> int:
+        """
+        Пересобирает агрегаты кассы по открытым лотам (ремонтная задача)
+
+        Returns:
+            Количество записанных агрегатов
+        """
+        pipeline = [
+            {"$match": {"cash_desk_id": cash_desk_id, "remaining": {"$gt": 0}}},
+            {"$group": {
+                "_id": {"currency": "$currency", "source": "$meta.source"},
+                "total_remaining": {"$sum": "$remaining"},
+                "rate_value": {"$sum": {"$multiply": ["$rate", "$remaining"]}},
+                "open_count": {"$sum": 1},
+                "tenant_id": {"$first": "$tenant_id"}
+            }}
+        ]
+        found = {
+            (r["_id"]["currency"], r["_id"].get("source")): r
+            for r in db.fiat_lots.aggregate(pipeline, session=session)
+        }
+
+        # Пустые агрегаты для всех валют, чтобы отсутствие документа означало "ещё не собрано"
+        keys = set(found) | {(currency, source) for currency in FIAT_ASSETS for source in LOT_SOURCES}
+
+        now = datetime.utcnow()
+        operations = []
+        for currency, source in keys:
+            row = found.get((currency, source), {})
+            operations.append(UpdateOne(
+                LotStatsManager._key(cash_desk_id, currency, source),
+                {"$set": {
+                    "tenant_id": row.get("tenant_id") or tenant_id,
+                    "total_remaining": row.get("total_remaining", 0.0),
+                    "rate_value": row.get("rate_value", 0.0),
+                    "open_count": row.get("open_count", 0),
+                    "updated_at": now
+                }, "$unset": {"oldest_open_at": ""}},
+                upsert=True
+            ))
+        db.lot_stats.bulk_write(operations, ordered=False, session=session)
+        return len(operations)
+
+    @staticmethod
+    def _desk_docs(cash_desk_id: str, currency: str, tenant_id: str = None) -> List[dict]:
+        docs = list(db.lot_stats.find({"cash_desk_id": cash_desk_id, "currency": currency}))
+        if not docs:
+            LotStatsManager.rebuild(cash_desk_id, tenant_id)
+            docs = list(db.lot_stats.find({"cash_desk_id": cash_desk_id, "currency": currency}))
+        return docs
+
+    @staticmethod
+    def backfill() -> int:
+        """
+        Собирает агрегаты касс, у которых их ещё нет (задача запуска)
+
+        Returns:
+            Количество собранных касс
+        """
+        built = set(db.lot_stats.distinct("cash_desk_id"))
+        rebuilt = 0
+        for desk in db.cash_desks.find({}, {"_id": 1, "tenant_id": 1}):
+            if desk["_id"] not in built:
+                LotStatsManager.rebuild(desk["_id"], desk.get("tenant_id"))
+                rebuilt += 1
+        return rebuilt
+
+    @staticmethod
+    def get_summary(currency: str, cash_desk_id: Optional[str] = None, tenant_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Сводка открытых лотов валюты для кассы или агрегированно по всем кассам tenant'а
+
+        Returns:
+            {count, total_remaining, weighted_avg_rate, oldest_open_at, by_source}
+        """
+        if cash_desk_id:
+            desk_ids = [cash_desk_id]
+            docs = LotStatsManager._desk_docs(cash_desk_id, currency, tenant_id)
+        else:
+            desk_ids = [d["_id"] for d in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1})]
+            docs = list(db.lot_stats.find({"cash_desk_id": {"$in": desk_ids}, "currency": currency}))
+            built = {doc["cash_desk_id"] for doc in docs}
+            for desk_id in desk_ids:
+                if desk_id not in built:
+                    docs.extend(LotStatsManager._desk_docs(desk_id, currency, tenant_id))
+
+        summary = {
+            "count": 0,
+            "total_remaining": 0.0,
+            "weighted_avg_rate": 0.0,
+            "oldest_open_at": None,
+            "by_source": {}
+        }
+        rate_value = 0.0
+        for doc in docs:
+            if doc.get("open_count", 0) <= 0:
+                continue
+            summary["count"] += doc["open_count"]
+            summary["total_remaining"] += doc["total_remaining"]
+            rate_value += doc["rate_value"]
+            source = doc.get("source") or "unknown"
+            by_source = summary["by_source"].setdefault(source, {"count": 0, "total_remaining": 0.0})
+            by_source["count"] += doc["open_count"]
+            by_source["total_remaining"] += doc["total_remaining"]
+
+        if summary["total_remaining"] > EPS:
+            summary["weighted_avg_rate"] = rate_value / summary["total_remaining"]
+            # Самый старый открытый лот - голова очереди FIFO, один запрос по индексу лотов
+            oldest = db.fiat_lots.find_one(
+                {"cash_desk_id": {"$in": desk_ids}, "currency": currency, "remaining": {"$gt": 0}},
+                {"created_at": 1},
+                sort=[("created_at", 1)]
+            )
+            summary["oldest_open_at"] = oldest["created_at"] if oldest else None
+        return summary
+
+    @staticmethod
+    def clear(tenant_id: str, cash_desk_id: str = None) -> int:
+        """Удаляет агрегаты tenant'а (или одной кассы)"""
+        filter_criteria = {"tenant_id": tenant_id}
+        if cash_desk_id:
+            filter_criteria["cash_desk_id"] = cash_desk_id
+        return db.lot_stats.delete_many(filter_criteria).deleted_count
+
+
+# Глобальный экземпляр
+lot_stats_manager = LotStatsManager()
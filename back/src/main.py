@@ -1,11 +1,22 @@
 """
 Главный файл приложения FastAPI с подключением роутеров
 """
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 # Импорт роутеров
-from .routers import cash, transactions, system, admin, google_sheets, cash_desks
+from .routers import cash, transactions, system, admin, google_sheets, cash_desks, reports, dashboard
+from .desk_stats import desk_stats_manager
+from .daily_rollups import rollup_manager
+from .lot_stats import lot_stats_manager
+from .lot_archive import lot_archive_manager
+from .history_manager import history_manager
+from .checkpoints import checkpoint_manager
+from .fifo_engine import fifo_engine
+from .pnl_match_store import pnl_match_store
+from .idempotency import idempotency_manager
+from .constants import SNAPSHOT_PRUNE_INTERVAL_SECONDS, CHECKPOINT_INTERVAL_SECONDS
 # Новые роутеры с репозиториями и явным разделением API
 
 # Создание приложения FastAPI
@@ -27,4 +38,83 @@ app.include_router(transactions.router) # Операции с транзакци
 app.include_router(admin.router)       # Административные операции (/admin/*)
 app.include_router(google_sheets.router) # Google Sheets интеграция (/google-sheets/*)
 app.include_router(cash_desks.router)   # Фаза 2: Управление кассами (/cash-desks/*)
+app.include_router(reports.router)      # Отчёты за период по дневным агрегатам (/reports/*)
+app.include_router(dashboard.router)    # Сводка дашборда одним запросом (/dashboard)
 
+
+@app.on_event("startup")
+def ensure_indexes():
+    """Создаёт индексы служебных коллекций"""
+    try:
+        rollup_manager.ensure_indexes()
+        lot_stats_manager.ensure_indexes()
+        lot_archive_manager.ensure_indexes()
+        history_manager.ensure_indexes()
+        checkpoint_manager.ensure_indexes()
+        fifo_engine.ensure_indexes()
+        pnl_match_store.ensure_indexes()
+        idempotency_manager.ensure_indexes()
+    except Exception as e:
+        print(f"❌ Failed to ensure indexes: {e}")
+
+
+
+def _backfill_aggregates():
+    """Пересобирает материализованные агрегаты касс, которых ещё нет (касс с историей до их появления)"""
+    try:
+        rebuilt = desk_stats_manager.backfill()
+        if rebuilt:
+            print(f"🔧 Desk stats backfilled for {rebuilt} cash desks")
+    except Exception as e:
+        print(f"❌ Desk stats backfill failed: {e}")
+    try:
+        rebuilt = lot_stats_manager.backfill()
+        if rebuilt:
+            print(f"🔧 Lot stats backfilled for {rebuilt} cash desks")
+    except Exception as e:
+        print(f"❌ Lot stats backfill failed: {e}")
+
+
+@app.on_event("startup")
+async def start_aggregate_backfill():
+    """Запускает пересборку недостающих агрегатов в фоне, не задерживая запуск"""
+    asyncio.create_task(asyncio.to_thread(_backfill_aggregates))
+
+
+
+async def _prune_history_loop():
+    """Периодическая фоновая очистка снимков истории"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_PRUNE_INTERVAL_SECONDS)
+        try:
+            deleted = await asyncio.to_thread(history_manager.prune_all)
+            if deleted:
+                print(f"🧹 Background snapshot pruning removed {deleted} snapshots")
+        except Exception as e:
+            print(f"❌ Background snapshot pruning failed: {e}")
+
+
+@app.on_event("startup")
+async def start_history_pruning():
+    """Запускает фоновую очистку снимков"""
+    if SNAPSHOT_PRUNE_INTERVAL_SECONDS > 0:
+        asyncio.create_task(_prune_history_loop())
+
+
+async def _checkpoint_loop():
+    """Периодическое создание контрольных точек состояния касс"""
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL_SECONDS)
+        try:
+            created = await asyncio.to_thread(checkpoint_manager.run_due)
+            if created:
+                print(f"📍 Background checkpointing created {created} checkpoints")
+        except Exception as e:
+            print(f"❌ Background checkpointing failed: {e}")
+
+
+@app.on_event("startup")
+async def start_checkpointing():
+    """Запускает фоновое создание контрольных точек"""
+    if CHECKPOINT_INTERVAL_SECONDS > 0:
+        asyncio.create_task(_checkpoint_loop())
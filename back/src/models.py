@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 
 # Tenant Management Models
 class Tenant(BaseModel):
@@ -65,6 +65,20 @@ class TransactionUpdate(BaseModel):
     # Финансовые поля (amount, rate, asset, type) запрещены для изменения
     note: Optional[str] = None
 
+class TransactionBatch(BaseModel):
+    transactions: List[Transaction] = Field(..., description="Обмены одной кассы в порядке проведения")
+    atomic: bool = Field(default=True, description="Все или ничего: при ошибке любой позиции пакет отклоняется")
+
+class PreviewLadderRequest(BaseModel):
+    type: str                     # "crypto_to_fiat", "fiat_to_crypto", "fiat_to_fiat"
+    from_asset: str
+    to_asset: str
+    amount_from: Optional[float] = None           # Одна сумма, если amounts не передан
+    rate_used: Optional[float] = None             # Один курс, если rates не передан
+    amounts: Optional[List[float]] = None         # Суммы amount_from - строки сетки
+    rates: Optional[List[float]] = None           # Курсы - столбцы сетки
+    fee_percent: Optional[float] = 0.0
+
 class CashDeposit(BaseModel):
     tenant_id: Optional[str] = None  # Tenant isolation field (deprecated, use cash_desk_id)
     cash_desk_id: Optional[str] = None  # Фаза 2: Cash desk isolation field
@@ -0,0 +1,150 @@
+"""
+Модуль хранения денежных полей в Decimal128
+
+Балансы, остатки и курсы лотов, суммы транзакций и PnL матчей пишутся в MongoDB
+как Decimal128: $inc по балансам не накапливает двоичную погрешность, а $sum в
+агрегациях считается на сервере точно. Чтение прозрачно для приложения - драйвер
+отдаёт Decimal128 как float (utils/money.py), документы старого формата с double
+читаются так же. Миграция переводит уже сохранённые документы пакетами.
+"""
+from typing import Dict, Any, List, Optional
+from bson.codec_options import CodecOptions
+from pymongo import UpdateOne
+from .db import db
+from .constants import MONEY_DECIMAL128
+from .utils.money import to_decimal128
+
+MIGRATION_BATCH_SIZE = 1000
+
+# Денежные поля по коллекциям (вложенные - через точку)
+MONEY_FIELDS: Dict[str, List[str]] = {
+    "cash": ["balance"],
+    "transactions": [
+        "amount_from", "amount_to_clean", "amount_to_final", "fee_amount",
+        "profit", "realized_profit", "realized_profit_usdt", "cost_usdt_of_fiat_in"
+    ],
+    "fiat_lots": ["remaining", "rate", "meta.cost_usdt_of_fiat_in"],
+    "fiat_lots_archive": ["remaining", "rate", "meta.cost_usdt_of_fiat_in"],
+    "pnl_matches": [
+        "fiat_used", "matched_usdt", "lot_rate", "sell_rate_eff",
+        "pnl_fiat", "pnl_usdt", "cost_usdt_of_fiat_in"
+    ],
+    # Поля кусков корзины - через точку по элементам массива pieces
+    "pnl_match_buckets": [
+        "fiat_used", "matched_usdt", "pnl_fiat", "pnl_usdt", "sell_rate_eff",
+        "pieces.fiat_used", "pieces.matched_usdt", "pieces.lot_rate",
+        "pieces.pnl_fiat", "pieces.pnl_usdt", "pieces.cost_usdt_of_fiat_in"
+    ]
+}
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _encode_items(items: list, child: str) -> list:
+    """Копия массива поддокументов с полем child в Decimal128"""
+    return [
+        {**item, child: to_decimal128(item[child])} if isinstance(item, dict) and _is_number(item.get(child)) else item
+        for item in items
+    ]
+
+
+class MoneyStorageManager:
+    """Запись денежных полей в Decimal128 и миграция старых документов"""
+
+    @staticmethod
+    def value(amount):
+        """Значение для $set / $inc денежного поля"""
+        if not MONEY_DECIMAL128 or not _is_number(amount):
+            return amount
+        return to_decimal128(amount)
+
+    @staticmethod
+    def encode(collection: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Копия документа (или набора полей для $set) с денежными полями в Decimal128.
+        Исходный документ не меняется - он может жить в книге лотов или в ответе API
+        """
+        fields = MONEY_FIELDS.get(collection)
+        if not MONEY_DECIMAL128 or not fields:
+            return doc
+        encoded = dict(doc)
+        for field in fields:
+            if "." in field:
+                parent, child = field.split(".", 1)
+                nested = encoded.get(parent)
+                if isinstance(nested, dict) and _is_number(nested.get(child)):
+                    encoded[parent] = {**nested, child: to_decimal128(nested[child])}
+                elif isinstance(nested, list):
+                    encoded[parent] = _encode_items(nested, child)
+            elif _is_number(encoded.get(field)):
+                encoded[field] = to_decimal128(encoded[field])
+        return encoded
+
+    @staticmethod
+    def encode_many(collection: str, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [MoneyStorageManager.encode(collection, doc) for doc in docs]
+
+    @staticmethod
+    def migrate(collection: Optional[str] = None, dry_run: bool = True) -> Dict[str, int]:
+        """
+        Переводит денежные поля сохранённых документов из double/int в Decimal128
+
+        Args:
+            collection: Одна коллекция из MONEY_FIELDS (по умолчанию все)
+            dry_run: Только посчитать документы, которые нужно перевести
+
+        Returns:
+            {коллекция: количество документов со старыми числовыми полями (или переведённых)}.
+            Документ, изменённый во время миграции, пропускается - его переведёт повторный запуск
+        """
+        collections = [collection] if collection else list(MONEY_FIELDS)
+        # Без декодера Decimal128 уже переведённые поля видны как Decimal128, а не float
+        raw_options = CodecOptions()
+        counts = {}
+        for name in collections:
+            fields = MONEY_FIELDS[name]
+            filter_criteria = {"$or": [{field: {"$type": ["double", "int", "long"]}} for field in fields]}
+            raw = db[name].with_options(codec_options=raw_options)
+            if dry_run:
+                counts[name] = raw.count_documents(filter_criteria)
+                continue
+
+            converted = 0
+            operations = []
+            # Массивы читаются целиком - они перезаписываются полностью
+            projection = {field.split(".", 1)[0]: 1 for field in fields}
+            cursor = raw.find(filter_criteria, projection).batch_size(MIGRATION_BATCH_SIZE)
+            for doc in cursor:
+                update = {}
+                expected = {"_id": doc["_id"]}  # поле, изменённое после чтения, не перезаписываем
+                for field in fields:
+                    parent, _, child = field.partition(".")
+                    if child and isinstance(doc.get(parent), list):
+                        items = update.get(parent, doc[parent])
+                        encoded_items = _encode_items(items, child)
+                        if encoded_items != items:
+                            update[parent] = encoded_items
+                            expected[parent] = doc[parent]
+                        continue
+                    value = doc
+                    for part in field.split("."):
+                        value = value.get(part) if isinstance(value, dict) else None
+                    if _is_number(value):
+                        update[field] = to_decimal128(value)
+                        expected[field] = value
+                if update:
+                    operations.append(UpdateOne(expected, {"$set": update}))
+                if len(operations) >= MIGRATION_BATCH_SIZE:
+                    converted += raw.bulk_write(operations, ordered=False).modified_count
+                    operations = []
+            if operations:
+                converted += raw.bulk_write(operations, ordered=False).modified_count
+            counts[name] = converted
+            print(f"💱 Migrated {converted} documents of {name} to Decimal128")
+        return counts
+
+
+# Глобальный экземпляр
+money_storage = MoneyStorageManager()
@@ -0,0 +1,182 @@
+"""
+Модуль хранения матчей PnL (pnl_matches и pnl_match_buckets)
+
+Продажа, списавшая N лотов, даёт N кусков PnL. В раскладке по документам каждый кусок -
+отдельный документ pnl_matches с повторяющимися tenant/касса/валюта/курс продажи.
+В раскладке по корзинам (PNL_MATCH_BUCKETS) закрывающая транзакция даёт один документ
+pnl_match_buckets: _id - ID транзакции, общие поля один раз, куски - массивом pieces,
+суммы кусков посчитаны заранее. Чтение объединяет обе коллекции и отдаёт куски
+в прежнем виде отдельных матчей, поэтому документы старого формата читаются как раньше.
+"""
+from typing import Dict, Any, List, Optional, Tuple
+from bson import ObjectId
+from .db import db
+from .constants import PNL_MATCH_BUCKETS
+from .money_storage import money_storage
+from .utils.money import to_units, from_units, WORK_SCALE
+
+# Поля, общие для всех кусков одной закрывающей транзакции
+BUCKET_FIELDS = ["tenant_id", "cash_desk_id", "currency", "sell_rate_eff", "created_at"]
+
+# Суммы кусков, хранимые в корзине
+TOTAL_FIELDS = ["fiat_used", "matched_usdt", "pnl_fiat", "pnl_usdt"]
+
+
+def _bucket_id(close_tx_id) -> Optional[ObjectId]:
+    if isinstance(close_tx_id, ObjectId):
+        return close_tx_id
+    if isinstance(close_tx_id, str) and ObjectId.is_valid(close_tx_id):
+        return ObjectId(close_tx_id)
+    return None
+
+
+class PnlMatchStore:
+    """Запись и чтение матчей PnL в обеих раскладках"""
+
+    @staticmethod
+    def ensure_indexes():
+        """Корзины по кассе и по tenant'у с валютой (корзина транзакции читается по _id)"""
+        db.pnl_match_buckets.create_index([("cash_desk_id", 1), ("currency", 1)])
+        db.pnl_match_buckets.create_index([("tenant_id", 1), ("currency", 1)])
+
+    @staticmethod
+    def layout(matches: List[dict]) -> Tuple[List[dict], List[dict]]:
+        """
+        Раскладывает матчи FIFO-движка по коллекциям
+
+        Returns:
+            (документы pnl_matches, корзины pnl_match_buckets). Без PNL_MATCH_BUCKETS или без
+            ссылки на закрывающую транзакцию матчи остаются отдельными документами
+        """
+        if not PNL_MATCH_BUCKETS:
+            return list(matches), []
+        documents = []
+        buckets: Dict[ObjectId, dict] = {}
+        for match in matches:
+            bucket_id = _bucket_id(match.get("close_tx_id"))
+            if bucket_id is None:
+                documents.append(match)
+                continue
+            bucket = buckets.get(bucket_id)
+            if bucket is None:
+                bucket = {"_id": bucket_id, **{field: match.get(field) for field in BUCKET_FIELDS}, "pieces": []}
+                buckets[bucket_id] = bucket
+            excluded = {"_id", "close_tx_id", *BUCKET_FIELDS}
+            bucket["pieces"].append({k: v for k, v in match.items() if k not in excluded})
+
+        for bucket in buckets.values():
+            pieces = bucket["pieces"]
+            bucket["pieces_count"] = len(pieces)
+            # Суммы - в рабочих единицах, без накопления погрешности float
+            for field in TOTAL_FIELDS:
+                bucket[field] = from_units(sum(to_units(piece.get(field) or 0, WORK_SCALE) for piece in pieces), WORK_SCALE)
+        return documents, list(buckets.values())
+
+    @staticmethod
+    def insert(matches: List[dict], session=None) -> Dict[str, list]:
+        """
+        Записывает матчи одной или нескольких транзакций
+
+        Returns:
+            ID вставленных документов по коллекциям - для журнала снимка
+        """
+        documents, buckets = PnlMatchStore.layout(matches)
+        inserted = {}
+        if documents:
+            db.pnl_matches.insert_many(money_storage.encode_many("pnl_matches", documents), session=session)
+            inserted["pnl_matches"] = [match["_id"] for match in documents]
+        if buckets:
+            db.pnl_match_buckets.insert_many(money_storage.encode_many("pnl_match_buckets", buckets), session=session)
+            inserted["pnl_match_buckets"] = [bucket["_id"] for bucket in buckets]
+        return inserted
+
+    @staticmethod
+    def _expand(bucket: dict) -> List[dict]:
+        """Куски корзины в виде отдельных матчей (_id куска - ID транзакции и номер куска)"""
+        common = {field: bucket.get(field) for field in BUCKET_FIELDS}
+        close_tx_id = str(bucket["_id"])
+        return [
+            {"_id": f"{close_tx_id}-{index}", **common, "close_tx_id": close_tx_id, **piece}
+            for index, piece in enumerate(bucket.get("pieces") or [])
+        ]
+
+    @staticmethod
+    def find(filter_criteria: dict) -> List[dict]:
+        """Матчи по фильтру (поля корзины: tenant_id, cash_desk_id, currency) из обеих раскладок, _id строкой"""
+        matches = list(db.pnl_matches.find(filter_criteria))
+        for match in matches:
+            match["_id"] = str(match["_id"])
+        for bucket in db.pnl_match_buckets.find(filter_criteria).sort([("created_at", 1), ("_id", 1)]):
+            matches.extend(PnlMatchStore._expand(bucket))
+        return matches
+
+    @staticmethod
+    def for_transaction(transaction_id: str, tenant_id: str) -> List[dict]:
+        """Матчи, закрытые транзакцией, в порядке этапов FIFO"""
+        matches = list(
+            db.pnl_matches.find({"close_tx_id": transaction_id, "tenant_id": tenant_id}).sort([("stage", 1), ("_id", 1)])
+        )
+        for match in matches:
+            match["_id"] = str(match["_id"])
+        bucket_id = _bucket_id(transaction_id)
+        if bucket_id is not None:
+            bucket = db.pnl_match_buckets.find_one({"_id": bucket_id, "tenant_id": tenant_id})
+            if bucket:
+                matches.extend(PnlMatchStore._expand(bucket))
+        return matches
+
+    @staticmethod
+    def rows_pipeline(filter_criteria: dict) -> List[dict]:
+        """
+        Стадии агрегации по pnl_matches: строки {currency, pnl_fiat, pnl_usdt, pieces_count}
+        из отдельных матчей и (через $unionWith) из готовых сумм корзин
+        """
+        fields = {"currency": 1, "pnl_fiat": 1, "pnl_usdt": 1}
+        return [
+            {"$match": filter_criteria},
+            {"$project": {**fields, "pieces_count": {"$literal": 1}}},
+            {"$unionWith": {"coll": "pnl_match_buckets", "pipeline": [
+                {"$match": filter_criteria},
+                {"$project": {**fields, "pieces_count": 1}}
+            ]}}
+        ]
+
+    @staticmethod
+    def totals(filter_criteria: dict) -> Dict[str, Any]:
+        """Суммарный PnL и количество кусков по фильтру - на стороне MongoDB"""
+        pipeline = PnlMatchStore.rows_pipeline(filter_criteria) + [
+            {"$group": {
+                "_id": None,
+                "pnl_fiat": {"$sum": "$pnl_fiat"},
+                "pnl_usdt": {"$sum": "$pnl_usdt"},
+                "count": {"$sum": "$pieces_count"}
+            }}
+        ]
+        row = next(db.pnl_matches.aggregate(pipeline), None)
+        if not row:
+            return {"pnl_fiat": 0.0, "pnl_usdt": 0.0, "count": 0}
+        return {"pnl_fiat": row["pnl_fiat"], "pnl_usdt": row["pnl_usdt"], "count": row["count"]}
+
+    @staticmethod
+    def count(filter_criteria: dict) -> int:
+        """Количество кусков PnL по фильтру"""
+        return PnlMatchStore.totals(filter_criteria)["count"]
+
+    @staticmethod
+    def clear(filter_criteria: dict) -> int:
+        """
+        Удаляет матчи по фильтру из обеих раскладок
+
+        Returns:
+            Количество удалённых кусков PnL
+        """
+        pieces = sum(
+            bucket.get("pieces_count", 0)
+            for bucket in db.pnl_match_buckets.find(filter_criteria, {"pieces_count": 1})
+        )
+        db.pnl_match_buckets.delete_many(filter_criteria)
+        return db.pnl_matches.delete_many(filter_criteria).deleted_count + pieces
+
+
+# Глобальный экземпляр
+pnl_match_store = PnlMatchStore()
@@ -0,0 +1,72 @@
+"""
+Модуль кэша результатов предпросмотра обмена
+
+Небольшой LRU в памяти процесса. Ключ включает версию кассы (desk_versions),
+поэтому повторный предпросмотр неизменной кассы отдаётся из памяти, а после любой
+записи в балансы или лоты кассы старые результаты больше не находятся и
+вытесняются при следующем сохранении.
+"""
+import copy
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from .constants import PREVIEW_CACHE_SIZE
+
+
+class PreviewCache:
+    """LRU результатов предпросмотра по (касса, версия кассы, параметры обмена)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._desk_versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(cash_desk_id: str, version: int, tx_type: str, from_asset: str, to_asset: str,
+                 amount_from: float, rate_used: float, fee_percent: Optional[float]) -> tuple:
+        return (cash_desk_id, version, tx_type, from_asset, to_asset,
+                float(amount_from), float(rate_used), float(fee_percent or 0.0))
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        """Копия сохранённого результата или None"""
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(result)
+
+    def put(self, key: tuple, result: Dict[str, Any]):
+        """Сохраняет результат; записи прошлых версий кассы удаляются сразу"""
+        if self.max_size <= 0:
+            return
+        cash_desk_id, version = key[0], key[1]
+        with self._lock:
+            known_version = self._desk_versions.get(cash_desk_id)
+            if known_version is not None and known_version > version:
+                # Результат посчитан по уже устаревшей версии кассы
+                return
+            if known_version is not None and known_version < version:
+                for stale_key in [k for k in self._entries if k[0] == cash_desk_id]:
+                    del self._entries[stale_key]
+            self._desk_versions[cash_desk_id] = version
+
+            self._entries[key] = copy.deepcopy(result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+# Глобальный экземпляр
+preview_cache = PreviewCache(PREVIEW_CACHE_SIZE)
@@ -0,0 +1,202 @@
+"""
+Модуль лестницы котировок для предпросмотра обмена
+
+Считает сетку "суммы × курсы" одним проходом NumPy: суммы к выдаче, комиссии и
+прогноз реализованной прибыли по FIFO. Книга лотов загружается один раз, а списание
+для каждой ячейки сетки вычисляется по кумулятивным суммам остатков лотов
+(searchsorted по накопленному остатку вместо цикла по лотам).
+"""
+from typing import Dict, Any, List
+import numpy as np
+from .db import db
+from .constants import FIAT_ASSETS, SPECIAL_FIAT
+from .lot_book_cache import lot_book_cache
+
+EPS = 0.0000001
+
+
+class PreviewLadder:
+    """Векторный расчёт предпросмотра обмена по сетке сумм и курсов"""
+
+    @staticmethod
+    def price_grid(tx_type: str, from_asset: str, to_asset: str, amounts: np.ndarray, rates: np.ndarray, fee_percent: float) -> Dict[str, np.ndarray]:
+        """
+        Суммы и комиссии для каждой пары (сумма, курс) - та же логика, что и при создании обмена
+
+        Returns:
+            {amount_to_clean, amount_to_final, fee_amount} - матрицы len(amounts) × len(rates)
+        """
+        amount = amounts[:, None]
+        rate = rates[None, :]
+
+        if tx_type == "fiat_to_crypto" and from_asset in SPECIAL_FIAT:
+            clean = amount / rate
+        elif tx_type == "crypto_to_fiat" and to_asset in SPECIAL_FIAT:
+            clean = amount * rate
+        elif tx_type == "crypto_to_fiat" and to_asset == "EUR":
+            clean = amount / rate
+        elif tx_type == "fiat_to_fiat":
+            clean = amount * rate if to_asset == "CZK" else amount / rate
+        else:
+            clean = amount * rate
+
+        # np.round, как и round(), округляет половины к чётному
+        if tx_type == "crypto_to_fiat":
+            fee = clean * (fee_percent / 100)
+            final = np.round(clean + fee)
+        elif tx_type == "fiat_to_crypto":
+            final = np.round(clean / (1 + (fee_percent / 100)))
+            fee = clean - final
+        else:
+            final = np.round(clean)
+            fee = np.zeros_like(clean)
+
+        return {"amount_to_clean": clean, "amount_to_final": final, "fee_amount": fee}
+
+    @staticmethod
+    def _consume(need: np.ndarray, remaining: np.ndarray, weights: np.ndarray):
+        """
+        Списание по FIFO для каждой ячейки need через кумулятивные суммы
+
+        Args:
+            need: Сколько фиата нужно списать (матрица)
+            remaining: Остатки лотов в порядке FIFO
+            weights: Вес единицы фиата каждого лота (курс, себестоимость и т.п.)
+
+        Returns:
+            (списано, Σ weight·take, количество затронутых лотов)
+        """
+        if remaining.size == 0:
+            zeros = np.zeros_like(need)
+            return zeros, zeros, np.zeros(need.shape, dtype=int)
+
+        cum = np.cumsum(remaining)
+        cum_weighted = np.cumsum(weights * remaining)
+
+        # Лоты, накопленный остаток которых покрыт потребностью, списываются целиком
+        full = np.searchsorted(cum, need, side="right")
+        prev = np.where(full > 0, cum[full - 1], 0.0)
+        prev_weighted = np.where(full > 0, cum_weighted[full - 1], 0.0)
+
+        # Следующий лот списывается частично
+        has_next = full < remaining.size
+        next_index = np.minimum(full, remaining.size - 1)
+        partial = np.where(has_next, np.clip(need - prev, 0.0, remaining[next_index]), 0.0)
+
+        taken = prev + partial
+        weighted = prev_weighted + partial * weights[next_index]
+        lots_used = full + (partial > EPS)
+        return taken, weighted, lots_used
+
+    @staticmethod
+    def _lot_arrays(lots: List[dict], source: str = None):
+        """Остатки, курсы и себестоимости лотов (опционально одного источника) в порядке FIFO"""
+        selected = [lot for lot in lots if source is None or (lot.get("meta") or {}).get("source") == source]
+        remaining = np.array([lot["remaining"] for lot in selected], dtype=float)
+        rate = np.array([lot["rate"] for lot in selected], dtype=float)
+        cost = np.array([(lot.get("meta") or {}).get("cost_usdt_of_fiat_in", 0) or 0 for lot in selected], dtype=float)
+        return remaining, rate, cost
+
+    @staticmethod
+    def calculate(
+        cash_desk_id: str,
+        tx_type: str,
+        from_asset: str,
+        to_asset: str,
+        amounts: List[float],
+        rates: List[float],
+        fee_percent: float = 0.0
+    ) -> Dict[str, Any]:
+        """
+        Сетка предпросмотра: строки - суммы amount_from, столбцы - курсы
+
+        Returns:
+            Матрицы сумм, комиссий, прогноза прибыли и достаточности кассы
+        """
+        amounts_arr = np.asarray(amounts, dtype=float)
+        rates_arr = np.asarray(rates, dtype=float)
+        if tx_type == "fiat_to_fiat":
+            fee_percent = 0.0
+
+        grid = PreviewLadder.price_grid(tx_type, from_asset, to_asset, amounts_arr, rates_arr, fee_percent)
+        amount_from = np.broadcast_to(amounts_arr[:, None], grid["amount_to_final"].shape)
+        final = grid["amount_to_final"]
+
+        realized_profit = np.zeros_like(final)
+        realized_profit_usdt = np.zeros_like(final)
+        lots_used = np.zeros(final.shape, dtype=int)
+        cost_usdt = None
+        lots_loaded = 0
+
+        if tx_type == "crypto_to_fiat":
+            profit_currency = to_asset
+        elif tx_type == "fiat_to_crypto":
+            profit_currency = from_asset
+        else:
+            profit_currency = "USDT"
+
+        # Книга лотов загружается один раз на всю сетку - до покрытия самой крупной ячейки
+        if tx_type == "crypto_to_fiat" and from_asset == "USDT" and to_asset in FIAT_ASSETS:
+            lots = lot_book_cache.open_lots(cash_desk_id, to_asset, float(final.max()))
+            lots_loaded = len(lots)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sell_rate_eff = np.where(amount_from > 0, final / amount_from, 0.0)
+
+                # Этап 1: живые лоты, прибыль (lot_rate - sell_rate) · take / sell_rate
+                remaining, rate, _ = PreviewLadder._lot_arrays(lots, "fiat_to_crypto")
+                taken1, rate_value, used1 = PreviewLadder._consume(final, remaining, rate)
+                pnl_fiat1 = np.where(sell_rate_eff > 0, rate_value / sell_rate_eff - taken1, 0.0)
+                pnl_usdt1 = np.where(sell_rate_eff > 0, pnl_fiat1 / sell_rate_eff, 0.0)
+
+                # Этап 2: лоты обменных пунктов, себестоимость в USDT пропорциональна доле остатка
+                remaining, _, cost = PreviewLadder._lot_arrays(lots, "fiat_to_fiat")
+                cost_per_fiat = np.where(remaining > 0, cost / np.where(remaining > 0, remaining, 1.0), 0.0)
+                taken2, cost_value, used2 = PreviewLadder._consume(final - taken1, remaining, cost_per_fiat)
+                pnl_usdt2 = np.where(sell_rate_eff > 0, taken2 / sell_rate_eff - cost_value, 0.0)
+                pnl_fiat2 = pnl_usdt2 * sell_rate_eff
+
+            realized_profit = np.round(pnl_fiat1 + pnl_fiat2, 2)
+            realized_profit_usdt = np.round(pnl_usdt1 + pnl_usdt2, 4)
+            lots_used = used1 + used2
+
+        elif tx_type == "fiat_to_fiat" and from_asset in FIAT_ASSETS:
+            # Себестоимость получаемой валюты в USDT по лотам любого источника
+            lots = lot_book_cache.open_lots(cash_desk_id, from_asset, float(amounts_arr.max()))
+            lots_loaded = len(lots)
+            remaining, rate, _ = PreviewLadder._lot_arrays(lots)
+            _, cost_usdt, lots_used = PreviewLadder._consume(amount_from, remaining, 1.0 / rate)
+            cost_usdt = np.round(cost_usdt, 4)
+
+        # Достаточность кассы для каждой ячейки
+        balances = {row["asset"]: row["balance"] for row in db.cash.find({"cash_desk_id": cash_desk_id})}
+        if tx_type == "fiat_to_fiat":
+            sufficient = amount_from <= balances.get(from_asset, 0.0)
+        else:
+            sufficient = final <= balances.get(to_asset, 0.0)
+
+        result = {
+            "type": tx_type,
+            "from_asset": from_asset,
+            "to_asset": to_asset,
+            "fee_percent": fee_percent,
+            "amounts": amounts_arr.tolist(),
+            "rates": rates_arr.tolist(),
+            "profit_currency": profit_currency,
+            "lots_loaded": lots_loaded,
+            "grid": {
+                "amount_to_clean": np.round(grid["amount_to_clean"], 8).tolist(),
+                "amount_to_final": final.tolist(),
+                "fee_amount": np.round(grid["fee_amount"], 8).tolist(),
+                "realized_profit": realized_profit.tolist(),
+                "realized_profit_usdt": realized_profit_usdt.tolist(),
+                "lots_used": lots_used.tolist(),
+                "sufficient_cash": sufficient.tolist()
+            }
+        }
+        if cost_usdt is not None:
+            result["grid"]["cost_usdt_of_fiat_in"] = cost_usdt.tolist()
+        return result
+
+
+# Глобальный экземпляр
+preview_ladder = PreviewLadder()
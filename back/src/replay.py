@@ -0,0 +1,337 @@
+"""
+Модуль пересборки кассы по журналу транзакций (replay)
+
+Транзакции кассы читаются по порядку (created_at, _id) пакетами курсора и
+проигрываются через FIFO-движок в памяти. Из результата строятся лоты, матчи PnL,
+производные поля транзакций и балансы; они сравниваются с сохранёнными данными,
+и в базу пишутся только отличия - bulk_write на коллекцию в одной транзакции.
+Режим dry_run только проверяет согласованность и возвращает отчёт.
+"""
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+from pymongo import UpdateOne, DeleteOne
+from .db import db
+from .fifo_engine import fifo_engine, LotBook, EXCHANGE_TYPES
+from .history_manager import history_manager
+from .desk_versions import desk_version_manager
+from .lot_stats import lot_stats_manager
+from .money_storage import money_storage
+from .pnl_match_store import pnl_match_store
+from .utils.transaction_utils import transaction_cash_flows
+
+REPLAY_BATCH_SIZE = 1000
+BALANCE_EPS = 0.0000001
+
+# Поля транзакции, которые вычисляет FIFO-движок
+DERIVED_TX_FIELDS = [
+    "profit", "profit_currency", "realized_profit", "realized_profit_usdt",
+    "cost_usdt_of_fiat_in", "rate_usdt_of_fiat_in"
+]
+
+
+class ReplayManager:
+    """Пересборка лотов, матчей и балансов кассы из её транзакций"""
+
+    @staticmethod
+    def regenerate(
+        cash_desk_id: str,
+        book: Optional[LotBook] = None,
+        balances: Optional[Dict[str, float]] = None,
+        profit: Optional[Dict[str, float]] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        """
+        Проигрывает транзакции кассы в памяти
+
+        Args:
+            cash_desk_id: ID кассы
+            book, balances, profit: Начальное состояние (например, из контрольной точки); по умолчанию пустое
+            since: Проигрывать только транзакции позже этого момента
+            until: Проигрывать только транзакции не позже этого момента
+
+        Returns:
+            {count, book, lots, matches, changed_txs, balances, profit}
+        """
+        book = book if book is not None else LotBook()
+        balances = dict(balances or {})
+        profit = dict(profit or {})
+        lots, matches = [], []
+        changed_txs = []  # (сохранённая транзакция, изменившиеся производные поля)
+        count = 0
+
+        filter_criteria = {"cash_desk_id": cash_desk_id}
+        created_at = {}
+        if since:
+            created_at["$gt"] = since
+        if until:
+            created_at["$lte"] = until
+        if created_at:
+            filter_criteria["created_at"] = created_at
+
+        cursor = db.transactions.find(filter_criteria).sort(
+            [("created_at", 1), ("_id", 1)]
+        ).batch_size(REPLAY_BATCH_SIZE)
+
+        for tx in cursor:
+            count += 1
+            if tx.get("type") in EXCHANGE_TYPES:
+                # Сохранённые производные поля - результат прошлого расчёта, а не вход движка
+                inputs = {field: value for field, value in tx.items() if field not in DERIVED_TX_FIELDS}
+                result = fifo_engine.apply(inputs, book, tx.get("created_at") or datetime.utcnow())
+                lots.extend(result["new_lots"])
+                matches.extend(result["matches"])
+                flows = result["cash_deltas"]
+                derived = {**result, "profit": result["realized_profit"]}
+                changes = {
+                    field: derived[field]
+                    for field in DERIVED_TX_FIELDS
+                    if tx.get(field) != derived[field]
+                }
+                if changes:
+                    changed_txs.append((tx, changes))
+                if result["profit_currency"] and result["realized_profit"]:
+                    currency = result["profit_currency"]
+                    profit[currency] = profit.get(currency, 0.0) + result["realized_profit"]
+            else:
+                flows = transaction_cash_flows(tx)
+            for asset, delta in flows:
+                if asset:
+                    balances[asset] = balances.get(asset, 0.0) + delta
+
+        return {
+            "count": count,
+            "book": book,
+            "lots": lots,
+            "matches": matches,
+            "changed_txs": changed_txs,
+            "balances": balances,
+            "profit": profit
+        }
+
+    @staticmethod
+    def _align(generated: List[dict], existing: List[dict], key) -> Dict[Any, dict]:
+        """
+        Сопоставляет i-й сгенерированный документ группы с i-м сохранённым документом той же группы
+        (в порядке создания), чтобы согласованные данные сохраняли свои _id и created_at
+
+        Returns:
+            {_id сгенерированного документа: сохранённый документ}
+        """
+        groups = {}
+        for doc in sorted(existing, key=lambda d: (d["created_at"], str(d["_id"]))):
+            groups.setdefault(key(doc), []).append(doc)
+        positions = {}
+        pairs = {}
+        for doc in generated:
+            group = key(doc)
+            index = positions.get(group, 0)
+            positions[group] = index + 1
+            candidates = groups.get(group, [])
+            if index < len(candidates):
+                pairs[doc["_id"]] = candidates[index]
+        return pairs
+
+    @staticmethod
+    def _changed_ids(current_docs: list, target_docs: list) -> set:
+        """ID документов, которые изменит diff_operations (отличающиеся, новые и лишние)"""
+        current = {doc["_id"]: doc for doc in current_docs}
+        target_ids = {doc["_id"] for doc in target_docs}
+        changed = {doc["_id"] for doc in target_docs if current.get(doc["_id"]) != doc}
+        return changed | (set(current) - target_ids)
+
+    @staticmethod
+    def _count_operations(operations: list) -> Dict[str, int]:
+        deletes = sum(1 for op in operations if isinstance(op, DeleteOne))
+        return {"upserts": len(operations) - deletes, "deletes": deletes}
+
+    @staticmethod
+    def replay_desk(cash_desk_id: str, tenant_id: str, dry_run: bool = True, rebuild_cash: bool = False) -> Dict[str, Any]:
+        """
+        Пересобирает производные данные кассы по её транзакциям
+
+        Args:
+            cash_desk_id: ID кассы
+            tenant_id: ID tenant'а
+            dry_run: Только сравнить и вернуть отчёт, ничего не записывая
+            rebuild_cash: Перезаписать балансы кассы рассчитанными по транзакциям
+                (балансы, выставленные вручную через /cash/set, транзакций не имеют)
+
+        Returns:
+            Отчёт о расхождениях и применённых изменениях
+        """
+        # Версия читается до проигрывания: запись в кассу во время пересборки отменит её (409)
+        version = desk_version_manager.get(cash_desk_id)
+        replayed = ReplayManager.regenerate(cash_desk_id)
+        desk_filter = {"cash_desk_id": cash_desk_id}
+        now = datetime.utcnow()
+
+        # --- Лоты: рабочие в fiat_lots, исчерпанные - в архиве ---
+        hot_lots = list(db.fiat_lots.find(desk_filter))
+        archived_lots = list(db.fiat_lots_archive.find(desk_filter))
+        hot_ids = {lot["_id"] for lot in hot_lots}
+        archived_by_id = {lot["_id"]: lot for lot in archived_lots}
+
+        lot_pairs = ReplayManager._align(
+            replayed["lots"], hot_lots + archived_lots,
+            lambda lot: (lot["currency"], (lot.get("meta") or {}).get("source"))
+        )
+        lot_id_map = {}
+        for lot in replayed["lots"]:
+            stored = lot_pairs.get(lot["_id"])
+            if stored:
+                lot_id_map[str(lot["_id"])] = str(stored["_id"])
+                lot["_id"] = stored["_id"]
+                lot["created_at"] = stored["created_at"]
+
+        target_hot, target_archive = [], []
+        for lot in replayed["lots"]:
+            if lot["remaining"] > 0 or lot["_id"] in hot_ids:
+                # Исчерпанный лот, ещё не перенесённый в архив, остаётся на месте
+                target_hot.append(lot)
+            else:
+                stored = archived_by_id.get(lot["_id"])
+                target_archive.append({**lot, "archived_at": stored["archived_at"] if stored else now})
+
+        # --- Матчи PnL: отдельные документы и корзины закрывающих транзакций ---
+        stored_matches = list(db.pnl_matches.find(desk_filter))
+        stored_buckets = list(db.pnl_match_buckets.find(desk_filter))
+        match_pairs = ReplayManager._align(replayed["matches"], stored_matches, lambda match: match["currency"])
+        for match in replayed["matches"]:
+            match["open_lot_id"] = lot_id_map.get(match["open_lot_id"], match["open_lot_id"])
+            stored = match_pairs.get(match["_id"])
+            if stored:
+                match["_id"] = stored["_id"]
+                match["created_at"] = stored["created_at"]
+        # Матчи со ссылкой на транзакцию переходят в корзины текущей раскладки
+        target_matches, target_buckets = pnl_match_store.layout(replayed["matches"])
+        buckets_by_id = {bucket["_id"]: bucket for bucket in stored_buckets}
+        for bucket in target_buckets:
+            stored = buckets_by_id.get(bucket["_id"])
+            if stored:
+                bucket["created_at"] = stored["created_at"]
+
+        operations = {
+            "fiat_lots": history_manager.diff_operations(hot_lots, target_hot, collection="fiat_lots"),
+            "fiat_lots_archive": history_manager.diff_operations(
+                archived_lots, target_archive, collection="fiat_lots_archive"
+            ),
+            "pnl_matches": history_manager.diff_operations(stored_matches, target_matches, collection="pnl_matches"),
+            "pnl_match_buckets": history_manager.diff_operations(
+                stored_buckets, target_buckets, collection="pnl_match_buckets"
+            )
+        }
+
+        # --- Производные поля транзакций ---
+        tx_operations = [
+            UpdateOne({"_id": tx["_id"]}, {"$set": money_storage.encode("transactions", changes)})
+            for tx, changes in replayed["changed_txs"]
+        ]
+        operations["transactions"] = tx_operations
+
+        # --- Балансы ---
+        stored_cash = {row["asset"]: row for row in db.cash.find(desk_filter)}
+        cash_report = []
+        for asset in sorted(set(stored_cash) | set(replayed["balances"])):
+            stored_balance = (stored_cash.get(asset) or {}).get("balance", 0.0)
+            replayed_balance = replayed["balances"].get(asset, 0.0)
+            if abs(stored_balance - replayed_balance) > BALANCE_EPS:
+                cash_report.append({
+                    "asset": asset,
+                    "stored": stored_balance,
+                    "replayed": replayed_balance,
+                    "difference": replayed_balance - stored_balance
+                })
+        if rebuild_cash:
+            operations["cash"] = [
+                UpdateOne(
+                    {"asset": row["asset"], "cash_desk_id": cash_desk_id},
+                    {
+                        "$set": {"balance": money_storage.value(row["replayed"]), "updated_at": now},
+                        "$setOnInsert": {"tenant_id": tenant_id}
+                    },
+                    upsert=True
+                )
+                for row in cash_report
+            ]
+
+        report = {
+            "cash_desk_id": cash_desk_id,
+            "dry_run": dry_run,
+            "transactions_replayed": replayed["count"],
+            "changes": {
+                "fiat_lots": ReplayManager._count_operations(operations["fiat_lots"]),
+                "fiat_lots_archive": ReplayManager._count_operations(operations["fiat_lots_archive"]),
+                "pnl_matches": ReplayManager._count_operations(operations["pnl_matches"]),
+                "pnl_match_buckets": ReplayManager._count_operations(operations["pnl_match_buckets"]),
+                "transactions": len(tx_operations)
+            },
+            "cash": cash_report,
+            "cash_rebuilt": bool(rebuild_cash and cash_report),
+            "consistent": not any(operations.values()) and not cash_report,
+            "snapshot_id": None
+        }
+        if dry_run or not any(operations.values()):
+            return report
+
+        # --- Журнал для отмены: исходные версии меняемых документов и ID новых ---
+        touched_lot_ids = (
+            ReplayManager._changed_ids(hot_lots, target_hot)
+            | ReplayManager._changed_ids(archived_lots, target_archive)
+        )
+        before_lots = [lot for lot in hot_lots if lot["_id"] in touched_lot_ids]
+        before_lots += [
+            {k: v for k, v in lot.items() if k != "archived_at"}
+            for lot in archived_lots
+            if lot["_id"] in touched_lot_ids and lot["_id"] not in hot_ids
+        ]
+        touched_match_ids = ReplayManager._changed_ids(stored_matches, target_matches)
+        stored_match_ids = {match["_id"] for match in stored_matches}
+        touched_bucket_ids = ReplayManager._changed_ids(stored_buckets, target_buckets)
+        known_lot_ids = hot_ids | set(archived_by_id)
+
+        cash_assets = [row["asset"] for row in cash_report] if rebuild_cash else []
+        written = {}
+
+        def apply(session):
+            # Исходные строки кассы - из той же транзакции, что и перезапись балансов
+            written["cash"] = (
+                history_manager.cash_images(tenant_id, cash_desk_id, cash_assets, session=session) if cash_assets else []
+            )
+            for collection, collection_operations in operations.items():
+                if collection_operations:
+                    db[collection].bulk_write(collection_operations, ordered=False, session=session)
+            if operations["fiat_lots"]:
+                # Агрегаты лотов пересобираются вместе с переписанными лотами
+                lot_stats_manager.rebuild(cash_desk_id, tenant_id, session=session)
+            desk_version_manager.advance(cash_desk_id, version, tenant_id, session=session)
+
+        history_manager.run_in_transaction(apply)
+
+        # Снимок для отмены - только после успешной фиксации пересборки
+        snapshot_id = history_manager.save_snapshot(
+            operation_type="replay",
+            description=f"Replay of {replayed['count']} transactions",
+            tenant_id=tenant_id,
+            cash_desk_id=cash_desk_id,
+            cash_assets=cash_assets,
+            before={
+                "cash": written["cash"],
+                "fiat_lots": before_lots,
+                "pnl_matches": [match for match in stored_matches if match["_id"] in touched_match_ids],
+                "pnl_match_buckets": [bucket for bucket in stored_buckets if bucket["_id"] in touched_bucket_ids],
+                "transactions": [tx for tx, _ in replayed["changed_txs"]]
+            }
+        )
+        history_manager.record_changes(snapshot_id, inserted={
+            "fiat_lots": [_id for _id in touched_lot_ids if _id not in known_lot_ids],
+            "pnl_matches": [_id for _id in touched_match_ids if _id not in stored_match_ids],
+            "pnl_match_buckets": [_id for _id in touched_bucket_ids if _id not in buckets_by_id]
+        })
+        report["snapshot_id"] = snapshot_id
+        print(f"🔁 Replayed {replayed['count']} transactions for desk {cash_desk_id}: {report['changes']}")
+        return report
+
+
+# Глобальный экземпляр
+replay_manager = ReplayManager()
@@ -9,6 +9,11 @@ from ..db import db
 from ..models import CreateTenant, Tenant
 from ..auth import AuthenticationService
 from ..constants import CURRENCIES
+from ..money_storage import money_storage, MONEY_FIELDS
+from ..pnl_match_store import pnl_match_store
+from ..desk_versions import desk_version_manager
+from ..checkpoints import checkpoint_manager
+from ..lot_book_cache import lot_book_cache
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -92,7 +97,7 @@ def get_tenant(tenant_id: str):
         stats = {
             "transaction_count": db.transactions.count_documents({"tenant_id": tenant_id}),
             "fiat_lots_count": db.fiat_lots.count_documents({"tenant_id": tenant_id}),
-            "pnl_matches_count": db.pnl_matches.count_documents({"tenant_id": tenant_id}),
+            "pnl_matches_count": pnl_match_store.count({"tenant_id": tenant_id}),
             "history_snapshots_count": db.history_snapshots.count_documents({"tenant_id": tenant_id})
         }
         
@@ -205,9 +210,11 @@ def delete_tenant(tenant_id: str, confirm_delete: bool = False):
             raise HTTPException(status_code=404, detail="Tenant not found")
         
         # Удаляем все данные tenant
+        # (вместе с производными коллекциями: архив лотов, агрегаты, журналы снимков)
         collections_to_clean = [
-            "transactions", "cash", "fiat_lots", 
-            "pnl_matches", "history_snapshots"
+            "transactions", "cash", "fiat_lots", "fiat_lots_archive",
+            "pnl_matches", "pnl_match_buckets", "history_snapshots", "history_snapshot_chunks",
+            "desk_stats", "daily_rollups", "lot_stats", "idempotency_keys"
         ]
         
         deleted_counts = {}
@@ -216,6 +223,12 @@ def delete_tenant(tenant_id: str, confirm_delete: bool = False):
             result = collection.delete_many({"tenant_id": tenant_id})
             deleted_counts[collection_name] = result.deleted_count
         
+        # Версии касс сбрасываются - книги лотов, построенные по ним, в кэше больше не нужны
+        for desk in db.cash_desks.find({"tenant_id": tenant_id}, {"_id": 1}):
+            lot_book_cache.discard(desk["_id"])
+        deleted_counts["desk_checkpoints"] = checkpoint_manager.clear(tenant_id)
+        deleted_counts["desk_versions"] = desk_version_manager.clear(tenant_id)
+        
         # Удаляем самого tenant
         tenant_result = db.tenants.delete_one({"_id": tenant_id})
         
@@ -281,4 +294,27 @@ def migrate_existing_data_to_default_tenant():
         raise HTTPException(
             status_code=500,
             detail=f"Migration failed: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+
+@router.post("/migrate-decimal128", dependencies=[Depends(verify_super_admin)])
+def migrate_money_to_decimal128(collection: Optional[str] = None, dry_run: bool = True):
+    """
+    Перевод денежных полей (балансы, остатки и курсы лотов, суммы транзакций, PnL матчей)
+    из double в Decimal128. По умолчанию только считает документы старого формата.
+    Повторный запуск безопасен: уже переведённые поля не затрагиваются
+    """
+    if collection and collection not in MONEY_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown collection: {collection}")
+    try:
+        counts = money_storage.migrate(collection, dry_run=dry_run)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Migration failed: {str(e)}"
+        )
+    return {
+        "message": "Dry run: documents to migrate" if dry_run else "Money fields migrated to Decimal128",
+        "dry_run": dry_run,
+        "documents": counts
+    }
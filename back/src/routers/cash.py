@@ -2,9 +2,11 @@
 Роутер для операций с кассой
 """
 import os
-from fastapi import APIRouter, HTTPException, Depends,BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Header
 from pydantic import BaseModel
 from datetime import datetime
+from typing import Optional
+from bson import ObjectId
 
 from ..telegram_manager import telegram_manager
 from ..db import db
@@ -12,6 +14,11 @@ from ..models import CashDeposit, CashWithdrawal
 from ..constants import CURRENCIES
 from ..google_sheets import sheets_manager
 from ..history_manager import history_manager
+from ..desk_stats import desk_stats_manager
+from ..daily_rollups import rollup_manager
+from ..desk_versions import desk_version_manager
+from ..money_storage import money_storage
+from ..idempotency import idempotency_manager
 from ..auth import get_current_tenant
 from ..utils.cash_desk_utils import verify_cash_desk_access_util
 
@@ -32,23 +39,20 @@ def init_cash(
     """Инициализирует кассу с нулевыми балансами для всех валют для конкретной кассы"""
     # Проверяем доступ к кассе
     cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
-    initialized = []
-    for asset in CURRENCIES:
-        existing = db.cash.find_one({"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id})
-        if existing:
+    initialized = list(CURRENCIES)
+    
+    # Балансы и версия кассы - одной транзакцией MongoDB
+    def apply(session):
+        for asset in initialized:
             db.cash.update_one(
                 {"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id},
-                {"$set": {"balance": 0.0, "updated_at": datetime.utcnow()}}
+                {"$set": {"balance": 0.0, "updated_at": datetime.utcnow()}},
+                upsert=True,
+                session=session
             )
-        else:
-            db.cash.insert_one({
-                "asset": asset,
-                "balance": 0.0,
-                "tenant_id": tenant_id,
-                "cash_desk_id": cash_desk_id,
-                "updated_at": datetime.utcnow()
-            })
-        initialized.append(asset)
+        desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+    
+    history_manager.run_in_transaction(apply)
 
     return {
         "message": f"Cash register initialized with zero balances for tenant {tenant_id}",
@@ -69,20 +73,20 @@ def set_cash(
     
     asset = request.asset
     amount = request.amount
-    existing = db.cash.find_one({"asset": asset, "cash_desk_id": cash_desk_id})
-    if existing:
+    
+    def apply(session):
         db.cash.update_one(
             {"asset": asset, "cash_desk_id": cash_desk_id},
-            {"$set": {"balance": amount, "updated_at": datetime.utcnow()}}
+            {
+                "$set": {"balance": money_storage.value(amount), "updated_at": datetime.utcnow()},
+                "$setOnInsert": {"tenant_id": tenant_id}
+            },
+            upsert=True,
+            session=session
         )
-    else:
-        db.cash.insert_one({
-            "asset": asset,
-            "balance": amount,
-            "tenant_id": tenant_id,
-            "cash_desk_id": cash_desk_id,
-            "updated_at": datetime.utcnow()
-        })
+        desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+    
+    history_manager.run_in_transaction(apply)
     return {
         "message": f"Balance for {asset} set to {amount} for cash desk {cash_desk.name}",
         "cash_desk_id": cash_desk_id
@@ -92,14 +96,20 @@ def set_cash(
 @router.put("/{asset}")
 def update_cash_balance(asset: str, amount: float,cash_desk_id: str, tenant_id: str = Depends(get_current_tenant)):
     """Обновляет баланс существующей валюты для конкретного tenant"""
-    existing = db.cash.find_one({"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail=f"Asset {asset} not found in cash for cash desk {cash_desk_id}")
-     
-    db.cash.update_one(
-        {"asset": asset, "cash_desk_id": cash_desk_id},
-        {"$set": {"balance": amount, "updated_at": datetime.utcnow()}}
-    )
+    def apply(session):
+        existing = db.cash.find_one(
+            {"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id}, session=session
+        )
+        if not existing:
+            raise HTTPException(status_code=404, detail=f"Asset {asset} not found in cash for cash desk {cash_desk_id}")
+        db.cash.update_one(
+            {"asset": asset, "cash_desk_id": cash_desk_id},
+            {"$set": {"balance": money_storage.value(amount), "updated_at": datetime.utcnow()}},
+            session=session
+        )
+        desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+    
+    history_manager.run_in_transaction(apply)
     return {
         "message": f"Balance for {asset} updated to {amount} for tenant {tenant_id}",
         "tenant_id": tenant_id
@@ -109,18 +119,65 @@ def update_cash_balance(asset: str, amount: float,cash_desk_id: str, tenant_id:
 @router.delete("/{asset}")
 def delete_cash_asset(asset: str,cash_desk_id: str, tenant_id: str = Depends(get_current_tenant)):
     """Удаляет валюту из кассы для конкретного tenant"""
-    existing = db.cash.find_one({"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail=f"Asset {asset} not found in cash for tenant {tenant_id}")
+    # Удаление строки и версия кассы - одной транзакцией MongoDB
+    def apply(session):
+        result = db.cash.delete_one(
+            {"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id}, session=session
+        )
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail=f"Asset {asset} not found in cash for tenant {tenant_id}")
+        desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
     
-    result = db.cash.delete_one({"asset": asset, "tenant_id": tenant_id, "cash_desk_id": cash_desk_id})
-    if result.deleted_count > 0:
-        return {
-            "message": f"Asset {asset} removed from cash for tenant {tenant_id}",
-            "tenant_id": tenant_id
-        }
-    else:
-        raise HTTPException(status_code=500, detail=f"Failed to remove {asset} from cash for tenant {tenant_id}")
+    history_manager.run_in_transaction(apply)
+    return {
+        "message": f"Asset {asset} removed from cash for tenant {tenant_id}",
+        "tenant_id": tenant_id
+    }
+
+
+def _write_cash_operation(
+    tenant_id: str,
+    cash_desk_id: str,
+    asset: str,
+    amount: float,
+    transaction: dict,
+    must_exist: bool = False
+) -> dict:
+    """
+    Меняет баланс актива на amount и сохраняет транзакцию пополнения/вывода
+    одной транзакцией MongoDB (баланс читается внутри неё, повтор перечитывает его)
+    
+    Returns:
+        {"cash": строки кассы до изменения, "old_balance", "new_balance"}
+    """
+    written = {}
+    
+    def apply(session):
+        rows = history_manager.cash_images(tenant_id, cash_desk_id, [asset], session=session)
+        if not rows and must_exist:
+            raise HTTPException(status_code=404, detail=f"Asset {asset} not found in cash for tenant {tenant_id}")
+        old_balance = rows[0]["balance"] if rows else 0.0
+        if amount < 0 and old_balance < -amount:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient balance for cash desk {cash_desk_id}. Available: {old_balance} {asset}"
+            )
+        new_balance = old_balance + amount
+        db.cash.update_one(
+            {"asset": asset, "cash_desk_id": cash_desk_id},
+            {
+                "$set": {"balance": money_storage.value(new_balance), "updated_at": datetime.utcnow()},
+                "$setOnInsert": {"tenant_id": tenant_id}
+            },
+            upsert=True,
+            session=session
+        )
+        db.transactions.insert_one(money_storage.encode("transactions", transaction), session=session)
+        desk_version_manager.advance(cash_desk_id, tenant_id=tenant_id, session=session)
+        written.update({"cash": rows, "old_balance": old_balance, "new_balance": new_balance})
+    
+    history_manager.run_in_transaction(apply)
+    return written
 
 
 @router.post("/deposit")
@@ -128,46 +185,26 @@ def deposit_to_cash(
     deposit: CashDeposit, 
     cash_desk_id: str,
     background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     tenant_id: str = Depends(get_current_tenant)
 ):
     """Пополнение кассы с сохранением как транзакции для конкретной кассы"""
-    
+    return idempotency_manager.run(
+        tenant_id,
+        idempotency_key,
+        "deposit",
+        {"cash_desk_id": cash_desk_id, **deposit.dict(exclude_unset=True)},
+        lambda: _deposit_to_cash(deposit, cash_desk_id, background_tasks, tenant_id)
+    )
+
+
+def _deposit_to_cash(deposit: CashDeposit, cash_desk_id: str, background_tasks: BackgroundTasks, tenant_id: str):
     # Проверяем доступ к кассе
     cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
     
-    # Проверяем/создаем актив в кассе
-    existing = db.cash.find_one({"asset": deposit.asset, "cash_desk_id": cash_desk_id})
-    if not existing:
-        # Создаем новый актив с нулевым балансом
-        db.cash.insert_one({
-            "asset": deposit.asset,
-            "balance": 0.0,
-            "tenant_id": tenant_id,
-            "cash_desk_id": cash_desk_id,
-            "updated_at": datetime.utcnow()
-        })
-        old_balance = 0.0
-    else:
-        old_balance = existing["balance"]
-    
-    new_balance = old_balance + deposit.amount
-    
-    # Обновляем баланс в кассе
-    # Сохраняем снимок состояния ПЕРЕД пополнением
-    history_manager.save_snapshot(
-        operation_type="deposit",
-        description=f"Deposit {deposit.amount} {deposit.asset}",
-        tenant_id=tenant_id,
-        cash_desk_id=cash_desk_id
-    )
-    
-    db.cash.update_one(
-        {"asset": deposit.asset, "cash_desk_id": cash_desk_id},
-        {"$set": {"balance": new_balance, "updated_at": datetime.utcnow()}}
-    )
-    
     # Создаем транзакцию пополнения для истории транзакций
     deposit_transaction = {
+        "_id": ObjectId(),
         "type": "deposit",  # новый тип транзакции
         "from_asset": deposit.asset,
         "to_asset": "",  # пустое значение для пополнения
@@ -185,10 +222,22 @@ def deposit_to_cash(
         "is_modified": False
     }
     
-    # Сохраняем в коллекцию транзакций
-    transaction_result = db.transactions.insert_one(deposit_transaction)
-    # Add _id so Sheets helper can reference it
-    deposit_transaction["_id"] = transaction_result.inserted_id
+    # Баланс (актив создаётся, если его нет) и транзакция - одной транзакцией MongoDB
+    written = _write_cash_operation(tenant_id, cash_desk_id, deposit.asset, deposit.amount, deposit_transaction)
+    old_balance, new_balance = written["old_balance"], written["new_balance"]
+    
+    # Снимок для отмены: строка кассы до пополнения и ID транзакции
+    snapshot_id = history_manager.save_snapshot(
+        operation_type="deposit",
+        description=f"Deposit {deposit.amount} {deposit.asset}",
+        tenant_id=tenant_id,
+        cash_desk_id=cash_desk_id,
+        cash_assets=[deposit.asset],
+        before={"cash": written["cash"]}
+    )
+    history_manager.record_changes(snapshot_id, inserted={"transactions": [deposit_transaction["_id"]]})
+    desk_stats_manager.record_transaction(deposit_transaction)
+    rollup_manager.record_transaction(deposit_transaction)
 
     # Try to write to Google Sheets (don't fail the request if Sheets is down)
     try:
@@ -244,46 +293,33 @@ def deposit_to_cash(
         "new_balance": new_balance,
         "note": deposit.note,
         "tenant_id": tenant_id,
-        "transaction_id": str(transaction_result.inserted_id)
+        "transaction_id": str(deposit_transaction["_id"])
     }
 
 
 @router.post("/withdrawal")
-def withdraw_from_cash(withdrawal: CashWithdrawal, cash_desk_id: str, tenant_id: str = Depends(get_current_tenant)):
+def withdraw_from_cash(
+    withdrawal: CashWithdrawal,
+    cash_desk_id: str,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    tenant_id: str = Depends(get_current_tenant)
+):
     """Вычет средств из кассы с сохранением как транзакции для конкретного tenant"""
-    cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
-    # Проверяем существование актива в кассе
-    existing = db.cash.find_one({"asset": withdrawal.asset, "cash_desk_id": cash_desk_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail=f"Asset {withdrawal.asset} not found in cash for tenant {tenant_id}")
-    
-    old_balance = existing["balance"]
-    
-    # Проверяем достаточность средств
-    if old_balance < withdrawal.amount:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Insufficient balance for cash desk {cash_desk_id}. Available: {old_balance} {withdrawal.asset}"     
-            )
-    
-    new_balance = old_balance - withdrawal.amount
-    
-    # Сохраняем снимок состояния ПЕРЕД выводом
-    history_manager.save_snapshot(
-        operation_type="withdrawal",
-        description=f"Withdrawal {withdrawal.amount} {withdrawal.asset}",
-        tenant_id=tenant_id,
-        cash_desk_id=cash_desk_id
-    )
-    
-    # Обновляем баланс в кассе
-    db.cash.update_one(
-        {"asset": withdrawal.asset, "cash_desk_id": cash_desk_id},
-        {"$set": {"balance": new_balance, "updated_at": datetime.utcnow()}}
+    return idempotency_manager.run(
+        tenant_id,
+        idempotency_key,
+        "withdrawal",
+        {"cash_desk_id": cash_desk_id, **withdrawal.dict(exclude_unset=True)},
+        lambda: _withdraw_from_cash(withdrawal, cash_desk_id, tenant_id)
     )
+
+
+def _withdraw_from_cash(withdrawal: CashWithdrawal, cash_desk_id: str, tenant_id: str):
+    cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
     
     # Создаем транзакцию вычета для истории транзакций
     withdrawal_transaction = {
+        "_id": ObjectId(),
         "type": "withdrawal",  # новый тип транзакции
         "from_asset": withdrawal.asset,
         "to_asset": "",  # пустое значение для вычета
@@ -301,10 +337,24 @@ def withdraw_from_cash(withdrawal: CashWithdrawal, cash_desk_id: str, tenant_id:
         "is_modified": False
     }
     
-    # Сохраняем в коллекцию транзакций
-    transaction_result = db.transactions.insert_one(withdrawal_transaction)
-    # Add _id so Sheets helper can reference it
-    withdrawal_transaction["_id"] = transaction_result.inserted_id
+    # Наличие актива и достаточность средств проверяются внутри транзакции записи
+    written = _write_cash_operation(
+        tenant_id, cash_desk_id, withdrawal.asset, -withdrawal.amount, withdrawal_transaction, must_exist=True
+    )
+    old_balance, new_balance = written["old_balance"], written["new_balance"]
+    
+    # Снимок для отмены: строка кассы до вывода и ID транзакции
+    snapshot_id = history_manager.save_snapshot(
+        operation_type="withdrawal",
+        description=f"Withdrawal {withdrawal.amount} {withdrawal.asset}",
+        tenant_id=tenant_id,
+        cash_desk_id=cash_desk_id,
+        cash_assets=[withdrawal.asset],
+        before={"cash": written["cash"]}
+    )
+    history_manager.record_changes(snapshot_id, inserted={"transactions": [withdrawal_transaction["_id"]]})
+    desk_stats_manager.record_transaction(withdrawal_transaction)
+    rollup_manager.record_transaction(withdrawal_transaction)
 
     # Try to write to Google Sheets (don't fail the request if Sheets is down)
     try:
@@ -324,7 +374,7 @@ def withdraw_from_cash(withdrawal: CashWithdrawal, cash_desk_id: str, tenant_id:
         "new_balance": new_balance,
         "note": withdrawal.note,
         "tenant_id": tenant_id,
-        "transaction_id": str(transaction_result.inserted_id)
+        "transaction_id": str(withdrawal_transaction["_id"])
     }
 
 
@@ -374,21 +424,15 @@ def get_total_profit(
     if cash_desk_id:
         # Проверяем доступ к кассе
         verify_cash_desk_access_util(cash_desk_id, tenant_id)
-        match_filter = {"cash_desk_id": cash_desk_id}
-    else:
-        # Агрегированные данные по всем кассам tenant'а
-        match_filter = {"tenant_id": tenant_id}
     
-    pipeline = [
-        {"$match": match_filter},
-        {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-    ]
-    results = list(db.transactions.aggregate(pipeline))
+    # Прибыль берётся из материализованных счётчиков desk_stats
+    # (без cash_desk_id - агрегированно по всем кассам tenant'а)
+    results = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
 
     profits = {
-        r["_id"]: round(r["total_realized_profit"], 2)
-        for r in results
-        if r["_id"] in FIAT_ASSETS
+        currency: round(total, 2)
+        for currency, total in results.items()
+        if currency in FIAT_ASSETS
     }
 
     return {
@@ -401,43 +445,51 @@ def get_total_profit(
 @router.get("/cashflow_profit")
 def get_cashflow_profit(
     cash_desk_id: str = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
     tenant_id: str = Depends(get_current_tenant)
 ):
     """
     Считает чистую прибыль/убыток по каждой валюте через поток кассы:
     - profit = все, что получили в этой валюте - все, что отдали из кассы в этой валюте
+    
+    Считается на стороне MongoDB ($facet по from_asset и to_asset),
+    опционально за период [date_from, date_to].
     """
     if cash_desk_id:
         # Проверяем доступ к кассе
         verify_cash_desk_access_util(cash_desk_id, tenant_id)
-        txs = list(db.transactions.find({"cash_desk_id": cash_desk_id}))
+        match_filter = {"cash_desk_id": cash_desk_id}
     else:
         # Агрегированные данные по всем кассам tenant'а
-        txs = list(db.transactions.find({"tenant_id": tenant_id}))
-    cashflow_profit = {}
-
-    for tx in txs:
-        # Получаем и отдаем в каждой валюте
-        # fiat_to_crypto: клиент отдаёт from_asset, получает to_asset
-        # crypto_to_fiat: клиент отдаёт from_asset, получает to_asset
-
-        # --- отработаем from_asset ---
-        from_asset = tx["from_asset"]
-        amount_from = tx["amount_from"]
-
-        if from_asset not in cashflow_profit:
-            cashflow_profit[from_asset] = 0.0
-        cashflow_profit[from_asset] += amount_from  # получили в кассу
+        match_filter = {"tenant_id": tenant_id}
 
-        # --- отработаем to_asset ---
-        to_asset = tx["to_asset"]
-        amount_to_final = tx["amount_to_final"]
+    if date_from or date_to:
+        match_filter["created_at"] = {}
+        if date_from:
+            match_filter["created_at"]["$gte"] = date_from
+        if date_to:
+            match_filter["created_at"]["$lte"] = date_to
 
-        if to_asset not in cashflow_profit:
-            cashflow_profit[to_asset] = 0.0
+    # fiat_to_crypto / crypto_to_fiat: клиент отдаёт from_asset (получили в кассу),
+    # получает to_asset (отдано из кассы → вычитаем)
+    pipeline = [
+        {"$match": match_filter},
+        {"$project": {"_id": 0, "from_asset": 1, "to_asset": 1, "amount_from": 1, "amount_to_final": 1}},
+        {"$facet": {
+            "inflow": [{"$group": {"_id": "$from_asset", "total": {"$sum": "$amount_from"}}}],
+            "outflow": [{"$group": {"_id": "$to_asset", "total": {"$sum": "$amount_to_final"}}}]
+        }}
+    ]
+    result = next(db.transactions.aggregate(pipeline), {"inflow": [], "outflow": []})
 
-        # считаем как отдано из кассы → вычитаем
-        cashflow_profit[to_asset] -= amount_to_final
+    cashflow_profit = {}
+    for item in result["inflow"]:
+        if item["_id"] is not None:
+            cashflow_profit[item["_id"]] = cashflow_profit.get(item["_id"], 0.0) + item["total"]
+    for item in result["outflow"]:
+        if item["_id"] is not None:
+            cashflow_profit[item["_id"]] = cashflow_profit.get(item["_id"], 0.0) - item["total"]
 
     # Округляем для удобства
     cashflow_profit = {k: round(v, 2) for k, v in cashflow_profit.items()}
@@ -446,4 +498,36 @@ def get_cashflow_profit(
         "cashflow_profit_by_currency": cashflow_profit,
         "message": f"Net profit for tenant {tenant_id} calculated from actual cash flow for each currency",
         "tenant_id": tenant_id
-    }
\ No newline at end of file
+    }
+
+
+@router.get("/stats")
+def get_desk_stats(
+    cash_desk_id: str,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Материализованные счётчики кассы: прибыль, количество операций, объёмы по активам"""
+    verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    stats = desk_stats_manager.get_stats(cash_desk_id, tenant_id)
+    stats["cash_desk_id"] = stats.pop("_id")
+    return stats
+
+
+@router.post("/stats/rebuild")
+def rebuild_desk_stats(
+    cash_desk_id: str = None,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Пересобирает счётчики desk_stats из транзакций (для кассы или всех касс tenant'а)"""
+    if cash_desk_id:
+        verify_cash_desk_access_util(cash_desk_id, tenant_id)
+        desk_stats_manager.rebuild(cash_desk_id, tenant_id)
+        rebuilt = 1
+    else:
+        rebuilt = desk_stats_manager.rebuild_tenant(tenant_id)
+
+    return {
+        "message": f"Desk stats rebuilt for {rebuilt} cash desk(s)",
+        "rebuilt_count": rebuilt,
+        "tenant_id": tenant_id
+    }
@@ -6,6 +6,13 @@ from datetime import datetime
 from ..db import db
 from ..models import CashDesk, CreateCashDesk, UpdateCashDesk
 from ..auth import get_current_tenant
+from ..desk_stats import desk_stats_manager
+from ..daily_rollups import rollup_manager
+from ..lot_stats import lot_stats_manager
+from ..lot_archive import lot_archive_manager
+from ..pnl_match_store import pnl_match_store
+from ..checkpoints import checkpoint_manager
+from ..desk_versions import desk_version_manager
 
 router = APIRouter(prefix="/cash-desks", tags=["cash_desks"])
 
@@ -322,7 +329,7 @@ async def _collect_usage_info(cash_desk_id: str, tenant_id: str) -> dict:
         ]
     
     # Проверяем PnL матчи
-    pnl_matches_count = db["pnl_matches"].count_documents({
+    pnl_matches_count = pnl_match_store.count({
         "tenant_id": tenant_id,
         "cash_desk_id": cash_desk_id
     })
@@ -372,11 +379,18 @@ async def _cascade_delete_cash_desk_data(cash_desk_id: str, tenant_id: str) -> d
     deleted_summary["fiat_lots_deleted"] = fiat_lots_result.deleted_count
     
     # Удаляем PnL матчи
-    pnl_matches_result = db["pnl_matches"].delete_many({
+    deleted_summary["pnl_matches_deleted"] = pnl_match_store.clear({
         "tenant_id": tenant_id,
         "cash_desk_id": cash_desk_id
     })
-    deleted_summary["pnl_matches_deleted"] = pnl_matches_result.deleted_count
+    
+    # Удаляем счётчики и агрегаты кассы
+    desk_stats_manager.clear(tenant_id, cash_desk_id)
+    rollup_manager.clear(tenant_id, cash_desk_id)
+    lot_stats_manager.clear(tenant_id, cash_desk_id)
+    lot_archive_manager.clear(tenant_id, cash_desk_id)
+    checkpoint_manager.clear(tenant_id, cash_desk_id)
+    desk_version_manager.bump(cash_desk_id, tenant_id)
     
     return deleted_summary
 
@@ -9,6 +9,7 @@ from ..db import db
 from ..models import CashDesk
 from ..auth import get_current_tenant
 from ..history_manager import history_manager
+from ..pnl_match_store import pnl_match_store
 
 router = APIRouter(prefix="/cash-desks", tags=["cash_desks_enhanced"])
 
@@ -68,7 +69,7 @@ async def check_cash_desk_usage(cash_desk_id: str, tenant_id: str) -> Dict[str,
         ]
     
     # Проверяем PnL матчи
-    pnl_matches_count = db.pnl_matches.count_documents({
+    pnl_matches_count = pnl_match_store.count({
         "tenant_id": tenant_id,
         "cash_desk_id": cash_desk_id
     })
@@ -0,0 +1,138 @@
+"""
+Роутер для сводки дашборда одним запросом
+"""
+from fastapi import APIRouter, Depends
+from typing import Optional
+from ..db import db
+from ..constants import FIAT_ASSETS
+from ..desk_stats import desk_stats_manager
+from ..pnl_match_store import pnl_match_store
+from ..auth import get_current_tenant
+from ..utils.cash_desk_utils import verify_cash_desk_access_util
+
+router = APIRouter(prefix="/dashboard", tags=["dashboard"])
+
+
+def _dashboard_pipeline(scope: dict) -> list:
+    """
+    Один конвейер агрегации по cash с $unionWith по pnl_matches (вместе с pnl_match_buckets),
+    fiat_lots и transactions.
+    Каждая ветка группируется по валюте и помечается полем kind.
+    """
+    return [
+        {"$match": scope},
+        {"$group": {"_id": "$asset", "balance": {"$sum": "$balance"}}},
+        {"$addFields": {"kind": "cash"}},
+        {"$unionWith": {"coll": "pnl_matches", "pipeline": [
+            *pnl_match_store.rows_pipeline(scope),
+            {"$group": {
+                "_id": "$currency",
+                "pnl_fiat": {"$sum": "$pnl_fiat"},
+                "pnl_usdt": {"$sum": "$pnl_usdt"},
+                "matches_count": {"$sum": "$pieces_count"}
+            }},
+            {"$addFields": {"kind": "pnl"}}
+        ]}},
+        {"$unionWith": {"coll": "fiat_lots", "pipeline": [
+            {"$match": {**scope, "remaining": {"$gt": 0}}},
+            {"$group": {
+                "_id": "$currency",
+                "total_value": {"$sum": "$remaining"},
+                "rate_value": {"$sum": {"$multiply": ["$rate", "$remaining"]}},
+                "count": {"$sum": 1},
+                "min_rate": {"$min": "$rate"},
+                "max_rate": {"$max": "$rate"},
+                "avg_rate": {"$avg": "$rate"}
+            }},
+            {"$addFields": {"kind": "lots"}}
+        ]}},
+        {"$unionWith": {"coll": "transactions", "pipeline": [
+            {"$match": {**scope, "type": {"$in": ["fiat_to_crypto", "crypto_to_fiat"]}}},
+            {"$group": {
+                "_id": {
+                    "type": "$type",
+                    "currency": {"$cond": [{"$eq": ["$type", "fiat_to_crypto"]}, "$from_asset", "$to_asset"]}
+                },
+                "count": {"$sum": 1}
+            }},
+            {"$addFields": {"kind": "tx_count"}}
+        ]}}
+    ]
+
+
+def _empty_summary(currency: str) -> dict:
+    """Структура сводки по валюте, совместимая с /transactions/profit-summary/{currency}"""
+    return {
+        "currency": currency,
+        "realized_profit": {"fiat": 0.0, "usdt": 0.0},
+        "remaining_lots": {"count": 0, "total_value": 0.0},
+        "rates_info": {},
+        "transactions": {"buy_count": 0, "sell_count": 0},
+        "pnl_matches_count": 0
+    }
+
+
+@router.get("")
+def get_dashboard(
+    cash_desk_id: Optional[str] = None,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """
+    Сводка дашборда одним запросом: балансы, прибыль по валютам,
+    PnL, остатки открытых лотов и средневзвешенный курс по всем валютам
+    кассы (или агрегированно по всем кассам tenant'а)
+    """
+    if cash_desk_id:
+        # Проверяем доступ к кассе
+        verify_cash_desk_access_util(cash_desk_id, tenant_id)
+        scope = {"cash_desk_id": cash_desk_id}
+    else:
+        # Агрегированный режим по всем кассам tenant'а
+        scope = {"tenant_id": tenant_id}
+
+    cash = {}
+    summaries = {currency: _empty_summary(currency) for currency in FIAT_ASSETS}
+
+    for row in db.cash.aggregate(_dashboard_pipeline(scope)):
+        kind = row["kind"]
+        if kind == "cash":
+            cash[row["_id"]] = row["balance"]
+            continue
+
+        currency = row["_id"]["currency"] if kind == "tx_count" else row["_id"]
+        if not currency:
+            continue
+        summary = summaries.setdefault(currency, _empty_summary(currency))
+
+        if kind == "pnl":
+            summary["realized_profit"] = {
+                "fiat": round(row["pnl_fiat"], 2),
+                "usdt": round(row["pnl_usdt"], 4)
+            }
+            summary["pnl_matches_count"] = row["matches_count"]
+        elif kind == "lots":
+            total_value = row["total_value"]
+            summary["remaining_lots"] = {"count": row["count"], "total_value": round(total_value, 2)}
+            summary["rates_info"] = {
+                "min_rate": round(row["min_rate"], 5),
+                "max_rate": round(row["max_rate"], 5),
+                "avg_rate": round(row["avg_rate"], 5),
+                "weighted_avg_rate": round(row["rate_value"] / total_value, 5) if total_value > 0 else 0
+            }
+        elif kind == "tx_count":
+            key = "buy_count" if row["_id"]["type"] == "fiat_to_crypto" else "sell_count"
+            summary["transactions"][key] = row["count"]
+
+    profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
+
+    return {
+        "cash": cash,
+        "profits_by_currency": {
+            currency: round(total, 2)
+            for currency, total in profits.items()
+            if currency in FIAT_ASSETS
+        },
+        "summaries": summaries,
+        "cash_desk_id": cash_desk_id,
+        "tenant_id": tenant_id
+    }
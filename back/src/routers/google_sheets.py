@@ -4,6 +4,7 @@
 from fastapi import APIRouter, HTTPException, Depends
 from datetime import datetime
 from ..db import db
+from ..desk_stats import desk_stats_manager
 from ..models import GoogleSheetsSettings, EnableGoogleSheets, GoogleSheetsStatus
 from ..auth import get_current_tenant
 from ..google_sheets import sheets_manager
@@ -94,12 +95,7 @@ def enable_google_sheets(
             cash_status = {item["asset"]: item["balance"] for item in cash_items}
             
             # Получаем данные прибыли
-            pipeline = [
-                {"$match": {"tenant_id": tenant_id}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+            realized_profits = desk_stats_manager.get_profits(tenant_id=tenant_id)
             
             # Синхронизируем все существующие данные
             if transactions or cash_status or realized_profits:
@@ -176,12 +172,7 @@ def re_enable_google_sheets(tenant_id: str = Depends(get_current_tenant)):
             cash_status = {item["asset"]: item["balance"] for item in cash_items}
             
             # Получаем данные прибыли
-            pipeline = [
-                {"$match": {"tenant_id": tenant_id}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+            realized_profits = desk_stats_manager.get_profits(tenant_id=tenant_id)
             
             # Синхронизируем все существующие данные
             sheets_manager.sync_all_data(tenant_id)
@@ -303,12 +294,7 @@ def sync_cash_desk_data(
         cash_status = {item["asset"]: item["balance"] for item in cash_items}
         
         # Рассчитываем прибыль по этой кассе
-        pipeline = [
-            {"$match": {"cash_desk_id": cash_desk_id}},
-            {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-        ]
-        profit_results = list(db.transactions.aggregate(pipeline))
-        realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+        realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
         
         # Синхронизируем данные кассы
         sheets_manager.sync_cash_desk_data(
@@ -358,12 +344,7 @@ def sync_aggregate_report(tenant_id: str = Depends(get_current_tenant)):
             cash_status = {item["asset"]: item["balance"] for item in cash_items}
             
             # Прибыль по кассе
-            pipeline = [
-                {"$match": {"cash_desk_id": cash_desk._id}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+            realized_profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk._id, tenant_id=tenant_id)
             
             all_cash_desks_data.append({
                 "cash_desk_name": cash_desk.name,
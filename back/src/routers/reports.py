@@ -0,0 +1,100 @@
+"""
+Роутер для отчётов за период на основе дневных агрегатов
+"""
+from fastapi import APIRouter, HTTPException, Depends
+from datetime import date, datetime, timezone
+from typing import Optional
+from ..daily_rollups import rollup_manager
+from ..checkpoints import checkpoint_manager
+from ..auth import get_current_tenant
+from ..utils.cash_desk_utils import verify_cash_desk_access_util
+
+router = APIRouter(prefix="/reports", tags=["reports"])
+
+
+@router.get("/range")
+def get_range_report(
+    date_from: date,
+    date_to: date,
+    cash_desk_id: Optional[str] = None,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Сводка за произвольный период: объёмы, комиссии, PnL и количество транзакций по валютам"""
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be later than date_to")
+
+    if cash_desk_id:
+        # Проверяем доступ к кассе
+        verify_cash_desk_access_util(cash_desk_id, tenant_id)
+
+    by_currency = rollup_manager.get_range(tenant_id, date_from, date_to, cash_desk_id)
+    for item in by_currency.values():
+        item["net_flow"] = round(item["volume_in"] - item["volume_out"], 2)
+        item["pnl_fiat"] = round(item["pnl_fiat"], 2)
+        item["pnl_usdt"] = round(item["pnl_usdt"], 4)
+
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "cash_desk_id": cash_desk_id,
+        "by_currency": by_currency,
+        "tenant_id": tenant_id
+    }
+
+
+@router.post("/rollups/backfill")
+def backfill_rollups(
+    cash_desk_id: Optional[str] = None,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Пересобирает дневные агрегаты из транзакций (для кассы или всех касс tenant'а)"""
+    if cash_desk_id:
+        verify_cash_desk_access_util(cash_desk_id, tenant_id)
+
+    written = rollup_manager.backfill(tenant_id, cash_desk_id)
+    return {
+        "message": "Daily rollups rebuilt",
+        "rollups_written": written,
+        "cash_desk_id": cash_desk_id,
+        "tenant_id": tenant_id
+    }
+
+
+@router.get("/as-of")
+def get_state_as_of(
+    cash_desk_id: str,
+    at: datetime,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """
+    Балансы, открытые лоты и накопленная прибыль кассы на момент at.
+    Собирается от ближайшей контрольной точки проигрыванием только более поздних транзакций
+    """
+    verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    if at.tzinfo is not None:
+        # Время в базе хранится в UTC без часового пояса
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+
+    state = checkpoint_manager.get_state_at(cash_desk_id, at)
+    state["balances"] = {asset: round(balance, 8) for asset, balance in state["balances"].items()}
+    state["profit"] = {currency: round(value, 2) for currency, value in state["profit"].items()}
+    return {
+        **state,
+        "cash_desk_id": cash_desk_id,
+        "tenant_id": tenant_id
+    }
+
+
+@router.post("/checkpoints")
+def create_checkpoint(
+    cash_desk_id: str,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Создаёт контрольную точку текущего состояния кассы вне расписания"""
+    verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    checkpoint = checkpoint_manager.create_checkpoint(cash_desk_id, tenant_id)
+    return {
+        "message": "Checkpoint created",
+        "checkpoint": checkpoint,
+        "tenant_id": tenant_id
+    }
@@ -2,10 +2,22 @@
 Роутер для системных операций
 """
 from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+from datetime import datetime
 from ..db import db
 from ..google_sheets import sheets_manager
 from ..history_manager import history_manager
+from ..desk_stats import desk_stats_manager
+from ..daily_rollups import rollup_manager
+from ..lot_stats import lot_stats_manager
+from ..lot_archive import lot_archive_manager
+from ..pnl_match_store import pnl_match_store
+from ..replay import replay_manager
+from ..checkpoints import checkpoint_manager
+from ..desk_versions import desk_version_manager, DeskVersionConflict
+from ..idempotency import idempotency_manager
 from ..auth import get_current_tenant
+from ..utils.cash_desk_utils import verify_cash_desk_access_util
 
 router = APIRouter(tags=["system"])
 
@@ -57,6 +69,7 @@ def get_tenant_info(tenant_id: str = Depends(get_current_tenant)):
 def reset_cash_delete(tenant_id: str = Depends(get_current_tenant)):
     """Полностью очищает кассу — все валюты и балансы (DELETE метод)"""
     result = db.cash.delete_many({"tenant_id": tenant_id})
+    desk_version_manager.bump_tenant(tenant_id)
     
     # Очищаем Google Sheets
     try:
@@ -74,6 +87,9 @@ def reset_cash_delete(tenant_id: str = Depends(get_current_tenant)):
 def reset_transactions(tenant_id: str = Depends(get_current_tenant)):
     """Полностью очищает коллекцию транзакций"""
     result = db.transactions.delete_many({"tenant_id": tenant_id})
+    desk_stats_manager.clear(tenant_id)
+    rollup_manager.clear(tenant_id)
+    checkpoint_manager.clear(tenant_id)
     
     # Очищаем Google Sheets
     try:
@@ -91,6 +107,10 @@ def reset_transactions(tenant_id: str = Depends(get_current_tenant)):
 def reset_fiat_lots(tenant_id: str = Depends(get_current_tenant)):
     """Полностью очищает коллекцию фиатных лотов"""
     result = db.fiat_lots.delete_many({"tenant_id": tenant_id})
+    lot_stats_manager.clear(tenant_id)
+    lot_archive_manager.clear(tenant_id)
+    checkpoint_manager.clear(tenant_id)
+    desk_version_manager.bump_tenant(tenant_id)
     return {
         "message": "All fiat lots have been deleted",
         "deleted_count": result.deleted_count
@@ -99,11 +119,11 @@ def reset_fiat_lots(tenant_id: str = Depends(get_current_tenant)):
 
 @router.delete("/reset-pnl-matches")
 def reset_pnl_matches(tenant_id: str = Depends(get_current_tenant)):
-    """Полностью очищает коллекцию PnL матчей"""
-    result = db.pnl_matches.delete_many({"tenant_id": tenant_id})
+    """Полностью очищает PnL матчи (отдельные документы и корзины транзакций)"""
+    deleted_count = pnl_match_store.clear({"tenant_id": tenant_id})
     return {
         "message": "All PnL matches have been deleted", 
-        "deleted_count": result.deleted_count
+        "deleted_count": deleted_count
     }
 
 
@@ -113,7 +133,14 @@ def reset_all_data(tenant_id: str = Depends(get_current_tenant)):
     cash_result = db.cash.delete_many({"tenant_id": tenant_id})
     tx_result = db.transactions.delete_many({"tenant_id": tenant_id})
     lots_result = db.fiat_lots.delete_many({"tenant_id": tenant_id})
-    pnl_result = db.pnl_matches.delete_many({"tenant_id": tenant_id})
+    pnl_deleted = pnl_match_store.clear({"tenant_id": tenant_id})
+    desk_stats_manager.clear(tenant_id)
+    rollup_manager.clear(tenant_id)
+    lot_stats_manager.clear(tenant_id)
+    lot_archive_manager.clear(tenant_id)
+    checkpoint_manager.clear(tenant_id)
+    idempotency_manager.clear(tenant_id)
+    desk_version_manager.bump_tenant(tenant_id)
     
     # Очищаем кассы (Фаза 2) для данного tenant
     cash_desks_result = db.cash_desks.delete_many({"tenant_id": tenant_id})
@@ -143,49 +170,182 @@ def reset_all_data(tenant_id: str = Depends(get_current_tenant)):
         "cash_deleted": cash_result.deleted_count,
         "transactions_deleted": tx_result.deleted_count,
         "fiat_lots_deleted": lots_result.deleted_count,
-        "pnl_matches_deleted": pnl_result.deleted_count,
+        "pnl_matches_deleted": pnl_deleted,
         "cash_desks_deleted": cash_desks_result.deleted_count,
         "history_snapshots_deleted": history_result
     }
 
 
+def _refresh_after_history_change(
+    tenant_id: str,
+    cash_desk_id: Optional[str],
+    full_rebuild: bool,
+    since: Optional[datetime] = None
+):
+    """
+    Пересобирает производные агрегаты и синхронизирует Google Sheets после отмены/повтора.
+    Контрольные точки, снятые после since (или все точки, если since не задан), удаляются.
+    Версию кассы увеличивает сама отмена/повтор (пересборка) в своей транзакции
+    """
+    checkpoint_manager.invalidate(tenant_id, cash_desk_id, since)
+    
+    # Журнальные снимки сами корректируют desk_stats и дневные агрегаты;
+    # после полного снимка старого формата пересобираем их по восстановленным данным
+    if full_rebuild:
+        if cash_desk_id:
+            desk_stats_manager.rebuild(cash_desk_id, tenant_id)
+        else:
+            desk_stats_manager.rebuild_tenant(tenant_id)
+        rollup_manager.backfill(tenant_id, cash_desk_id)
+    
+    # Агрегаты лотов пересобираются по открытым лотам кассы
+    if cash_desk_id:
+        lot_stats_manager.rebuild(cash_desk_id, tenant_id)
+    else:
+        lot_stats_manager.clear(tenant_id)
+    
+    if cash_desk_id:
+        try:
+            sheets_manager.resync_cash_desk(cash_desk_id, tenant_id)
+            print(f"Google Sheets resync triggered for cash desk {cash_desk_id}")
+        except Exception as e:
+            print(f"Failed to resync Google Sheets after undo/redo: {e}")
+
+
 @router.post("/undo")
-def undo_last_operation(cash_desk_id: str = None, tenant_id: str = Depends(get_current_tenant)):
-    """Отменяет последнюю операцию для конкретного tenant и кассы, восстанавливая предыдущее состояние"""
+def undo_last_operation(cash_desk_id: str = None, steps: int = 1, tenant_id: str = Depends(get_current_tenant)):
+    """
+    Отменяет последние steps операций для конкретного tenant и кассы.
+    Отменённые операции попадают в стек повтора (/redo)
+    """
+    if steps < 1:
+        raise HTTPException(status_code=400, detail="steps must be at least 1")
     try:
-        # Получаем последний снимок для конкретного tenant и кассы
-        snapshot = history_manager.get_last_snapshot(tenant_id, cash_desk_id)
+        cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+        undone = []
+        full_rebuild = False
+        
+        for _ in range(steps):
+            # Получаем последний снимок для конкретного tenant и кассы (без журнала)
+            snapshot = history_manager.get_last_snapshot(tenant_id, cash_desk_id, metadata_only=True)
+            if not snapshot:
+                break
+            
+            success = history_manager.restore_snapshot(
+                snapshot_id=str(snapshot["_id"]),
+                tenant_id=tenant_id,
+                cash_desk_id=cash_desk_id
+            )
+            if not success:
+                if not undone:
+                    raise HTTPException(status_code=500, detail="Failed to restore snapshot")
+                break
+            
+            full_rebuild = full_rebuild or snapshot.get("format") != "delta"
+            undone.append({
+                "operation": snapshot.get("operation_type"),
+                "description": snapshot.get("description"),
+                "timestamp": snapshot.get("timestamp"),
+                "redo_available": snapshot.get("format") == "delta"
+            })
         
-        if not snapshot:
-            cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
+        if not undone:
             raise HTTPException(status_code=404, detail=f"No operations to undo for tenant {tenant_id}{cash_desc}")
         
-        # Восстанавливаем состояние для конкретного tenant и кассы
-        # (Google Sheets автоматически синхронизируется внутри restore_snapshot)
-        success = history_manager.restore_snapshot(tenant_id=tenant_id, cash_desk_id=cash_desk_id)
+        _refresh_after_history_change(
+            tenant_id, cash_desk_id, full_rebuild,
+            since=min(item["timestamp"] for item in undone)
+        )
         
-        if not success:
-            raise HTTPException(status_code=500, detail="Failed to restore snapshot")
+        return {
+            "message": f"{len(undone)} operation(s) undone successfully for tenant {tenant_id}{cash_desc}",
+            "restored_operation": undone[-1]["operation"],
+            "restored_description": undone[-1]["description"],
+            "restored_timestamp": undone[-1]["timestamp"],
+            "undone": undone,
+            "undone_count": len(undone)
+        }
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during undo: {str(e)}")
+
+
+@router.post("/redo")
+def redo_operation(cash_desk_id: str = None, steps: int = 1, tenant_id: str = Depends(get_current_tenant)):
+    """Повторяет последние steps отменённых операций для конкретного tenant и кассы"""
+    if steps < 1:
+        raise HTTPException(status_code=400, detail="steps must be at least 1")
+    try:
         cash_desc = f" (desk: {cash_desk_id})" if cash_desk_id else " (all desks)"
-        if cash_desk_id:
-            try:
-                sheets_manager.resync_cash_desk(cash_desk_id, tenant_id)
-                print(f"Google Sheets resync triggered for cash desk {cash_desk_id}")
-            except Exception as e:
-                print(f"Failed to resync Google Sheets after undo: {e}")
+        redone = []
+        
+        for _ in range(steps):
+            snapshot = history_manager.get_next_redo(tenant_id, cash_desk_id)
+            if not snapshot:
+                break
+            
+            success = history_manager.redo_snapshot(
+                snapshot_id=str(snapshot["_id"]),
+                tenant_id=tenant_id,
+                cash_desk_id=cash_desk_id
+            )
+            if not success:
+                if not redone:
+                    raise HTTPException(status_code=500, detail="Failed to redo operation")
+                break
+            
+            redone.append({
+                "operation": snapshot.get("operation_type"),
+                "description": snapshot.get("description"),
+                "timestamp": snapshot.get("timestamp")
+            })
+        
+        if not redone:
+            raise HTTPException(status_code=404, detail=f"No operations to redo for tenant {tenant_id}{cash_desc}")
+        
+        _refresh_after_history_change(
+            tenant_id, cash_desk_id, full_rebuild=False,
+            since=min(item["timestamp"] for item in redone)
+        )
         
         return {
-            "message": f"Operation undone successfully for tenant {tenant_id}{cash_desc}",
-            "restored_operation": snapshot.get("operation_type"),
-            "restored_description": snapshot.get("description"),
-            "restored_timestamp": snapshot.get("timestamp")
+            "message": f"{len(redone)} operation(s) redone successfully for tenant {tenant_id}{cash_desc}",
+            "redone_operation": redone[-1]["operation"],
+            "redone_description": redone[-1]["description"],
+            "redone": redone,
+            "redone_count": len(redone)
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error during undo: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error during redo: {str(e)}")
+
+
+@router.post("/replay")
+def replay_cash_desk(
+    cash_desk_id: str,
+    dry_run: bool = True,
+    rebuild_cash: bool = False,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """
+    Пересобирает лоты, матчи PnL и производные поля транзакций кассы по журналу транзакций.
+    С dry_run=true (по умолчанию) только проверяет согласованность и возвращает отчёт о расхождениях.
+    rebuild_cash=true также перезаписывает балансы рассчитанными по транзакциям
+    """
+    verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    try:
+        report = replay_manager.replay_desk(cash_desk_id, tenant_id, dry_run=dry_run, rebuild_cash=rebuild_cash)
+        if not dry_run and not report["consistent"]:
+            _refresh_after_history_change(tenant_id, cash_desk_id, full_rebuild=True)
+        return report
+    except DeskVersionConflict:
+        raise HTTPException(status_code=409, detail="Cash desk was changed during replay, please retry")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during replay: {str(e)}")
 
 
 @router.get("/history")
@@ -201,6 +361,20 @@ def get_operation_history(limit: int = 10, tenant_id: str = Depends(get_current_
         raise HTTPException(status_code=500, detail=f"Error fetching history: {str(e)}")
 
 
+@router.get("/history/metrics")
+def get_history_metrics(cash_desk_id: Optional[str] = None, tenant_id: str = Depends(get_current_tenant)):
+    """Метрики объёма снимков истории (для кассы или всех касс tenant'а)"""
+    try:
+        metrics = history_manager.get_snapshot_metrics(tenant_id, cash_desk_id)
+        return {
+            **metrics,
+            "cash_desk_id": cash_desk_id,
+            "tenant_id": tenant_id
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching history metrics: {str(e)}")
+
+
 @router.post("/sheets/update-summary")
 def update_sheets_summary(tenant_id: str = Depends(get_current_tenant)):
     """Ручное обновление сводного листа Google Sheets для текущего tenant"""
@@ -208,12 +382,7 @@ def update_sheets_summary(tenant_id: str = Depends(get_current_tenant)):
         cash_items = list(db.cash.find({"tenant_id": tenant_id}, {"_id": 0}))
         cash_status = {item["asset"]: item["balance"] for item in cash_items}
         
-        pipeline = [
-            {"$match": {"tenant_id": tenant_id}},
-            {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-        ]
-        profit_results = list(db.transactions.aggregate(pipeline))
-        realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+        realized_profits = desk_stats_manager.get_profits(tenant_id=tenant_id)
         
         sheets_manager.update_cash_and_profits(cash_status, realized_profits, tenant_id)
         
@@ -1,49 +1,57 @@
 """
 Роутер для операций с транзакциями
 """
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Header
 from fastapi.responses import StreamingResponse
 from bson import ObjectId
-from datetime import datetime
+from pymongo import UpdateOne
+from datetime import datetime, timedelta
 from typing import Optional
+import os
 from decimal import Decimal, ROUND_HALF_UP
 import csv
 from io import StringIO
 from ..db import db
-from ..models import Transaction, TransactionUpdate
+from ..models import Transaction, TransactionUpdate, TransactionBatch, PreviewLadderRequest
 from ..constants import FIAT_ASSETS, SPECIAL_FIAT, SPECIAL_FIAT_FOR_USDT
 from ..google_sheets import sheets_manager
+from ..telegram_manager import telegram_manager
 from ..history_manager import history_manager
+from ..desk_stats import desk_stats_manager
+from ..daily_rollups import rollup_manager
+from ..lot_stats import lot_stats_manager
+from ..lot_archive import lot_archive_manager
+from ..fifo_engine import fifo_engine
+from ..lot_book_cache import lot_book_cache
+from ..money_storage import money_storage
+from ..pnl_match_store import pnl_match_store
+from ..preview_ladder import preview_ladder
+from ..preview_cache import preview_cache
+from ..desk_versions import desk_version_manager, DeskVersionConflict
+from ..idempotency import idempotency_manager
 from ..auth import get_current_tenant
 from ..utils.cash_desk_utils import verify_cash_desk_access_util
 
 router = APIRouter(prefix="/transactions", tags=["transactions"])
 
+MAX_BATCH_SIZE = 200  # Максимум обменов в одном пакете
+MAX_LADDER_CELLS = 10000  # Максимум ячеек сетки предпросмотра
 
-@router.post("")
-def create_transaction(
-    tx: Transaction, 
-    cash_desk_id: str,
-    tenant_id: str = Depends(get_current_tenant)
-):
-    # Фаза 2: Проверяем доступ к кассе
-    cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
-    
-    # Устанавливаем идентификаторы для изоляции данных
-    tx.tenant_id = tenant_id
-    tx.cash_desk_id = cash_desk_id
-    
-    # Сохраняем снимок состояния ПЕРЕД созданием транзакции
-    history_manager.save_snapshot(
-        operation_type="create_transaction",
-        description=f"Creating {tx.type}: {tx.from_asset} → {tx.to_asset}",
-        tenant_id=tenant_id,
-        cash_desk_id=cash_desk_id
-    )
-    
+
+def _price_transaction(tx: Transaction) -> str:
+    """
+    Проверяет тип обмена и рассчитывает суммы и комиссию транзакции (изменяет tx на месте)
+
+    Returns:
+        Направление комиссии: "added", "deducted" или "none"
+    """
     # --- Проверки ---
     if tx.type not in ["fiat_to_crypto", "crypto_to_fiat", "fiat_to_fiat"]:
         raise HTTPException(status_code=400, detail="Invalid transaction type")
+    if tx.amount_from is None or tx.amount_from <= 0:
+        raise HTTPException(status_code=400, detail="amount_from must be positive")
+    if tx.rate_used is None or tx.rate_used <= 0:
+        raise HTTPException(status_code=400, detail="rate_used must be positive")
 
     if tx.type == "fiat_to_crypto" and tx.from_asset in SPECIAL_FIAT:
         # Клиент платит кронами → делим
@@ -96,357 +104,166 @@ def create_transaction(
         tx.fee_percent = 0.0
         tx.rate_for_gleb_pnl = 0.0
         fee_direction = "none"
-     
-
-    from_cash = db.cash.find_one({"asset": tx.from_asset, "cash_desk_id": cash_desk_id})
-    to_cash = db.cash.find_one({"asset": tx.to_asset, "cash_desk_id": cash_desk_id})
-
-    if not from_cash:
-        db.cash.insert_one({
-            "asset": tx.from_asset,
-            "balance": 0.0,
-            "tenant_id": tenant_id,
-            "cash_desk_id": cash_desk_id,
-            "updated_at": datetime.utcnow()
-        })
-        from_cash = {"asset": tx.from_asset, "balance": 0.0}
-
-    if not to_cash:
-        db.cash.insert_one({
-            "asset": tx.to_asset,
-            "balance": 0.0,
-            "tenant_id": tenant_id,
-            "cash_desk_id": cash_desk_id,
-            "updated_at": datetime.utcnow()
-        })
-        to_cash = {"asset": tx.to_asset, "balance": 0.0}
 
+    # После округления до целого сумма выдачи может обнулиться - такой обмен не провести
+    if tx.amount_to_final <= 0:
+        raise HTTPException(status_code=400, detail="amount_to_final must be positive")
 
-    if tx.type == "crypto_to_fiat":
-        tx.profit_currency = tx.to_asset  # клиент получает фиат → прибыль в нём
-    elif tx.type == "fiat_to_crypto":
-        tx.profit_currency = tx.from_asset  # клиент платит фиат → прибыль в нём
-    elif tx.type == "fiat_to_fiat":
-        tx.profit_currency = "USDT"  # PnL от fiat_to_fiat считается в USDT
-    
-    if tx.type == "fiat_to_crypto":
-        # клиент отдаёт фиат, получает крипту
-        # проверяем, достаточно ли крипты (to_asset), чтобы выдать клиенту
-        if to_cash["balance"] < tx.amount_to_final:
-            raise HTTPException(status_code=400, detail=f"Not enough {tx.to_asset} in cash")
-        
-        db.cash.update_one({"asset": tx.to_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": -tx.amount_to_final}})
-        db.cash.update_one({"asset": tx.from_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": tx.amount_from}})
-        
-        # Создаём лот фиата (этот кэш позже "сгорит" при покупках USDT за этот же фиат)
-        fiat_currency = tx.from_asset           # 'CZK' | 'EUR' | 'USD'
-        fiat_in_fact  = Decimal(str(tx.amount_from))   # фактический приток фиата в кассу
-        usdt_out_fact = Decimal(str(tx.amount_to_final)) # фактическая выдача USDT клиенту
-        
-        # Эффективный курс покупки = полученный фиат / выданный USDT
-        lot_rate_eff = fiat_in_fact / usdt_out_fact
-
-        db.fiat_lots.insert_one({
-            "tenant_id": tenant_id,                   # изоляция по tenant
-            "cash_desk_id": cash_desk_id,             # Фаза 2: изоляция по кассе
-            "currency": fiat_currency,                # в какой валюте этот лот
-            "remaining": float(fiat_in_fact),         # сколько фиата осталось в этом лоте
-            "rate": float(lot_rate_eff),              # эффективный курс с учетом комиссии (FIAT/USDT)
-            "tx_id": None,  # будем заполнять после создания транзакции
-            "created_at": datetime.utcnow(),
-            "meta": {
-                "source": "fiat_to_crypto",
-                "fee_percent": float(tx.fee_percent),
-            }
-        })
+    return fee_direction
 
-    elif tx.type == "crypto_to_fiat":
-        # клиент отдаёт крипту, получает фиат - проверяем баланс, но НЕ обновляем пока
-        if to_cash["balance"] < tx.amount_to_final:
-            raise HTTPException(status_code=400, detail=f"Not enough {tx.to_asset} in cash")
-    
-    elif tx.type == "fiat_to_fiat":
-        # Обмен фиата на фиат
-        # Проверяем баланс from_asset
-        if from_cash["balance"] < tx.amount_from:
-            raise HTTPException(status_code=400, detail=f"Not enough {tx.from_asset} in cash")
-    
-    # --- Подсчёт реализованной прибыли ---
-    realized_profit = 0.0
-
-    if tx.type == "fiat_to_fiat" and tx.from_asset in FIAT_ASSETS:
-        # FIFO расчет себестоимости to_asset в USDT
-        # Для fiat_to_fiat PnL не рассчитывается! Это просто обмен.
-        # PnL будет рассчитана позже, когда we sell this to_asset через crypto_to_fiat
-        def D(x):
-            return Decimal(str(x))
-        
-        from_asset_currency = tx.from_asset
-        fiat_out_fact = D(tx.amount_from)           # сколько фиата отдали (CZK)
-        to_fiat_in = D(tx.amount_to_final)          # сколько фиata получили (EUR)
-        
-        # Просто накапливаем себестоимость для to_asset (EUR)
-        need = fiat_out_fact
-        eps = D("0.0000001")
-        cost_usdt_total = D(0)  # Себестоимость EUR в USDT
-        
-        while need > eps:
-            lot = db.fiat_lots.find_one(
-                {"currency": from_asset_currency, "remaining": {"$gt": 0},  "cash_desk_id": cash_desk_id}, 
-                sort=[("created_at", 1)]
-            )
-            if not lot:
-                print(f"WARNING: No {from_asset_currency} lots available for FIFO calculation in fiat_to_fiat")
-                break
-            
-            lot_rem = D(lot["remaining"])
-            lot_rate = D(lot["rate"])  # CZK/USDT курс при исходной покупке
-            take = lot_rem if lot_rem <= need else need
-            matched_usdt = take / lot_rate  # сколько USDT эквивалента в этом куске CZK
-            
-            # Себестоимость этой части EUR в USDT
-            cost_piece_usdt = matched_usdt
-            cost_usdt_total += cost_piece_usdt
-            
-            # Update lot
-            new_rem = (lot_rem - take).quantize(D("0.0000001"))
-            db.fiat_lots.update_one({"_id": lot["_id"]}, {"$set": {"remaining": float(new_rem)}})
-            
-            # НЕ логируем PnL для fiat_to_fiat, так как PnL будет при продаже EUR
-            
-            need -= take
-        
-        # Для fiat_to_fiat нет реализованной прибыли
-        realized_profit = 0.0
-        tx.profit_currency = "USDT"
-        
-        # Сохраняем себестоимость to_asset в USDT
-        if cost_usdt_total > eps:
-            rate_usdt_of_fiat_in = to_fiat_in / cost_usdt_total
-            tx.cost_usdt_of_fiat_in = float(cost_usdt_total.quantize(D("0.0001"), rounding=ROUND_HALF_UP))
-            tx.rate_usdt_of_fiat_in = float(rate_usdt_of_fiat_in.quantize(D("0.0001"), rounding=ROUND_HALF_UP))
-        
-        # Обновляем кассу
-        db.cash.update_one({"asset": tx.from_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": -tx.amount_from}})
-        db.cash.update_one({"asset": tx.to_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": tx.amount_to_final}})
-
-    elif tx.type == "crypto_to_fiat" and tx.from_asset == "USDT" and tx.to_asset in FIAT_ASSETS:
-        # Двухэтапная логика FIFO по фиатным лотам
-        def D(x): 
-            return Decimal(str(x))
-
-        fiat_currency   = tx.to_asset                     # 'CZK' | 'EUR' | 'USD'
-        fiat_out_fact   = D(tx.amount_to_final)           # сколько фиата реально отдали клиенту
-        usdt_in_fact    = D(tx.amount_from)               # сколько USDT получили от клиента
-        sell_rate       = D(tx.rate_used)                 # FIAT/USDT базовый курс
-        
-        # Эффективный курс = фактически выданный фиат / полученный USDT
-        sell_rate_eff = fiat_out_fact / usdt_in_fact
 
-        pnl_fiat = D(0)
-        pnl_usdt = D(0)
-        need     = fiat_out_fact
-        eps      = D("0.0000001")
-        
-        # ЭТАП 1: Берём из живых лотов (fiat_to_crypto)
-        while need > eps:
-            lot = db.fiat_lots.find_one(
-                {
-                    "currency": fiat_currency,
-                    "remaining": {"$gt": 0},
-                    "meta.source": "fiat_to_crypto",
-                    "tenant_id": tenant_id,
-                    "cash_desk_id": cash_desk_id
-                },
-                sort=[("created_at", 1)]
-            )
-            if not lot:
-                # Больше нет живых лотов, переходим на этап 2
-                break
-
-            lot_rem  = D(lot["remaining"])
-            lot_rate = D(lot["rate"])
-            take     = lot_rem if lot_rem <= need else need       # сколько забираем из этого лота
-            matched_usdt = take / sell_rate_eff                    # сколько USDT закрываем этим куском
-
-            # Этап 1: Считаем прибыль в ФИАТЕ (pnl_piece_fiat)
-            pnl_piece_fiat = (lot_rate - sell_rate_eff) * matched_usdt
-            pnl_fiat += pnl_piece_fiat
-
-            # --- УНИВЕРСАЛЬНЫЙ КОД (ИСПРАВЛЕНИЕ) ---
-            # Конвертируем прибыль в USDT для лога
-            # Формула: USDT = FIAT / (FIAT / USDT)
-            if sell_rate_eff == 0:
-                pnl_piece_usdt = D(0)
-            else:
-                # Эта формула теперь едина для ВСЕХ валют (CZK, EUR, USD)
-                pnl_piece_usdt = pnl_piece_fiat / sell_rate_eff
-            
-            pnl_usdt += pnl_piece_usdt
-            # --- Конец исправления ---
-
-            # уменьшаем остаток лота
-            new_rem = (lot_rem - take).quantize(D("0.0000001"))
-            db.fiat_lots.update_one({"_id": lot["_id"], "tenant_id": tenant_id}, {"$set": {"remaining": float(new_rem)}})
-
-            # лог матчинга (удобно для аудита/отчётов)
-            db.pnl_matches.insert_one({
-                "tenant_id": tenant_id,
-                "cash_desk_id": cash_desk_id,
-                "currency": fiat_currency,
-                "open_lot_id": str(lot["_id"]),
-                "close_tx_id": None,
-                "stage": 1,  # этап 1 - живые лоты
-                "fiat_used": float(take),
-                "matched_usdt": float(matched_usdt),
-                "lot_rate": float(lot_rate),
-                "sell_rate_eff": float(sell_rate_eff),
-                "pnl_fiat": float(pnl_piece_fiat),
-                "pnl_usdt": float(pnl_piece_usdt),
-                "created_at": datetime.utcnow()
-            })
+def _balance_error(tx: Transaction, from_balance: float, to_balance: float) -> Optional[str]:
+    """Проверяет, хватает ли кассе средств на обмен. Возвращает текст ошибки или None"""
+    if tx.type in ["fiat_to_crypto", "crypto_to_fiat"]:
+        # Касса выдаёт клиенту to_asset - проверяем, хватает ли его
+        if to_balance < tx.amount_to_final:
+            return f"Not enough {tx.to_asset} in cash"
+    elif tx.type == "fiat_to_fiat":
+        # Обмен фиата на фиат: проверяем баланс from_asset
+        if from_balance < tx.amount_from:
+            return f"Not enough {tx.from_asset} in cash"
+    return None
 
-            need -= take
-        
-        # ЭТАП 2: Если осталась потребность - берём из лотов fiat_to_fiat (обменных пунктов)
-        while need > eps:
-            lot = db.fiat_lots.find_one(
-                {
-                    "currency": fiat_currency,
-                    "remaining": {"$gt": 0},
-                    "meta.source": "fiat_to_fiat",
-                    "tenant_id": tenant_id,
-                    "cash_desk_id": cash_desk_id
-                },
-                sort=[("created_at", 1)]
-            )
-            if not lot:
-                # Нет лотов для данной валюты - выходим из цикла
-                print(f"WARNING: No {fiat_currency} fiat_to_fiat lots available for stage 2")
-                break
 
-            lot_rem  = D(lot["remaining"])
-            
-            # ✅ ПРАВИЛЬНЫЙ PnL расчет для fiat_to_fiat лотов:
-            # Берем себестоимость ВСЕГО лота из метаданных
-            cost_usdt_total_lot = D(str(lot["meta"].get("cost_usdt_of_fiat_in", 0)))
-            
-            take = lot_rem if lot_rem <= need else need
-            matched_usdt = take / sell_rate_eff  # сколько USDT получаем от клиента
-
-            # Находим себестоимость проданной части в USDT
-            # Полный лот был создан с размером X фиата и себестоимостью cost_usdt_total_lot
-            # Сейчас остаток lot_rem, значит изначально лот был (lot_rem + уже_потрачено)
-            # Но в метаданных cost_usdt_of_fiat_in относится к ОСТАТКУ лота!
-            portion = take / lot_rem  # какая доля ОСТАТКА продается
-            cost_usdt_portion = cost_usdt_total_lot * portion  # себестоимость в USDT
-            
-            # Этап 2: Считаем прибыль в USDT (pnl_piece_usdt)
-            pnl_piece_usdt = matched_usdt - cost_usdt_portion
-            pnl_usdt += pnl_piece_usdt
-
-            # --- УНИВЕРСАЛЬНЫЙ КОД (ИСПРАВЛЕНИЕ) ---
-            # Конвертируем прибыль в ФИАТ для итоговой суммы
-            # Формула: FIAT = USDT * (FIAT / USDT)
-            # Эта формула теперь едина для ВСЕХ валют (CZK, EUR, USD)
-            pnl_piece_fiat = pnl_piece_usdt * sell_rate_eff
-            
-            pnl_fiat += pnl_piece_fiat
-            # --- Конец исправления ---
-
-            # уменьшаем остаток лота
-            new_rem = (lot_rem - take).quantize(D("0.0000001"))
-            db.fiat_lots.update_one({"_id": lot["_id"]}, {"$set": {"remaining": float(new_rem)}})
-
-            # лог матчинга
-            db.pnl_matches.insert_one({
-                "tenant_id": tenant_id,
-                "cash_desk_id": cash_desk_id,
-                "currency": fiat_currency,
-                "open_lot_id": str(lot["_id"]),
-                "close_tx_id": None,
-                "stage": 2,  # этап 2 - обменные пункты
-                "fiat_used": float(take),
-                "matched_usdt": float(matched_usdt),
-                "lot_rate": float(take / cost_usdt_portion) if cost_usdt_portion > 0 else 0,  # эффективный курс лота
-                "sell_rate_eff": float(sell_rate_eff),
-                "pnl_fiat": float(pnl_piece_fiat),
-                "pnl_usdt": float(pnl_piece_usdt),
-                "cost_usdt_of_fiat_in": float(cost_usdt_total_lot),
-                "created_at": datetime.utcnow()
-            })
+def _transaction_response(tx: Transaction, realized_profit: float, fee_direction: str) -> dict:
+    """Ответ на создание обмена"""
+    return {
+        "type": tx.type,
+        "rate_used": tx.rate_used,
+        "rate_for_gleb_pnl": tx.rate_for_gleb_pnl,
+        "from_asset": tx.from_asset,
+        "to_asset": tx.to_asset,
+        "amount_from": tx.amount_from,
+        "amount_to_clean": tx.amount_to_clean,
+        "fee_percent": tx.fee_percent,
+        "fee_amount": tx.fee_amount,
+        "amount_to_final": tx.amount_to_final,
+        "profit": realized_profit,
+        "fee_direction": fee_direction,
+        "message": "Transaction processed successfully"
+    }
 
-            need -= take
-
-        # ЭТАП 3: Если осталась потребность - значит, она покрывается из депозитов (без PnL)
-        if need > eps:
-            matched_usdt = need / sell_rate_eff
-            db.pnl_matches.insert_one({
-                "tenant_id": tenant_id,
-                "cash_desk_id": cash_desk_id,
-                "currency": fiat_currency,
-                "open_lot_id": "deposit",
-                "close_tx_id": None,
-                "stage": 3,  # этап 3 - депозиты
-                "fiat_used": float(need),
-                "matched_usdt": float(matched_usdt),
-                "lot_rate": float(sell_rate_eff), # Себестоимость равна курсу продажи
-                "sell_rate_eff": float(sell_rate_eff),
-                "pnl_fiat": 0.0, # Депозиты не генерируют PnL
-                "pnl_usdt": 0.0,
-                "created_at": datetime.utcnow()
-            })
-            need = D(0)
 
-        # округляем и сохраняем в транзакцию
-        realized_profit_fiat = pnl_fiat.quantize(D("0.01"), rounding=ROUND_HALF_UP)
-        realized_profit_usdt = pnl_usdt.quantize(D("0.0001"), rounding=ROUND_HALF_UP)
+@router.post("")
+def create_transaction(
+    tx: Transaction, 
+    cash_desk_id: str,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Проводит обмен; повтор с тем же Idempotency-Key возвращает сохранённый ответ без повторной записи"""
+    return idempotency_manager.run(
+        tenant_id,
+        idempotency_key,
+        "create_transaction",
+        {"cash_desk_id": cash_desk_id, **tx.dict(exclude_unset=True)},
+        lambda: _create_transaction(tx, cash_desk_id, background_tasks, tenant_id)
+    )
 
-        realized_profit = float(realized_profit_fiat)        # profit в валюте транзакции
-        tx.profit_currency = fiat_currency
-        # tx.profit_usdt = float(realized_profit_usdt)   # можно добавить в модель при необходимости
 
-    # Для fiat_to_fiat: создаём лот для to_asset (EUR) с сохранённой себестоимостью в USDT
-    # Этот лот будет использован на следующем этапе (в crypto_to_fiat)
-    if tx.type == "fiat_to_fiat" and tx.cost_usdt_of_fiat_in and tx.cost_usdt_of_fiat_in > 0:
-        def D(x): 
-            return Decimal(str(x))
-        
-        fiat_currency_to = tx.to_asset
-        fiat_in_fact_to = D(str(tx.amount_to_final))
-        
-        # Курс to_asset/USDT на основе себестоимости
-        lot_rate_to = fiat_in_fact_to / D(str(tx.cost_usdt_of_fiat_in))
-        
-        db.fiat_lots.insert_one({
-            "tenant_id": tenant_id,
-            "cash_desk_id": cash_desk_id,             # Фаза 2: изоляция по кассе
-            "currency": fiat_currency_to,
-            "remaining": float(fiat_in_fact_to),
-            "rate": float(lot_rate_to),
-            "tx_id": None,  # будем заполнять после создания транзакции
-            "created_at": datetime.utcnow(),
-            "meta": {
-                "source": "fiat_to_fiat",
-                "cost_usdt_of_fiat_in": float(tx.cost_usdt_of_fiat_in),
-                "rate_usdt_of_fiat_in": float(tx.rate_usdt_of_fiat_in)
-            }
-        })
+def _create_transaction(tx: Transaction, cash_desk_id: str, background_tasks: BackgroundTasks, tenant_id: str):
+    # Фаза 2: Проверяем доступ к кассе
+    cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
     
-    # Обновляем кассу ТОЛЬКО после успешного расчета прибыли (если это crypto_to_fiat)
-    if tx.type == "crypto_to_fiat":
-        db.cash.update_one({"asset": tx.to_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": -tx.amount_to_final}})
-        db.cash.update_one({"asset": tx.from_asset, "cash_desk_id": cash_desk_id}, {"$inc": {"balance": tx.amount_from}})
-
+    # Устанавливаем идентификаторы для изоляции данных
+    tx.tenant_id = tenant_id
+    tx.cash_desk_id = cash_desk_id
+    
+    fee_direction = _price_transaction(tx)
+
+    # --- FIFO по книге лотов кассы в памяти процесса (сверяется с версией кассы) ---
+    # Книга берётся до чтения балансов: запись проверит, что версия кассы с тех пор не менялась
+    demand = fifo_engine.lot_demand(tx.dict())
+    book, book_version = lot_book_cache.checkout(cash_desk_id, {demand[0]: demand[1]} if demand else {})
+
+    # Отсутствующие строки кассы создаются при записи ($inc с upsert)
+    from_cash = db.cash.find_one({"asset": tx.from_asset, "cash_desk_id": cash_desk_id}) or {"balance": 0.0}
+    to_cash = db.cash.find_one({"asset": tx.to_asset, "cash_desk_id": cash_desk_id}) or {"balance": 0.0}
+
+    balance_error = _balance_error(tx, from_cash["balance"], to_cash["balance"])
+    if balance_error:
+        lot_book_cache.checkin(cash_desk_id, book, book_version)
+        raise HTTPException(status_code=400, detail=balance_error)
+
+    now = datetime.utcnow()
+    # _id транзакции выделяется заранее - лоты и матчи записываются уже со ссылкой на неё
+    tx_id = ObjectId()
+    fifo = fifo_engine.apply({**tx.dict(), "_id": tx_id}, book, now)
+
+    consumed = fifo["consumed"]
+    realized_profit = fifo["realized_profit"]
+    realized_profit_usdt = fifo["realized_profit_usdt"]
+    tx.profit_currency = fifo["profit_currency"]
+    tx.cost_usdt_of_fiat_in = fifo["cost_usdt_of_fiat_in"]
+    tx.rate_usdt_of_fiat_in = fifo["rate_usdt_of_fiat_in"]
     tx.profit = float(realized_profit)
 
     tx_data = tx.dict()
-    tx_data["created_at"] = datetime.utcnow()
+    tx_data["_id"] = tx_id
+    tx_data["created_at"] = now
     tx_data["is_modified"] = False
     tx_data["realized_profit"] = float(realized_profit)
+    tx_data["realized_profit_usdt"] = float(realized_profit_usdt)
+
+    # --- Запись результата: лоты, матчи, касса и транзакция - одной транзакцией MongoDB ---
+    cash_assets = [tx.from_asset, tx.to_asset]
+    match_ids = {}
+    written = {}
+
+    def apply(session):
+        # Строки кассы до изменения - для снимка истории, который пишется после фиксации
+        written["cash"] = history_manager.cash_images(tenant_id, cash_desk_id, cash_assets, session=session)
+        if consumed:
+            db.fiat_lots.bulk_write([
+                UpdateOne({"_id": item["lot"]["_id"]}, {"$set": {"remaining": money_storage.value(item["remaining"])}})
+                for item in consumed
+            ], ordered=False, session=session)
+        if fifo["new_lots"]:
+            db.fiat_lots.insert_many(money_storage.encode_many("fiat_lots", fifo["new_lots"]), session=session)
+        if fifo["matches"]:
+            match_ids.update(pnl_match_store.insert(fifo["matches"], session=session))
+        if fifo["cash_deltas"]:
+            db.cash.bulk_write([
+                UpdateOne(
+                    {"asset": asset, "cash_desk_id": cash_desk_id},
+                    {"$inc": {"balance": money_storage.value(delta)}, "$setOnInsert": {"tenant_id": tenant_id}},
+                    upsert=True
+                )
+                for asset, delta in fifo["cash_deltas"]
+            ], session=session)
+        db.transactions.insert_one(money_storage.encode("transactions", tx_data), session=session)
+        # Агрегаты лотов меняются вместе с самими лотами
+        lot_stats_manager.apply_lot_changes(cash_desk_id, tenant_id, fifo["new_lots"], consumed, session=session)
+        # Балансы и лоты посчитаны по версии book_version - запись отменяется, если касса успела измениться
+        written["version"] = desk_version_manager.advance(cash_desk_id, book_version, tenant_id, session=session)
 
-    result = db.transactions.insert_one(tx_data)
-    tx_data["_id"] = result.inserted_id
+    try:
+        history_manager.run_in_transaction(apply)
+    except DeskVersionConflict:
+        raise HTTPException(status_code=409, detail="Cash desk was changed by another operation, please retry")
+    # Книга уже содержит результат обмена - возвращаем её в кэш под новой версией кассы
+    lot_book_cache.commit(cash_desk_id, book, book_version, written["version"])
+
+    # Снимок для отмены: исходные версии строк кассы и списанных лотов, ID вставленных документов
+    snapshot_id = history_manager.save_snapshot(
+        operation_type="create_transaction",
+        description=f"Creating {tx.type}: {tx.from_asset} → {tx.to_asset}",
+        tenant_id=tenant_id,
+        cash_desk_id=cash_desk_id,
+        cash_assets=cash_assets,
+        before={"cash": written["cash"], "fiat_lots": [item["lot"] for item in consumed]}
+    )
+    history_manager.record_changes(
+        snapshot_id,
+        inserted={"fiat_lots": [lot["_id"] for lot in fifo["new_lots"]], **match_ids, "transactions": [tx_id]}
+    )
+    desk_stats_manager.record_transaction(tx_data)
+    rollup_manager.record_transaction(tx_data)
+    # Лоты, исчерпанные FIFO-списанием, переносятся в архив после записи транзакции
+    exhausted_lot_ids = [item["lot"]["_id"] for item in consumed if item["remaining"] <= 0]
+    if exhausted_lot_ids:
+        background_tasks.add_task(lot_archive_manager.archive_lots, exhausted_lot_ids)
     
     # Добавляем в Google Sheets
     sheets_manager.add_transaction(tx_data, tenant_id=tenant_id, cash_desk_id=cash_desk_id)
@@ -466,32 +283,217 @@ def create_transaction(
         
         # Обновляем прибыль, если есть profit_currency
         if tx_data.get("profit") and tx_data.get("profit_currency"):
-            # Вычисляем общую прибыль по валюте для данной кассы
-            pipeline = [
-                {"$match": {"tenant_id": tenant_id, "cash_desk_id": cash_desk_id, "profit_currency": tx_data["profit_currency"]}},
-                {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-            ]
-            profit_results = list(db.transactions.aggregate(pipeline))
-            if profit_results:
-                total_profit = profit_results[0]["total_realized_profit"]
+            # Общая прибыль по валюте для данной кассы (из счётчиков desk_stats)
+            profits = desk_stats_manager.get_profits(cash_desk_id=cash_desk_id, tenant_id=tenant_id)
+            if tx_data["profit_currency"] in profits:
+                total_profit = profits[tx_data["profit_currency"]]
                 sheets_manager.update_profit_for_desk(cash_desk_name, tx_data["profit_currency"], total_profit, tenant_id)
     except Exception as e:
         print(f"Failed to update summary sheet: {e}")
 
+    return _transaction_response(tx, realized_profit, fee_direction)
+
+
+@router.post("/batch")
+def create_transactions_batch(
+    batch: TransactionBatch,
+    cash_desk_id: str,
+    background_tasks: BackgroundTasks,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """
+    Проводит пачку обменов одной кассы по порядку.
+
+    Позиции считаются против балансов и книги лотов в памяти, затем лоты, матчи, касса
+    и транзакции записываются пакетно в одной транзакции MongoDB под одним снимком истории.
+    Google Sheets и Telegram обновляются один раз на пачку.
+    atomic=true - при ошибке любой позиции пакет отклоняется целиком,
+    atomic=false - ошибочные позиции пропускаются и возвращаются в results
+    """
+    cash_desk = verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    if not batch.transactions:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(batch.transactions) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch is limited to {MAX_BATCH_SIZE} transactions")
+
+    # --- Расчёт сумм и комиссий ---
+    errors = {}
+    fee_directions = {}
+    for index, tx in enumerate(batch.transactions):
+        tx.tenant_id = tenant_id
+        tx.cash_desk_id = cash_desk_id
+        try:
+            fee_directions[index] = _price_transaction(tx)
+        except HTTPException as e:
+            errors[index] = e.detail
+        except ArithmeticError as e:
+            errors[index] = f"Invalid amount or rate: {e}"
+
+    # --- Проведение по балансам и книге лотов в памяти ---
+    # Лоты грузятся до покрытия суммарной потребности пакета по каждой валюте
+    needs = {}
+    for index, tx in enumerate(batch.transactions):
+        demand = fifo_engine.lot_demand(tx.dict()) if index not in errors else None
+        if demand:
+            needs[demand[0]] = needs.get(demand[0], 0.0) + demand[1]
+    book, book_version = lot_book_cache.checkout(cash_desk_id, needs)
+    # Балансы читаются после книги - запись проверит, что версия кассы с тех пор не менялась
+    balances = {row["asset"]: row["balance"] for row in db.cash.find({"cash_desk_id": cash_desk_id})}
+
+    now = datetime.utcnow()
+    processed = []
+    failed_index = None  # позиция, на которой упало списание лотов
+    for index, tx in enumerate(batch.transactions):
+        if index in errors:
+            continue
+        if failed_index is not None:
+            # Упавшее списание могло частично изменить книгу - дальше по ней считать нельзя
+            errors[index] = f"Skipped: lot matching failed at item {failed_index}"
+            continue
+        balance_error = _balance_error(tx, balances.get(tx.from_asset, 0.0), balances.get(tx.to_asset, 0.0))
+        if balance_error:
+            errors[index] = balance_error
+            continue
+
+        # Миллисекундный шаг сохраняет порядок пачки для FIFO и пересборки
+        created_at = now + timedelta(milliseconds=index)
+        tx_id = ObjectId()
+        try:
+            fifo = fifo_engine.apply({**tx.dict(), "_id": tx_id}, book, created_at)
+        except (ArithmeticError, ValueError) as e:
+            errors[index] = f"Invalid amount or rate: {e}"
+            failed_index = index
+            continue
+        for asset, delta in fifo["cash_deltas"]:
+            balances[asset] = balances.get(asset, 0.0) + delta
+
+        tx.profit_currency = fifo["profit_currency"]
+        tx.cost_usdt_of_fiat_in = fifo["cost_usdt_of_fiat_in"]
+        tx.rate_usdt_of_fiat_in = fifo["rate_usdt_of_fiat_in"]
+        tx.profit = float(fifo["realized_profit"])
+
+        tx_data = tx.dict()
+        tx_data["_id"] = tx_id
+        tx_data["created_at"] = created_at
+        tx_data["is_modified"] = False
+        tx_data["realized_profit"] = float(fifo["realized_profit"])
+        tx_data["realized_profit_usdt"] = float(fifo["realized_profit_usdt"])
+        processed.append({"index": index, "tx": tx, "fifo": fifo, "tx_data": tx_data})
+
+    error_list = [{"index": index, "detail": detail} for index, detail in sorted(errors.items())]
+    if errors and batch.atomic:
+        raise HTTPException(status_code=400, detail={"message": "Batch rejected", "errors": error_list})
+
+    # --- Пакетная запись ---
+    new_lots = [lot for item in processed for lot in item["fifo"]["new_lots"]]
+    new_lot_ids = {lot["_id"] for lot in new_lots}
+    lots_before = {}      # исходная версия каждого списанного лота
+    final_remaining = {}  # остаток лота после всей пачки
+    for item in processed:
+        for consumed in item["fifo"]["consumed"]:
+            lot_id = consumed["lot"]["_id"]
+            if lot_id not in new_lot_ids:
+                lots_before.setdefault(lot_id, consumed["lot"])
+                final_remaining[lot_id] = consumed["remaining"]
+    matches = [match for item in processed for match in item["fifo"]["matches"]]
+    tx_docs = [item["tx_data"] for item in processed]
+    cash_deltas = {}
+    for item in processed:
+        for asset, delta in item["fifo"]["cash_deltas"]:
+            cash_deltas[asset] = cash_deltas.get(asset, 0.0) + delta
+
+    snapshot_id = None
+    if processed:
+        match_ids = {}
+        written = {}
+
+        def apply(session):
+            written["cash"] = history_manager.cash_images(tenant_id, cash_desk_id, list(cash_deltas), session=session)
+            if new_lots:
+                db.fiat_lots.insert_many(money_storage.encode_many("fiat_lots", new_lots), session=session)
+            if final_remaining:
+                db.fiat_lots.bulk_write([
+                    UpdateOne({"_id": lot_id}, {"$set": {"remaining": money_storage.value(remaining)}})
+                    for lot_id, remaining in final_remaining.items()
+                ], ordered=False, session=session)
+            if matches:
+                match_ids.update(pnl_match_store.insert(matches, session=session))
+            if cash_deltas:
+                db.cash.bulk_write([
+                    UpdateOne(
+                        {"asset": asset, "cash_desk_id": cash_desk_id},
+                        {"$inc": {"balance": money_storage.value(delta)}, "$setOnInsert": {"tenant_id": tenant_id}},
+                        upsert=True
+                    )
+                    for asset, delta in cash_deltas.items()
+                ], ordered=False, session=session)
+            db.transactions.insert_many(money_storage.encode_many("transactions", tx_docs), session=session)
+            # Агрегаты лотов пересобираются один раз на пачку - в той же транзакции
+            lot_stats_manager.rebuild(cash_desk_id, tenant_id, session=session)
+            written["version"] = desk_version_manager.advance(cash_desk_id, book_version, tenant_id, session=session)
+
+        try:
+            history_manager.run_in_transaction(apply)
+        except DeskVersionConflict:
+            raise HTTPException(status_code=409, detail="Cash desk was changed by another operation, please retry")
+        # Книга после упавшего списания не совпадает с записанным - в кэш она не возвращается,
+        # следующая операция загрузит её из базы
+        if failed_index is None:
+            lot_book_cache.commit(cash_desk_id, book, book_version, written["version"])
+        snapshot_id = history_manager.save_snapshot(
+            operation_type="create_transactions_batch",
+            description=f"Creating batch of {len(processed)} transactions",
+            tenant_id=tenant_id,
+            cash_desk_id=cash_desk_id,
+            cash_assets=list(cash_deltas),
+            before={"cash": written["cash"], "fiat_lots": list(lots_before.values())}
+        )
+        history_manager.record_changes(snapshot_id, inserted={
+            "fiat_lots": list(new_lot_ids),
+            **match_ids,
+            "transactions": [tx_data["_id"] for tx_data in tx_docs]
+        })
+
+        desk_stats_manager.apply_changes([], tx_docs)
+        for tx_data in tx_docs:
+            rollup_manager.record_transaction(tx_data)
+
+        exhausted_lot_ids = [lot_id for lot_id, remaining in final_remaining.items() if remaining <= 0]
+        exhausted_lot_ids += [lot["_id"] for lot in new_lots if lot["remaining"] <= 0]
+        if exhausted_lot_ids:
+            background_tasks.add_task(lot_archive_manager.archive_lots, exhausted_lot_ids)
+
+        # Одно обновление Google Sheets и одно сообщение в Telegram на пачку
+        background_tasks.add_task(sheets_manager.add_transactions, tx_docs, tenant_id=tenant_id, cash_desk_id=cash_desk_id)
+        chat_id = cash_desk.telegram_chat_id or os.getenv("TELEGRAM_CHAT_ID")
+        if chat_id:
+            message = telegram_manager.format_batch_message(
+                cash_desk.name,
+                tx_docs,
+                {asset: balances[asset] for asset in cash_deltas}
+            )
+            background_tasks.add_task(telegram_manager.send_message_async, chat_id, message)
+    elif failed_index is None:
+        # Ни одна позиция не проведена - книга не менялась
+        lot_book_cache.checkin(cash_desk_id, book, book_version)
+
+    results = [{"index": error["index"], "status": "error", "detail": error["detail"]} for error in error_list]
+    for item in processed:
+        results.append({
+            "index": item["index"],
+            "status": "ok",
+            "transaction_id": str(item["tx_data"]["_id"]),
+            **_transaction_response(item["tx"], item["tx_data"]["realized_profit"], fee_directions[item["index"]])
+        })
+    results.sort(key=lambda result: result["index"])
+
     return {
-        "type": tx.type,
-        "rate_used": tx.rate_used,
-        "rate_for_gleb_pnl": tx.rate_for_gleb_pnl,
-        "from_asset": tx.from_asset,
-        "to_asset": tx.to_asset,
-        "amount_from": tx.amount_from,
-        "amount_to_clean": tx.amount_to_clean,
-        "fee_percent": tx.fee_percent,
-        "fee_amount": tx.fee_amount,
-        "amount_to_final": tx.amount_to_final,
-        "profit": realized_profit,
-        "fee_direction": fee_direction,
-        "message": "Transaction processed successfully"
+        "message": f"{len(processed)} of {len(batch.transactions)} transactions processed",
+        "atomic": batch.atomic,
+        "processed": len(processed),
+        "failed": len(errors),
+        "snapshot_id": snapshot_id,
+        "results": results
     }
 
 
@@ -692,13 +694,19 @@ def export_transactions_simple_csv(tenant_id: str = Depends(get_current_tenant))
 
 
 @router.get("/fiat-lots")
-def get_fiat_lots(cash_desk_id: Optional[str] = None, tenant_id: str = Depends(get_current_tenant)):
-    """Получить фиатные лоты (для конкретной кассы или всех)"""
+def get_fiat_lots(
+    cash_desk_id: Optional[str] = None,
+    include_archived: bool = False,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Получить фиатные лоты (для конкретной кассы или всех), по запросу - вместе с архивными"""
     filter_query = {"tenant_id": tenant_id}
     if cash_desk_id:
         filter_query["cash_desk_id"] = cash_desk_id
     
     lots = list(db.fiat_lots.find(filter_query))
+    if include_archived:
+        lots.extend(lot_archive_manager.find(filter_query))
     for lot in lots:
         lot["_id"] = str(lot["_id"])
     return {"lots": lots}
@@ -711,29 +719,50 @@ def get_pnl_matches(cash_desk_id: Optional[str] = None, tenant_id: str = Depends
     if cash_desk_id:
         filter_query["cash_desk_id"] = cash_desk_id
     
-    matches = list(db.pnl_matches.find(filter_query))
-    for match in matches:
-        match["_id"] = str(match["_id"])
-    return {"matches": matches}
+    return {"matches": pnl_match_store.find(filter_query)}
+
+
+@router.post("/fiat-lots/archive")
+def archive_fiat_lots(cash_desk_id: Optional[str] = None, tenant_id: str = Depends(get_current_tenant)):
+    """Переносит все исчерпанные лоты в fiat_lots_archive (для кассы или всех касс tenant'а)"""
+    if cash_desk_id:
+        verify_cash_desk_access_util(cash_desk_id, tenant_id)
+    
+    archived = lot_archive_manager.archive_exhausted(tenant_id, cash_desk_id)
+    return {
+        "message": "Exhausted fiat lots archived",
+        "archived_count": archived,
+        "cash_desk_id": cash_desk_id,
+        "tenant_id": tenant_id
+    }
 
 
 @router.get("/fiat-lots/{currency}")
-def get_fiat_lots_by_currency(currency: str, cash_desk_id: Optional[str] = None, tenant_id: str = Depends(get_current_tenant)):
-    """Получить фиатные лоты по валюте (для конкретной кассы или всех)"""
+def get_fiat_lots_by_currency(
+    currency: str,
+    cash_desk_id: Optional[str] = None,
+    include_archived: bool = False,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """Получить фиатные лоты по валюте (для конкретной кассы или всех), по запросу - вместе с архивными"""
     filter_query = {"currency": currency, "tenant_id": tenant_id}
     if cash_desk_id:
         filter_query["cash_desk_id"] = cash_desk_id
     
     lots = list(db.fiat_lots.find(filter_query))
+    if include_archived:
+        lots.extend(lot_archive_manager.find(filter_query))
     for lot in lots:
         lot["_id"] = str(lot["_id"])
     
-    total_remaining = sum(lot["remaining"] for lot in lots)
+    # Остаток берём из агрегатов lot_stats, а не суммируем по лотам
+    summary = lot_stats_manager.get_summary(currency, cash_desk_id=cash_desk_id, tenant_id=tenant_id)
     
     return {
         "currency": currency,
         "lots": lots,
-        "total_remaining": total_remaining
+        "total_remaining": summary["total_remaining"],
+        "summary": summary
     }
 
 
@@ -754,26 +783,30 @@ def get_profit_summary(
         # Агрегированный режим по всем кассам tenant'а
         filter_query = {"currency": currency, "tenant_id": tenant_id}
     
-    # Общая прибыль из PnL матчей
-    matches = list(db.pnl_matches.find(filter_query))
-    total_pnl_fiat = sum(match["pnl_fiat"] for match in matches)
-    total_pnl_usdt = sum(match["pnl_usdt"] for match in matches)
+    # Общая прибыль из PnL матчей (суммы корзин посчитаны заранее)
+    pnl_totals = pnl_match_store.totals(filter_query)
+    total_pnl_fiat = pnl_totals["pnl_fiat"]
+    total_pnl_usdt = pnl_totals["pnl_usdt"]
     
-    # Оставшиеся лоты
-    lots = list(db.fiat_lots.find({**filter_query, "remaining": {"$gt": 0}}))
-    remaining_value = sum(lot["remaining"] for lot in lots)
+    # Оставшиеся лоты: остаток, количество и средневзвешенный курс из агрегатов lot_stats
+    lots_summary = lot_stats_manager.get_summary(currency, cash_desk_id=cash_desk_id, tenant_id=tenant_id)
+    remaining_value = lots_summary["total_remaining"]
     
-    # Анализ курсов активных лотов
+    # Анализ курсов активных лотов (min/max/avg считаются на стороне MongoDB)
     rates_info = {}
-    if lots:
-        rates = [lot["rate"] for lot in lots]
-        weighted_avg_rate = sum(lot["rate"] * lot["remaining"] for lot in lots) / remaining_value if remaining_value > 0 else 0
-        rates_info = {
-            "min_rate": round(min(rates), 5),
-            "max_rate": round(max(rates), 5),
-            "avg_rate": round(sum(rates) / len(rates), 5),
-            "weighted_avg_rate": round(weighted_avg_rate, 5)
-        }
+    if lots_summary["count"] > 0:
+        rates_pipeline = [
+            {"$match": {**filter_query, "remaining": {"$gt": 0}}},
+            {"$group": {"_id": None, "min_rate": {"$min": "$rate"}, "max_rate": {"$max": "$rate"}, "avg_rate": {"$avg": "$rate"}}}
+        ]
+        rates = next(db.fiat_lots.aggregate(rates_pipeline), None)
+        if rates:
+            rates_info = {
+                "min_rate": round(rates["min_rate"], 5),
+                "max_rate": round(rates["max_rate"], 5),
+                "avg_rate": round(rates["avg_rate"], 5),
+                "weighted_avg_rate": round(lots_summary["weighted_avg_rate"], 5)
+            }
     
     # Количество транзакций
     if cash_desk_id:
@@ -790,15 +823,29 @@ def get_profit_summary(
             "usdt": round(total_pnl_usdt, 4)
         },
         "remaining_lots": {
-            "count": len(lots),
-            "total_value": round(remaining_value, 2)
+            "count": lots_summary["count"],
+            "total_value": round(remaining_value, 2),
+            "oldest_open_at": lots_summary["oldest_open_at"]
         },
         "rates_info": rates_info,
         "transactions": {
             "buy_count": buy_txs,
             "sell_count": sell_txs
         },
-        "pnl_matches_count": len(matches)
+        "pnl_matches_count": pnl_totals["count"]
+    }
+
+
+@router.get("/{transaction_id}/matches")
+def get_transaction_matches(transaction_id: str, tenant_id: str = Depends(get_current_tenant)):
+    """PnL матчи, закрытые транзакцией (какие лоты списала продажа) - корзина по _id и матчи по индексу close_tx_id"""
+    matches = pnl_match_store.for_transaction(transaction_id, tenant_id)
+    return {
+        "transaction_id": transaction_id,
+        "matches": matches,
+        "total_fiat_used": sum(match.get("fiat_used", 0) for match in matches),
+        "total_pnl_fiat": sum(match.get("pnl_fiat", 0) for match in matches),
+        "total_pnl_usdt": sum(match.get("pnl_usdt", 0) for match in matches)
     }
 
 
@@ -833,7 +880,8 @@ def update_transaction(transaction_id: str, update_data: TransactionUpdate, tena
             operation_type="update_transaction",
             description=f"Updating transaction {transaction_id}",
             tenant_id=tenant_id,
-            cash_desk_id=existing_tx.get("cash_desk_id")
+            cash_desk_id=existing_tx.get("cash_desk_id"),
+            before={"transactions": [existing_tx]}
         )
         
         # Подготавливаем данные для обновления
@@ -889,14 +937,27 @@ def update_transaction(transaction_id: str, update_data: TransactionUpdate, tena
                 "profit": temp_tx.profit
             })
         
-        # Обновляем транзакцию
-        result = db.transactions.update_one(
-            {"_id": ObjectId(transaction_id)},
-            {"$set": update_fields}
-        )
+        # Обновляем транзакцию и версию кассы одной транзакцией MongoDB
+        written = {}
+        
+        def apply(session):
+            written["result"] = db.transactions.update_one(
+                {"_id": ObjectId(transaction_id)},
+                {"$set": money_storage.encode("transactions", update_fields)},
+                session=session
+            )
+            if written["result"].modified_count > 0 and existing_tx.get("cash_desk_id"):
+                desk_version_manager.advance(existing_tx["cash_desk_id"], tenant_id=tenant_id, session=session)
+        
+        history_manager.run_in_transaction(apply)
+        result = written["result"]
         
         if result.modified_count > 0:
             updated_tx = db.transactions.find_one({"_id": ObjectId(transaction_id)})
+            # Счётчики кассы и дневные агрегаты: вычитаем прежнюю версию транзакции и учитываем новую
+            desk_stats_manager.apply_changes([existing_tx], [updated_tx])
+            rollup_manager.remove_transaction(existing_tx)
+            rollup_manager.record_transaction(updated_tx)
             updated_tx["_id"] = str(updated_tx["_id"])
             
             # Обновляем в Google Sheets
@@ -911,12 +972,7 @@ def update_transaction(transaction_id: str, update_data: TransactionUpdate, tena
                 cash_items = list(db.cash.find({"tenant_id": tenant_id}, {"_id": 0}))
                 cash_status = {item["asset"]: item["balance"] for item in cash_items}
                 
-                pipeline = [
-                    {"$match": {"tenant_id": tenant_id}},
-                    {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-                ]
-                profit_results = list(db.transactions.aggregate(pipeline))
-                realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+                realized_profits = desk_stats_manager.get_profits(tenant_id=tenant_id)
                 
                 sheets_manager.update_cash_and_profits(cash_status, realized_profits, tenant_id)
             except Exception as e:
@@ -949,11 +1005,15 @@ def delete_transaction(transaction_id: str, cash_desk_id: str, tenant_id: str =
             operation_type="delete_transaction",
             description=f"Deleting transaction {transaction_id}",
             tenant_id=tenant_id,
-            cash_desk_id=cash_desk_id
+            cash_desk_id=cash_desk_id,
+            before={"transactions": [existing_tx]}
         )
         
         result = db.transactions.delete_one({"_id": ObjectId(transaction_id)})
         if result.deleted_count > 0:
+            desk_stats_manager.remove_transaction(existing_tx)
+            rollup_manager.remove_transaction(existing_tx)
+            
             # Удаляем из Google Sheets
             sheets_manager.delete_transaction(
                 transaction_id, 
@@ -966,12 +1026,7 @@ def delete_transaction(transaction_id: str, cash_desk_id: str, tenant_id: str =
                 cash_items = list(db.cash.find({"tenant_id": tenant_id}, {"_id": 0}))
                 cash_status = {item["asset"]: item["balance"] for item in cash_items}
                 
-                pipeline = [
-                    {"$match": {"tenant_id": tenant_id}},
-                    {"$group": {"_id": "$profit_currency", "total_realized_profit": {"$sum": "$realized_profit"}}}
-                ]
-                profit_results = list(db.transactions.aggregate(pipeline))
-                realized_profits = {r["_id"]: r["total_realized_profit"] for r in profit_results if r["_id"]}
+                realized_profits = desk_stats_manager.get_profits(tenant_id=tenant_id)
                 
                 sheets_manager.update_cash_and_profits(cash_status, realized_profits, tenant_id)
             except Exception as e:
@@ -1006,6 +1061,16 @@ def calculate_transaction_preview(
         # Устанавливаем идентификаторы для изоляции данных
         tx.tenant_id = tenant_id
         tx.cash_desk_id = cash_desk_id
+
+        # Повторный предпросмотр неизменной кассы отдаём из кэша.
+        # Версия читается до расчёта: запись, прошедшая во время расчёта, сменит версию
+        cache_key = preview_cache.make_key(
+            cash_desk_id, desk_version_manager.get(cash_desk_id),
+            tx.type, tx.from_asset, tx.to_asset, tx.amount_from, tx.rate_used, tx.fee_percent
+        )
+        cached = preview_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # --- 1. Расчет сумм (копируем логику из create_transaction) ---
         if tx.type not in ["fiat_to_crypto", "crypto_to_fiat", "fiat_to_fiat"]:
@@ -1095,15 +1160,8 @@ def calculate_transaction_preview(
             eps = D("0.0000001")
             cost_usdt_total = D(0)
             
-            # Загружаем все лоты в память для симуляции
-            lots_in_memory = list(db.fiat_lots.find(
-                {
-                    "currency": from_asset_currency, 
-                    "remaining": {"$gt": 0},
-                    "cash_desk_id": cash_desk_id
-                },
-                sort=[("created_at", 1)]
-            ))
+            # Копии открытых лотов из книги кассы в памяти (симуляция их не меняет)
+            lots_in_memory = lot_book_cache.open_lots(cash_desk_id, from_asset_currency, tx.amount_from)
             
             for lot in lots_in_memory:
                 if need <= eps: break
@@ -1153,16 +1211,11 @@ def calculate_transaction_preview(
             need = fiat_out_fact
             eps = D("0.0000001")
 
+            # Лоты обоих этапов - копии из книги кассы в памяти
+            covering_lots = lot_book_cache.open_lots(cash_desk_id, fiat_currency, tx.amount_to_final)
+
             # STAGE 1 (Read-Only)
-            stage1_lots = list(db.fiat_lots.find(
-                {
-                    "currency": fiat_currency,
-                    "remaining": {"$gt": 0},
-                    "meta.source": "fiat_to_crypto",
-                    "cash_desk_id": cash_desk_id
-                },
-                sort=[("created_at", 1)]
-            ))
+            stage1_lots = [lot for lot in covering_lots if lot.get("meta", {}).get("source") == "fiat_to_crypto"]
 
             for lot in stage1_lots:
                 if need <= eps: break
@@ -1198,15 +1251,7 @@ def calculate_transaction_preview(
                 need -= take
 
             # STAGE 2 (Read-Only)
-            stage2_lots = list(db.fiat_lots.find(
-                {
-                    "currency": fiat_currency,
-                    "remaining": {"$gt": 0},
-                    "meta.source": "fiat_to_fiat",
-                    "cash_desk_id": cash_desk_id
-                },
-                sort=[("created_at", 1)]
-            ))
+            stage2_lots = [lot for lot in covering_lots if lot.get("meta", {}).get("source") == "fiat_to_fiat"]
 
             for lot in stage2_lots:
                 if need <= eps: break
@@ -1290,7 +1335,7 @@ def calculate_transaction_preview(
              }
         
         # --- 6. Формируем ответ (используя структуру из старой функции) ---
-        return {
+        preview = {
             "transaction_preview": {
                 "type": tx.type,
                 "from_asset": tx.from_asset,
@@ -1310,8 +1355,48 @@ def calculate_transaction_preview(
             "matched_lots": matched_lots_preview,
             "warnings": ["Preview mode: No data was saved."]
         }
+        preview_cache.put(cache_key, preview)
+        return preview
         
     except Exception as e:
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=400, detail=f"Error calculating preview: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=f"Error calculating preview: {str(e)}")
+
+
+@router.post("/calculate-preview/ladder")
+def calculate_preview_ladder(
+    request: PreviewLadderRequest,
+    cash_desk_id: str,
+    tenant_id: str = Depends(get_current_tenant)
+):
+    """
+    Предпросмотр обмена сразу для нескольких сумм и/или курсов.
+    Возвращает сетку (строки - суммы, столбцы - курсы): сумму к выдаче, комиссию,
+    прогноз реализованной прибыли по FIFO и достаточность кассы. Ничего не сохраняет
+    """
+    verify_cash_desk_access_util(cash_desk_id, tenant_id)
+
+    if request.type not in ["fiat_to_crypto", "crypto_to_fiat", "fiat_to_fiat"]:
+        raise HTTPException(status_code=400, detail="Invalid transaction type")
+
+    amounts = request.amounts or ([request.amount_from] if request.amount_from is not None else [])
+    rates = request.rates or ([request.rate_used] if request.rate_used is not None else [])
+    if not amounts or not rates:
+        raise HTTPException(status_code=400, detail="At least one amount and one rate are required")
+    if any(value <= 0 for value in amounts + rates):
+        raise HTTPException(status_code=400, detail="Amounts and rates must be positive")
+    if len(amounts) * len(rates) > MAX_LADDER_CELLS:
+        raise HTTPException(status_code=400, detail=f"Ladder is limited to {MAX_LADDER_CELLS} cells")
+
+    result = preview_ladder.calculate(
+        cash_desk_id,
+        request.type,
+        request.from_asset,
+        request.to_asset,
+        amounts,
+        rates,
+        request.fee_percent or 0.0
+    )
+    result["warnings"] = ["Preview mode: No data was saved."]
+    return result
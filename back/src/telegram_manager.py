@@ -85,6 +85,32 @@ class TelegramManager:
             
         return message
 
+    def format_batch_message(self, cash_desk_name: str, transactions: list, balances: dict = None) -> str:
+        """
+        Форматирует одно сводное сообщение о пачке обменов.
+        """
+        message = f"*🔄 Пакет обменов ({cash_desk_name})*\n\n"
+        for tx_data in transactions:
+            message += (
+                f"• {tx_data.get('amount_from', 0):.2f} {tx_data.get('from_asset', '')} → "
+                f"{tx_data.get('amount_to_final', 0):.2f} {tx_data.get('to_asset', '')}"
+                f" (курс `{tx_data.get('rate_used', 0)}`)\n"
+            )
+
+        profits = {}
+        for tx_data in transactions:
+            profit = tx_data.get('profit', 0)
+            if profit:
+                currency = tx_data.get('profit_currency', '')
+                profits[currency] = profits.get(currency, 0) + profit
+        for currency, profit in profits.items():
+            profit_icon = "📈" if profit > 0 else "📉"
+            message += f"\nПрибыль: *{profit:.2f} {currency}* {profit_icon}"
+
+        if balances:
+            message += "\n\n" + "\n".join(f"Баланс {asset}: *{balance:.2f}*" for asset, balance in balances.items())
+        return message
+
     def format_undo_message(self, cash_desk_name: str, snapshot_desc: str) -> str:
         """Форматирует сообщение об отмене."""
         return f"*{'❌'} Отмена операции ({cash_desk_name})*\n\n" \
@@ -0,0 +1,88 @@
+"""
+Утилиты денежной арифметики на масштабированных целых
+
+Суммы хранятся в целых единицах 1e-7 (точность остатков лотов), курсы - в единицах 1e-12.
+Промежуточные результаты FIFO (прибыль, себестоимость) копятся в рабочих единицах 1e-18,
+а округление до 0.01 / 0.0001 выполняется один раз - половина от нуля (как ROUND_HALF_UP).
+Преобразование float → целое делается один раз на входе, целое → float - один раз на выходе.
+
+В MongoDB денежные поля хранятся как Decimal128; при чтении драйвер отдаёт их как float
+(Decimal128AsFloat), поэтому старые документы с double и новые с Decimal128 читаются одинаково.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from bson.decimal128 import Decimal128
+
+AMOUNT_DECIMALS = 7
+RATE_DECIMALS = 12
+WORK_DECIMALS = 18
+
+AMOUNT_SCALE = 10 ** AMOUNT_DECIMALS
+RATE_SCALE = 10 ** RATE_DECIMALS
+WORK_SCALE = 10 ** WORK_DECIMALS
+
+# Множитель из единиц суммы в рабочие единицы
+AMOUNT_TO_WORK = WORK_SCALE // AMOUNT_SCALE
+
+# Граница, до которой value * scale точно представимо в float
+_FLOAT_EXACT = 2 ** 52
+
+
+def to_units(value, scale: int = AMOUNT_SCALE) -> int:
+    """Число → целое количество единиц 1/scale (округление половины от нуля)"""
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value * scale
+    scaled = value * scale
+    if abs(scaled) < _FLOAT_EXACT:
+        units = int(scaled)
+        remainder = scaled - units
+        if remainder >= 0.5:
+            units += 1
+        elif remainder <= -0.5:
+            units -= 1
+        return units
+    # Очень большие значения - через Decimal, без потери точности
+    return int(Decimal(repr(value)).scaleb(len(str(scale)) - 1).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_units(units: int, scale: int = AMOUNT_SCALE) -> float:
+    """Целое количество единиц 1/scale → float (деление int/int округляется корректно)"""
+    return units / scale
+
+
+def div_round(numerator: int, denominator: int) -> int:
+    """Целочисленное деление с округлением половины от нуля"""
+    if denominator == 0:
+        raise ZeroDivisionError("division by zero in money arithmetic")
+    negative = (numerator < 0) != (denominator < 0)
+    quotient, remainder = divmod(abs(numerator), abs(denominator))
+    if 2 * remainder >= abs(denominator):
+        quotient += 1
+    return -quotient if negative else quotient
+
+
+def quantize_work(work_units: int, decimals: int) -> float:
+    """Рабочие единицы 1e-18 → float, округлённый до decimals знаков"""
+    return from_units(div_round(work_units, 10 ** (WORK_DECIMALS - decimals)), 10 ** decimals)
+
+
+def to_decimal128(value) -> Decimal128:
+    """Число → Decimal128 по его кратчайшей десятичной записи (0.1 → 0.1, а не 0.1000000000000000055)"""
+    if isinstance(value, Decimal128):
+        return value
+    if isinstance(value, Decimal):
+        return Decimal128(value)
+    return Decimal128(Decimal(repr(value)))
+
+
+class Decimal128AsFloat(TypeDecoder):
+    """Декодер драйвера: Decimal128 из базы читается как float"""
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        return float(value.to_decimal())
+
+
+MONEY_CODEC_OPTIONS = CodecOptions(type_registry=TypeRegistry([Decimal128AsFloat()]))
@@ -0,0 +1,28 @@
+"""
+Утилиты для разбора транзакций
+"""
+
+
+def transaction_cash_flows(tx: dict) -> list:
+    """
+    Возвращает движения кассы, которые порождает транзакция.
+
+    Returns:
+        Список кортежей (asset, delta): delta > 0 - приход в кассу, delta < 0 - расход
+    """
+    tx_type = tx.get("type")
+    from_asset = tx.get("from_asset")
+    to_asset = tx.get("to_asset")
+    amount_from = tx.get("amount_from") or 0
+    amount_to_final = tx.get("amount_to_final") or 0
+
+    if tx_type in ("deposit", "withdrawal"):
+        # У вывода amount_from уже отрицательный
+        return [(from_asset, amount_from)] if from_asset else []
+
+    if tx_type == "fiat_to_fiat":
+        # Касса отдаёт from_asset и получает to_asset
+        return [(from_asset, -amount_from), (to_asset, amount_to_final)]
+
+    # fiat_to_crypto / crypto_to_fiat: клиент отдаёт from_asset, получает to_asset
+    return [(from_asset, amount_from), (to_asset, -amount_to_final)]
@@ -0,0 +1,25 @@
+"""
+Общие настройки тестов: пакет src импортируется из каталога back.
+Зависимости тестов - requirements.txt и requirements-dev.txt:
+pip install -r requirements.txt -r requirements-dev.txt && python -m pytest tests
+"""
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """База mongomock вместо подключения src.db во всех уже импортированных модулях src"""
+    from src import db as db_module
+
+    original = db_module.db
+    database = mongomock.MongoClient().get_database("exchange_dashboard")
+    for name, module in list(sys.modules.items()):
+        if (name == "src" or name.startswith("src.")) and getattr(module, "db", None) is original:
+            monkeypatch.setattr(module, "db", database)
+    return database
@@ -0,0 +1,119 @@
+"""
+Тесты счётчиков кассы (desk_stats): приращения при создании, замена версии
+при редактировании, вычитание при удалении и совпадение с пересборкой
+"""
+from datetime import datetime, timedelta
+
+from src.desk_stats import desk_stats_manager
+
+T0 = datetime(2024, 1, 1)
+
+
+def make_tx(index, tx_type, from_asset, to_asset, amount_from, amount_to_final, profit=0.0):
+    tx = {
+        "_id": f"tx-{index}",
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "type": tx_type,
+        "from_asset": from_asset,
+        "to_asset": to_asset,
+        "amount_from": amount_from,
+        "amount_to_final": amount_to_final,
+        "created_at": T0 + timedelta(hours=index)
+    }
+    if profit:
+        tx["profit_currency"] = to_asset if tx_type == "crypto_to_fiat" else from_asset
+        tx["realized_profit"] = profit
+    return tx
+
+
+def write(mongo_db, tx):
+    mongo_db.transactions.insert_one(dict(tx))
+    desk_stats_manager.record_transaction(tx)
+
+
+def stored_stats(mongo_db):
+    stats = mongo_db.desk_stats.find_one({"_id": "desk1"})
+    return {key: stats[key] for key in ("profit", "tx_count", "last_op_at", "volume_in", "volume_out")}
+
+
+def rebuilt_stats(mongo_db):
+    stats = desk_stats_manager.rebuild("desk1", "t1")
+    return {key: stats[key] for key in ("profit", "tx_count", "last_op_at", "volume_in", "volume_out")}
+
+
+def seed_history(mongo_db):
+    """Касса с историей до появления desk_stats: транзакции есть, документа счётчиков нет"""
+    history = [
+        make_tx(0, "deposit", "CZK", None, 5000.0, 0),
+        make_tx(1, "fiat_to_crypto", "CZK", "USDT", 2500.0, 100.0),
+        make_tx(2, "crypto_to_fiat", "USDT", "CZK", 40.0, 800.0, profit=200.0)
+    ]
+    mongo_db.transactions.insert_many([dict(tx) for tx in history])
+    return history
+
+
+def test_first_write_after_deploy_keeps_history(mongo_db):
+    seed_history(mongo_db)
+
+    write(mongo_db, make_tx(3, "crypto_to_fiat", "USDT", "CZK", 10.0, 200.0, profit=50.0))
+
+    stats = stored_stats(mongo_db)
+    assert stats["tx_count"] == 4
+    assert stats["profit"] == {"CZK": 250.0}
+    assert stats["last_op_at"] == T0 + timedelta(hours=3)
+    assert stats == rebuilt_stats(mongo_db)
+
+
+def test_record_increments_existing_counters(mongo_db):
+    seed_history(mongo_db)
+    desk_stats_manager.rebuild("desk1", "t1")
+
+    write(mongo_db, make_tx(3, "withdrawal", "CZK", None, -300.0, 0))
+
+    stats = stored_stats(mongo_db)
+    assert stats["tx_count"] == 4
+    assert stats["volume_in"]["CZK"] == 5000.0 + 2500.0
+    assert stats["volume_out"]["CZK"] == 800.0 + 300.0
+    assert stats == rebuilt_stats(mongo_db)
+
+
+def test_edit_swaps_transaction_version(mongo_db):
+    history = seed_history(mongo_db)
+    desk_stats_manager.rebuild("desk1", "t1")
+
+    old = history[2]
+    new = {**old, "amount_to_final": 900.0, "realized_profit": 120.0}
+    mongo_db.transactions.replace_one({"_id": old["_id"]}, dict(new))
+    desk_stats_manager.apply_changes([old], [new])
+
+    stats = stored_stats(mongo_db)
+    assert stats["tx_count"] == 3
+    assert stats["profit"] == {"CZK": 120.0}
+    assert stats["volume_out"]["CZK"] == 900.0
+    assert stats == rebuilt_stats(mongo_db)
+
+
+def test_delete_subtracts_transaction(mongo_db):
+    history = seed_history(mongo_db)
+    desk_stats_manager.rebuild("desk1", "t1")
+
+    mongo_db.transactions.delete_one({"_id": history[2]["_id"]})
+    desk_stats_manager.remove_transaction(history[2])
+
+    stats = stored_stats(mongo_db)
+    assert stats["tx_count"] == 2
+    assert stats["profit"] == {"CZK": 0.0}
+    assert stats["volume_out"]["CZK"] == 0.0
+    assert stats["volume_in"]["USDT"] == 0.0
+    assert stats["tx_count"] == rebuilt_stats(mongo_db)["tx_count"]
+
+
+def test_backfill_builds_missing_desks_only(mongo_db):
+    seed_history(mongo_db)
+    mongo_db.cash_desks.insert_many([{"_id": "desk1", "tenant_id": "t1"}, {"_id": "desk2", "tenant_id": "t1"}])
+    mongo_db.desk_stats.insert_one({"_id": "desk2", "tenant_id": "t1", "tx_count": 7})
+
+    assert desk_stats_manager.backfill() == 1
+    assert stored_stats(mongo_db)["tx_count"] == 3
+    assert mongo_db.desk_stats.find_one({"_id": "desk2"})["tx_count"] == 7
@@ -0,0 +1,157 @@
+"""
+Тесты FIFO-движка на целых единицах: прибыль этапов 1/2/3, посчитанная вручную,
+новые лоты и себестоимость fiat_to_fiat
+"""
+from datetime import datetime, timedelta
+from itertools import count
+
+from src.fifo_engine import fifo_engine, LotBook
+
+T0 = datetime(2024, 1, 1)
+NOW = T0 + timedelta(days=1)
+
+
+def make_ids():
+    counter = count(1)
+    return lambda: f"id-{next(counter)}"
+
+
+def make_lot(_id, remaining, rate, source, minutes, cost_usdt=None):
+    meta = {"source": source}
+    if cost_usdt is not None:
+        meta["cost_usdt_of_fiat_in"] = cost_usdt
+    return {
+        "_id": _id,
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "currency": "CZK",
+        "remaining": remaining,
+        "rate": rate,
+        "created_at": T0 + timedelta(minutes=minutes),
+        "meta": meta
+    }
+
+
+def make_book():
+    """
+    CZK: живой лот 1000 по 25 CZK/USDT, затем лот обменного пункта 500 CZK
+    с себестоимостью 20 USDT (тоже 25 CZK/USDT)
+    """
+    return LotBook([
+        make_lot("live", 1000.0, 25.0, "fiat_to_crypto", 0),
+        make_lot("exchange", 500.0, 25.0, "fiat_to_fiat", 1, cost_usdt=20.0)
+    ])
+
+
+def sell_czk(amount_usdt, amount_czk):
+    return {
+        "_id": "tx-sell",
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "type": "crypto_to_fiat",
+        "from_asset": "USDT",
+        "to_asset": "CZK",
+        "amount_from": amount_usdt,
+        "amount_to_final": amount_czk
+    }
+
+
+def test_crypto_to_fiat_stages_hand_computed():
+    # Продажа 2000 CZK за 100 USDT: курс продажи 20 CZK/USDT
+    result = fifo_engine.apply(sell_czk(100.0, 2000.0), make_book(), NOW, make_ids())
+
+    stage1, stage2, stage3 = result["matches"]
+
+    # Этап 1: 1000 CZK живого лота, (25 - 20) · 1000 / 20 = 250 CZK = 12.5 USDT
+    assert stage1["stage"] == 1
+    assert stage1["open_lot_id"] == "live"
+    assert stage1["fiat_used"] == 1000.0
+    assert stage1["matched_usdt"] == 50.0
+    assert stage1["pnl_fiat"] == 250.0
+    assert stage1["pnl_usdt"] == 12.5
+
+    # Этап 2: 500 CZK лота обменного пункта, 500 / 20 - 20 = 5 USDT = 100 CZK
+    assert stage2["stage"] == 2
+    assert stage2["open_lot_id"] == "exchange"
+    assert stage2["fiat_used"] == 500.0
+    assert stage2["matched_usdt"] == 25.0
+    assert stage2["pnl_usdt"] == 5.0
+    assert stage2["pnl_fiat"] == 100.0
+
+    # Этап 3: оставшиеся 500 CZK - из депозитов, без прибыли
+    assert stage3["stage"] == 3
+    assert stage3["open_lot_id"] == "deposit"
+    assert stage3["fiat_used"] == 500.0
+    assert stage3["matched_usdt"] == 25.0
+    assert stage3["pnl_fiat"] == 0.0
+    assert stage3["pnl_usdt"] == 0.0
+
+    assert result["realized_profit"] == 350.0
+    assert result["realized_profit_usdt"] == 17.5
+    assert result["profit_currency"] == "CZK"
+    assert result["cash_deltas"] == [("CZK", -2000.0), ("USDT", 100.0)]
+    assert all(match["close_tx_id"] == "tx-sell" for match in result["matches"])
+    assert [(item["lot"]["_id"], item["take"], item["remaining"]) for item in result["consumed"]] == [
+        ("live", 1000.0, 0.0),
+        ("exchange", 500.0, 0.0)
+    ]
+
+
+def test_crypto_to_fiat_partial_lot_keeps_remainder():
+    # 600 CZK за 30 USDT: только часть живого лота, (25 - 20) · 600 / 20 = 150 CZK
+    book = make_book()
+    result = fifo_engine.apply(sell_czk(30.0, 600.0), book, NOW, make_ids())
+
+    assert [match["stage"] for match in result["matches"]] == [1]
+    assert result["realized_profit"] == 150.0
+    assert result["realized_profit_usdt"] == 7.5
+    assert book.next_open("CZK", "fiat_to_crypto")["remaining"] == 400.0
+
+
+def test_fiat_to_crypto_creates_lot_at_effective_rate():
+    tx = {
+        "_id": "tx-buy",
+        "type": "fiat_to_crypto",
+        "from_asset": "CZK",
+        "to_asset": "USDT",
+        "amount_from": 2500.0,
+        "amount_to_final": 100.0,
+        "fee_percent": 1.0
+    }
+    book = LotBook()
+    result = fifo_engine.apply(tx, book, NOW, make_ids())
+
+    lot, = result["new_lots"]
+    assert lot["currency"] == "CZK"
+    assert lot["remaining"] == 2500.0
+    assert lot["rate"] == 25.0
+    assert lot["tx_id"] == "tx-buy"
+    assert lot["meta"] == {"source": "fiat_to_crypto", "fee_percent": 1.0}
+    assert result["matches"] == []
+    assert result["realized_profit"] == 0.0
+    assert book.next_open("CZK") is lot
+
+
+def test_fiat_to_fiat_cost_and_new_lot():
+    # 500 CZK живого лота по 25 CZK/USDT = 20 USDT себестоимости за 20 EUR
+    tx = {
+        "_id": "tx-f2f",
+        "type": "fiat_to_fiat",
+        "from_asset": "CZK",
+        "to_asset": "EUR",
+        "amount_from": 500.0,
+        "amount_to_final": 20.0
+    }
+    book = make_book()
+    result = fifo_engine.apply(tx, book, NOW, make_ids())
+
+    assert result["cost_usdt_of_fiat_in"] == 20.0
+    assert result["rate_usdt_of_fiat_in"] == 1.0
+    assert result["matches"] == []
+    lot, = result["new_lots"]
+    assert lot["currency"] == "EUR"
+    assert lot["remaining"] == 20.0
+    assert lot["rate"] == 1.0
+    assert lot["meta"]["source"] == "fiat_to_fiat"
+    assert lot["meta"]["cost_usdt_of_fiat_in"] == 20.0
+    assert book.next_open("CZK")["remaining"] == 500.0
@@ -0,0 +1,93 @@
+"""
+Тесты агрегатов открытых лотов (lot_stats): приращения только к собранным агрегатам,
+пересборка кассы с уже открытыми лотами и совпадение с rebuild
+"""
+from datetime import datetime, timedelta
+
+from src.lot_stats import lot_stats_manager
+
+T0 = datetime(2024, 1, 1)
+FIELDS = ("total_remaining", "rate_value", "open_count")
+
+
+def make_lot(_id, remaining, rate, minutes, source="fiat_to_crypto"):
+    return {
+        "_id": _id,
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "currency": "CZK",
+        "remaining": remaining,
+        "rate": rate,
+        "created_at": T0 + timedelta(minutes=minutes),
+        "meta": {"source": source}
+    }
+
+
+def stored(mongo_db, source="fiat_to_crypto"):
+    doc = mongo_db.lot_stats.find_one({"cash_desk_id": "desk1", "currency": "CZK", "source": source})
+    return {field: doc[field] for field in FIELDS}
+
+
+def consume(mongo_db, lot, take):
+    """Списание, как его записывает обмен: остаток лота, затем агрегаты"""
+    remaining = lot["remaining"] - take
+    mongo_db.fiat_lots.update_one({"_id": lot["_id"]}, {"$set": {"remaining": remaining}})
+    return {"lot": dict(lot), "take": take, "remaining": remaining}
+
+
+def test_first_change_on_unbuilt_desk_includes_existing_lots(mongo_db):
+    old = make_lot("old", 1000.0, 25.0, 0)
+    mongo_db.fiat_lots.insert_one(dict(old))
+
+    new = make_lot("new", 500.0, 24.0, 10)
+    mongo_db.fiat_lots.insert_one(dict(new))
+    lot_stats_manager.apply_lot_changes("desk1", "t1", [new], [])
+
+    assert stored(mongo_db) == {"total_remaining": 1500.0, "rate_value": 37000.0, "open_count": 2}
+
+
+def test_consumption_on_unbuilt_desk_never_goes_negative(mongo_db):
+    old = make_lot("old", 1000.0, 25.0, 0)
+    mongo_db.fiat_lots.insert_one(dict(old))
+
+    lot_stats_manager.apply_lot_changes("desk1", "t1", [], [consume(mongo_db, old, 1000.0)])
+
+    assert stored(mongo_db) == {"total_remaining": 0.0, "rate_value": 0.0, "open_count": 0}
+
+
+def test_deltas_match_rebuild(mongo_db):
+    first, second = make_lot("first", 1000.0, 25.0, 0), make_lot("second", 400.0, 20.0, 5)
+    mongo_db.fiat_lots.insert_many([dict(first), dict(second)])
+    lot_stats_manager.rebuild("desk1", "t1")
+
+    # Первый лот закрыт, второй списан частично
+    consumed = [consume(mongo_db, first, 1000.0), consume(mongo_db, second, 100.0)]
+    lot_stats_manager.apply_lot_changes("desk1", "t1", [], consumed)
+
+    assert stored(mongo_db) == {"total_remaining": 300.0, "rate_value": 6000.0, "open_count": 1}
+    incremental = stored(mongo_db)
+    lot_stats_manager.rebuild("desk1", "t1")
+    assert stored(mongo_db) == incremental
+
+
+def test_summary_reports_oldest_open_lot(mongo_db):
+    lots = [make_lot("closed", 0.0, 25.0, 0), make_lot("open", 300.0, 20.0, 5), make_lot("later", 100.0, 22.0, 9)]
+    mongo_db.fiat_lots.insert_many([dict(lot) for lot in lots])
+    mongo_db.cash_desks.insert_one({"_id": "desk1", "tenant_id": "t1"})
+
+    summary = lot_stats_manager.get_summary("CZK", cash_desk_id="desk1", tenant_id="t1")
+
+    assert summary["count"] == 2
+    assert summary["total_remaining"] == 400.0
+    assert summary["weighted_avg_rate"] == (300.0 * 20.0 + 100.0 * 22.0) / 400.0
+    assert summary["oldest_open_at"] == T0 + timedelta(minutes=5)
+    assert lot_stats_manager.get_summary("CZK", tenant_id="t1")["oldest_open_at"] == T0 + timedelta(minutes=5)
+
+
+def test_backfill_builds_missing_desks_only(mongo_db):
+    mongo_db.fiat_lots.insert_one(make_lot("old", 1000.0, 25.0, 0))
+    mongo_db.cash_desks.insert_one({"_id": "desk1", "tenant_id": "t1"})
+
+    assert lot_stats_manager.backfill() == 1
+    assert stored(mongo_db)["open_count"] == 1
+    assert lot_stats_manager.backfill() == 0
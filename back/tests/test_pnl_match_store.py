@@ -0,0 +1,83 @@
+"""
+Тесты раскладки матчей PnL по корзинам: layout и обратное _expand
+возвращают куски в прежнем виде отдельных матчей
+"""
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from src import pnl_match_store as store_module
+from src.pnl_match_store import pnl_match_store, BUCKET_FIELDS
+
+NOW = datetime(2024, 1, 2)
+
+
+def make_match(close_tx_id, index, fiat_used, pnl_fiat, stage=1):
+    return {
+        "_id": ObjectId(),
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "close_tx_id": close_tx_id,
+        "currency": "CZK",
+        "open_lot_id": f"lot-{index}",
+        "stage": stage,
+        "fiat_used": fiat_used,
+        "matched_usdt": fiat_used / 20,
+        "lot_rate": 25.0,
+        "sell_rate_eff": 20.0,
+        "pnl_fiat": pnl_fiat,
+        "pnl_usdt": pnl_fiat / 20,
+        "created_at": NOW
+    }
+
+
+@pytest.fixture
+def buckets_enabled(monkeypatch):
+    monkeypatch.setattr(store_module, "PNL_MATCH_BUCKETS", True)
+
+
+def test_layout_groups_pieces_by_closing_transaction(buckets_enabled):
+    first, second = str(ObjectId()), str(ObjectId())
+    matches = [
+        make_match(first, 0, 0.1, 0.1),
+        make_match(first, 1, 0.2, 0.2),
+        make_match(second, 0, 500.0, 100.0, stage=2),
+        make_match(None, 0, 50.0, 0.0, stage=3)
+    ]
+    documents, buckets = pnl_match_store.layout(matches)
+
+    # Матч без закрывающей транзакции остаётся отдельным документом
+    assert documents == [matches[3]]
+    assert [bucket["_id"] for bucket in buckets] == [ObjectId(first), ObjectId(second)]
+
+    bucket = buckets[0]
+    assert bucket["pieces_count"] == 2
+    assert {field: bucket[field] for field in BUCKET_FIELDS} == {field: matches[0][field] for field in BUCKET_FIELDS}
+    # Суммы кусков - в рабочих единицах, без погрешности float (0.1 + 0.2 != 0.3)
+    assert bucket["fiat_used"] == 0.3
+    assert bucket["pnl_fiat"] == 0.3
+    for piece in bucket["pieces"]:
+        assert not {"_id", "close_tx_id", *BUCKET_FIELDS} & set(piece)
+
+
+def test_expand_restores_matches(buckets_enabled):
+    close_tx_id = str(ObjectId())
+    matches = [make_match(close_tx_id, index, 100.0 * (index + 1), 10.0) for index in range(3)]
+    _, (bucket,) = pnl_match_store.layout(matches)
+
+    expanded = pnl_match_store._expand(bucket)
+
+    assert [match["_id"] for match in expanded] == [f"{close_tx_id}-{index}" for index in range(3)]
+    for original, restored in zip(matches, expanded):
+        assert restored == {**original, "_id": restored["_id"]}
+
+
+def test_layout_without_buckets_keeps_documents(monkeypatch):
+    monkeypatch.setattr(store_module, "PNL_MATCH_BUCKETS", False)
+    matches = [make_match(str(ObjectId()), 0, 10.0, 1.0)]
+
+    documents, buckets = pnl_match_store.layout(matches)
+
+    assert documents == matches
+    assert buckets == []
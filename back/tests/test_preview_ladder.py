@@ -0,0 +1,34 @@
+"""
+Тесты лестницы котировок: векторное списание PreviewLadder._consume
+совпадает с FifoEngine.apply для той же книги лотов и сумм
+"""
+import numpy as np
+import pytest
+
+from src.fifo_engine import fifo_engine
+from src.preview_ladder import PreviewLadder
+from test_fifo_engine import NOW, make_book, make_ids, sell_czk
+
+
+@pytest.mark.parametrize("need", [0.0, 300.0, 1000.0, 1200.0, 1500.0, 2500.0])
+def test_preview_consume_matches_apply(need):
+    lots = make_book().open_lots("CZK")
+    sell_rate = 20.0
+    result = fifo_engine.apply(sell_czk(need / sell_rate, need), make_book(), NOW, make_ids()) if need else None
+    matches = result["matches"] if result else []
+    stage1 = [match for match in matches if match["stage"] == 1]
+    stage2 = [match for match in matches if match["stage"] == 2]
+
+    needs = np.array([need])
+    remaining, rate, _ = PreviewLadder._lot_arrays(lots, "fiat_to_crypto")
+    taken1, rate_value, used1 = PreviewLadder._consume(needs, remaining, rate)
+    assert taken1[0] == pytest.approx(sum(match["fiat_used"] for match in stage1))
+    assert rate_value[0] == pytest.approx(sum(match["fiat_used"] * match["lot_rate"] for match in stage1))
+    assert used1[0] == len(stage1)
+
+    remaining, _, cost = PreviewLadder._lot_arrays(lots, "fiat_to_fiat")
+    taken2, cost_value, used2 = PreviewLadder._consume(needs - taken1, remaining, cost / remaining)
+    assert taken2[0] == pytest.approx(sum(match["fiat_used"] for match in stage2))
+    # Себестоимость списанной доли = matched_usdt - pnl_usdt куска
+    assert cost_value[0] == pytest.approx(sum(match["matched_usdt"] - match["pnl_usdt"] for match in stage2))
+    assert used2[0] == len(stage2)
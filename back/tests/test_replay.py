@@ -0,0 +1,71 @@
+"""
+Тесты пересборки кассы по журналу: производные поля транзакций считаются
+заново из входных данных, испорченные сохранённые значения восстанавливаются
+"""
+from datetime import datetime, timedelta
+
+from src.replay import replay_manager
+
+T0 = datetime(2024, 1, 1)
+
+
+def make_tx(index, tx_type, from_asset, to_asset, amount_from, amount_to_final, **derived):
+    return {
+        "_id": f"tx-{index}",
+        "tenant_id": "t1",
+        "cash_desk_id": "desk1",
+        "type": tx_type,
+        "from_asset": from_asset,
+        "to_asset": to_asset,
+        "amount_from": amount_from,
+        "amount_to_final": amount_to_final,
+        "created_at": T0 + timedelta(hours=index),
+        **derived
+    }
+
+
+def test_corrupted_derived_fields_are_recomputed(mongo_db):
+    mongo_db.transactions.insert_many([
+        # Покупка: лот 2500 CZK по 25 CZK/USDT
+        make_tx(0, "fiat_to_crypto", "CZK", "USDT", 2500.0, 100.0, profit_currency="CZK"),
+        # Продажа 2000 CZK за 100 USDT: (25 - 20) · 2000 / 20 = 500 CZK, сохранено неверно
+        make_tx(
+            1, "crypto_to_fiat", "USDT", "CZK", 100.0, 2000.0,
+            profit=1.0, profit_currency="EUR", realized_profit=1.0, realized_profit_usdt=1.0
+        ),
+        # Обмен EUR → CZK без лотов EUR: себестоимости нет, сохранённая - мусор
+        make_tx(
+            2, "fiat_to_fiat", "EUR", "CZK", 10.0, 250.0,
+            profit=0.0, profit_currency="USDT", realized_profit=0.0, realized_profit_usdt=0.0,
+            cost_usdt_of_fiat_in=999.0, rate_usdt_of_fiat_in=0.25
+        )
+    ])
+
+    replayed = replay_manager.regenerate("desk1")
+    changes = {tx["_id"]: fields for tx, fields in replayed["changed_txs"]}
+
+    assert changes["tx-1"] == {
+        "profit": 500.0, "profit_currency": "CZK", "realized_profit": 500.0, "realized_profit_usdt": 25.0
+    }
+    assert changes["tx-2"] == {"cost_usdt_of_fiat_in": None, "rate_usdt_of_fiat_in": None}
+    # Лот из испорченной себестоимости не создаётся
+    assert [(lot["currency"], lot["remaining"]) for lot in replayed["lots"]] == [("CZK", 500.0)]
+    assert replayed["profit"] == {"CZK": 500.0}
+
+
+def test_replay_is_deterministic_from_log(mongo_db):
+    clean = [
+        make_tx(0, "fiat_to_crypto", "CZK", "USDT", 2500.0, 100.0),
+        make_tx(1, "fiat_to_fiat", "EUR", "CZK", 10.0, 250.0),
+        make_tx(2, "crypto_to_fiat", "USDT", "CZK", 100.0, 2000.0)
+    ]
+    mongo_db.transactions.insert_many([dict(tx) for tx in clean])
+    expected = replay_manager.regenerate("desk1")
+
+    mongo_db.transactions.update_one({"_id": "tx-1"}, {"$set": {"cost_usdt_of_fiat_in": 3.0}})
+    mongo_db.transactions.update_one({"_id": "tx-2"}, {"$set": {"realized_profit": -7.0}})
+    replayed = replay_manager.regenerate("desk1")
+
+    assert replayed["profit"] == expected["profit"]
+    assert replayed["balances"] == expected["balances"]
+    assert [lot["remaining"] for lot in replayed["lots"]] == [lot["remaining"] for lot in expected["lots"]]
@@ -0,0 +1,83 @@
+"""
+Тесты пакетного проведения обменов: ошибка расчёта или списания лотов одной позиции
+при atomic=false возвращается в results, а не роняет весь запрос
+"""
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+from src.models import Transaction, TransactionBatch
+from src.routers import transactions as transactions_module
+from src.routers.transactions import create_transactions_batch, _price_transaction
+
+
+@pytest.fixture
+def desk(mongo_db):
+    mongo_db.cash_desks.insert_one({"_id": "desk1", "tenant_id": "t1", "name": "Прага", "is_active": True})
+    mongo_db.cash.insert_many([
+        {"asset": "CZK", "balance": 100000.0, "cash_desk_id": "desk1", "tenant_id": "t1"},
+        {"asset": "USDT", "balance": 10000.0, "cash_desk_id": "desk1", "tenant_id": "t1"}
+    ])
+    return mongo_db
+
+
+def buy_usdt(amount_czk):
+    return Transaction(type="fiat_to_crypto", from_asset="CZK", to_asset="USDT", amount_from=amount_czk, rate_used=25.0)
+
+
+def sell_usdt(amount_usdt):
+    return Transaction(type="crypto_to_fiat", from_asset="USDT", to_asset="CZK", amount_from=amount_usdt, rate_used=20.0)
+
+
+@pytest.mark.parametrize("amount_from", [0.0, -10.0])
+def test_price_rejects_non_positive_amount(amount_from):
+    with pytest.raises(HTTPException) as error:
+        _price_transaction(sell_usdt(amount_from))
+    assert error.value.status_code == 400
+
+
+def test_zero_amount_is_reported_per_item(desk):
+    batch = TransactionBatch(transactions=[sell_usdt(0.0)], atomic=False)
+
+    response = create_transactions_batch(batch, "desk1", BackgroundTasks(), tenant_id="t1")
+
+    assert response["results"] == [{"index": 0, "status": "error", "detail": "amount_from must be positive"}]
+    assert desk.transactions.count_documents({}) == 0
+
+
+@pytest.fixture
+def failing_sell(monkeypatch):
+    """Списание лотов продажи падает с делением на ноль"""
+    apply = transactions_module.fifo_engine.apply
+
+    def failing_apply(tx, book, now, *args):
+        if tx["type"] == "crypto_to_fiat":
+            raise ZeroDivisionError("division by zero")
+        return apply(tx, book, now, *args)
+
+    monkeypatch.setattr(transactions_module.fifo_engine, "apply", failing_apply)
+
+
+def test_lot_matching_failure_is_reported_per_item(desk, failing_sell):
+    batch = TransactionBatch(transactions=[sell_usdt(10.0)], atomic=False)
+
+    response = create_transactions_batch(batch, "desk1", BackgroundTasks(), tenant_id="t1")
+
+    assert response["results"] == [
+        {"index": 0, "status": "error", "detail": "Invalid amount or rate: division by zero"}
+    ]
+    assert desk.transactions.count_documents({}) == 0
+
+
+def test_lot_matching_failure_skips_rest_of_batch(desk, failing_sell):
+    batch = TransactionBatch(transactions=[buy_usdt(2500.0), sell_usdt(10.0), buy_usdt(500.0)])
+
+    with pytest.raises(HTTPException) as error:
+        create_transactions_batch(batch, "desk1", BackgroundTasks(), tenant_id="t1")
+
+    assert error.value.status_code == 400
+    # После упавшего списания книга в памяти недостоверна - следующие позиции не проводятся
+    assert error.value.detail["errors"] == [
+        {"index": 1, "detail": "Invalid amount or rate: division by zero"},
+        {"index": 2, "detail": "Skipped: lot matching failed at item 1"}
+    ]
+    assert desk.transactions.count_documents({}) == 0
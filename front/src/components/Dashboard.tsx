@@ -37,6 +37,12 @@ interface ProfitSummary {
   }
 }
 
+interface DashboardData {
+  cash: Record<string, number>
+  profits_by_currency: Record<string, number>
+  summaries: Record<string, ProfitSummary>
+}
+
 export function Dashboard() {
   const [cashStatus, setCashStatus] = useState<CashStatus>({})
   const [realizedProfit, setRealizedProfit] = useState<CashProfit>({})
@@ -66,44 +72,21 @@ export function Dashboard() {
         ? ''
         : `?cash_desk_id=${selectedCashDeskId}`
 
-      const [statusRes, cashflowRes, realizedRes] = await Promise.all([
-        authenticatedFetch(`${API_BASE}/cash/status${cashDeskParam}`),
-        authenticatedFetch(`${API_BASE}/cash/cashflow_profit${cashDeskParam}`),
-        authenticatedFetch(`${API_BASE}/cash/profit${cashDeskParam}`),
-      ])
-
-      if (statusRes.ok) {
-        const statusData = await statusRes.json()
-        setCashStatus(statusData)
-      }
-
-      if (cashflowRes.ok) {
-        await cashflowRes.json()
-        // Cashflow data не используется в UI
-      }
-
-      if (realizedRes.ok) {
-        const realizedData = await realizedRes.json()
-        setRealizedProfit(realizedData)
-      }
-
-      // Получаем данные по фиатным лотам для всех валют
-      const currencies = ['CZK', 'USD', 'EUR']
-      const summariesData: Record<string, ProfitSummary> = {}
+      // Балансы, прибыль и сводки по всем валютам одним запросом
+      const dashboardRes = await authenticatedFetch(
+        `${API_BASE}/dashboard${cashDeskParam}`
+      )
 
-      for (const currency of currencies) {
-        try {
-          const summaryRes = await authenticatedFetch(
-            `${API_BASE}/transactions/profit-summary/${currency}${cashDeskParam}`
-          )
-          if (summaryRes.ok) {
-            summariesData[currency] = await summaryRes.json()
-          }
-        } catch (error) {
-          console.error(`Failed to fetch summary for ${currency}:`, error)
-        }
+      if (dashboardRes.ok) {
+        const dashboardData: DashboardData = await dashboardRes.json()
+        setCashStatus({ cash: dashboardData.cash })
+        setRealizedProfit({
+          profits_by_currency: dashboardData.profits_by_currency,
+        })
+        setProfitSummaries(dashboardData.summaries)
+      } else {
+        toast.error('Не удалось загрузить данные')
       }
-      setProfitSummaries(summariesData)
     } catch (error) {
       toast.error('Не удалось загрузить данные')
     } finally {
@@ -39,6 +39,10 @@ export function FiatLotsViewer({ onNavigateToHistory }: FiatLotsViewerProps) {
         if (selectedCashDesk?._id) {
           url.searchParams.set('cash_desk_id', selectedCashDesk._id)
         }
+        if (!showOnlyActive) {
+          // Исчерпанные лоты хранятся в архиве и запрашиваются отдельно
+          url.searchParams.set('include_archived', 'true')
+        }
         const res = await authenticatedFetch(url.toString())
         if (res.ok) {
           const data = await res.json()
@@ -59,7 +63,7 @@ export function FiatLotsViewer({ onNavigateToHistory }: FiatLotsViewerProps) {
 
   useEffect(() => {
     fetchLots()
-  }, [selectedCashDesk])
+  }, [selectedCashDesk, showOnlyActive])
 
   // Группируем лоты по валютам
   const lotsByCurrency = currencies.reduce((acc, currency) => {
@@ -7,6 +7,7 @@ import {
   ChevronDownIcon,
   DownloadIcon,
   UndoIcon,
+  RedoIcon,
 } from 'lucide-react'
 import { config } from '../config'
 import { useAuth } from '../services/authService'
@@ -497,6 +498,33 @@ export function TransactionsHistory() {
     }
   }
 
+  // Функция повтора последней отменённой операции
+  const handleRedo = async () => {
+    try {
+      const url = selectedCashDeskId
+        ? `${API_BASE}/redo?cash_desk_id=${selectedCashDeskId}`
+        : `${API_BASE}/redo`
+
+      const res = await authenticatedFetch(url, {
+        method: 'POST',
+      })
+      if (res.ok) {
+        const data = await res.json()
+        toast.success(
+          `✅ Операция повторена: ${
+            data.redone_description || data.redone_operation
+          }. Google Таблица обновлена.`
+        )
+        fetchTransactions()
+      } else {
+        const error = await res.json()
+        toast.error(error.detail || 'Нет операций для повтора')
+      }
+    } catch (error) {
+      toast.error('Ошибка при повторе операции')
+    }
+  }
+
   // Функция экспорта в CSV
   const handleExportCSV = async (simple = false) => {
     try {
@@ -749,6 +777,16 @@ export function TransactionsHistory() {
             <span className="sm:hidden">Отменить</span>
           </button>
 
+          {/* Кнопка Redo */}
+          <button
+            onClick={handleRedo}
+            className="flex items-center justify-center gap-2 px-3 sm:px-4 py-2 bg-orange-400 text-white rounded hover:bg-orange-500 text-sm flex-1 sm:flex-none"
+          >
+            <RedoIcon size={16} />
+            <span className="hidden sm:inline">Повторить</span>
+            <span className="sm:hidden">Повторить</span>
+          </button>
+
           {/* Меню экспорта */}
           <div className="relative flex-1 sm:flex-none export-menu-container">
             <button